@@ -0,0 +1,306 @@
+"""Benchmarks of the message pipeline and of worker state handling. Writes
+one JSON document of results, so that runs of different versions can be
+compared, and with --compare, exits with status 1 if anything got slower
+than a baseline by more than the tolerance.
+
+The pipeline benchmark floods temporary message drops with new requests
+(as left by `leave_new_request`) and with job events (as left by the job
+wrapper for array jobs of pre-started requests), then drains them with
+`Engine.sweep`, once on tmpfs and once on a disk-backed directory. It
+reports messages per second and the p50 and p99 time to deliver one
+message, including saving the worker.
+
+The state benchmarks time `load_most_recent_state`, saving a request whose
+large tree changes in one leaf at a time, with and without deltas, and
+`propagate_inheritance` on large request trees.
+
+Example:
+
+    python benchmarks/bench_pipeline.py --output bench_output.json
+    python benchmarks/bench_pipeline.py --compare bench_output.json
+"""
+
+import argparse
+from json import dump, load
+import os
+from pathlib import Path
+import platform
+import sys
+import tempfile
+import time
+from uuid import uuid4
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from seneschal import Engine, __version__, managers, messaging  # noqa: E402
+from seneschal.batch import LocalScheduler  # noqa: E402
+from seneschal.messaging import SUCCEEDED  # noqa: E402
+
+
+TMPFS = '/dev/shm'
+# Results where larger is better; for the rest smaller is better:
+HIGHER_IS_BETTER = {'messages_per_second'}
+
+
+def main():
+    args = parse_args()
+    results = []
+    storages = [('disk', args.disk)]
+    if args.tmpfs and os.path.isdir(args.tmpfs):
+        storages.insert(0, ('tmpfs', args.tmpfs))
+    for storage, base in storages:
+        with tempfile.TemporaryDirectory(dir=base) as directory:
+            results.append(bench_pipeline(
+                Path(directory), storage, args.requests, args.job_events
+            ))
+    with tempfile.TemporaryDirectory(dir=args.disk) as directory:
+        results.append(bench_load_state(Path(directory), args.tree_size,
+                                        args.repeat))
+        for saves in ('full', 'delta'):
+            results.append(bench_save_state(Path(directory), args.tree_size,
+                                            args.repeat, saves))
+    for chained in (False, True):
+        results.append(bench_propagate(args.tree_size, chained, args.repeat))
+    report = dict(version=__version__,
+                  python=platform.python_version(),
+                  platform=platform.platform(),
+                  time=time.time(),
+                  results=results)
+    if args.output == '-':
+        dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        with open(args.output, 'w') as fout:
+            dump(report, fout, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as fin:
+            baseline = load(fin)
+        regressions = compare(baseline, report, args.tolerance)
+        for regression in regressions:
+            print(regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument('--output', default='-',
+                        help='where to write JSON results (default stdout)')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='JSON results of an earlier run')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed fractional slowdown (default 0.2)')
+    parser.add_argument('--requests', type=int, default=2000,
+                        help='new request messages per pipeline run')
+    parser.add_argument('--job-events', type=int, default=2000,
+                        help='job event messages per pipeline run')
+    parser.add_argument('--tree-size', type=int, default=20000,
+                        help='leaf tasks in the large request tree')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='repetitions of the state benchmarks')
+    parser.add_argument('--tmpfs', default=TMPFS,
+                        help='tmpfs directory, skipped if missing')
+    parser.add_argument('--disk', default=os.getcwd(),
+                        help='disk-backed directory (default current)')
+    return parser.parse_args()
+
+
+def bench_pipeline(root, storage, request_count, job_event_count):
+    """Leave the messages, then time `Engine.sweep` delivering them all."""
+    paths = dict(user_messages=root / 'user_messages',
+                 job_messages=root / 'job_messages')
+    for path in paths.values():
+        for name in (messaging.TEMP, messaging.INBOX, messaging.RECEIVED,
+                     messaging.ERROR):
+            (path / name).mkdir(parents=True)
+    for name in ('requests', 'jobs', 'subprocesses'):
+        (root / name).mkdir()
+    config = dict(paths=paths, delivery=dict(batch_size=1000))
+    batch_scheduler = LocalScheduler(paths['job_messages'])
+    request_manager = managers.RequestManager(directory=root / 'requests')
+    job_manager = managers.JobManager(directory=root / 'jobs',
+                                      batch_scheduler=batch_scheduler)
+    subprocess_manager = managers.SubprocessManager(
+        directory=root / 'subprocesses')
+    broker = messaging.MessageBroker(config, request_manager, job_manager,
+                                     subprocess_manager)
+    engine = Engine(config)
+    engine.set_message_broker(broker)
+
+    # Each array task of a job leaves two events, STARTED and SUCCEEDED.
+    children = 50
+    for _ in range(max(1, job_event_count // (2 * children))):
+        start_array_request(request_manager, broker, children)
+    job_events = batch_scheduler.run_pending()
+    for index in range(request_count):
+        messaging.leave_new_request(paths['user_messages'], 'echo',
+                                    [str(index)])
+
+    durations = []
+    deliver_one_message = broker.deliver_one_message
+    depth = 0
+
+    def timed_delivery(message):
+        nonlocal depth
+        depth += 1
+        start = time.perf_counter()
+        try:
+            deliver_one_message(message)
+        finally:
+            depth -= 1
+        if depth == 0:  # Only time messages from the drops.
+            durations.append(time.perf_counter() - start)
+
+    broker.deliver_one_message = timed_delivery
+    start = time.perf_counter()
+    totals = engine.sweep()
+    elapsed = time.perf_counter() - start
+    subprocess_manager.shutdown()
+    delivered = sum(totals.values())
+    assert delivered == request_count + 2 * job_events, totals
+    return dict(name='pipeline', storage=storage, directory=str(root.parent),
+                messages=delivered, seconds=elapsed,
+                messages_per_second=delivered / elapsed,
+                p50_ms=percentile(durations, 0.5) * 1000,
+                p99_ms=percentile(durations, 0.99) * 1000)
+
+
+def start_array_request(request_manager, broker, children):
+    """Add and start a request whose children run as one array job."""
+    root = dict(type='parallel', child_type='batch_job', cores=1,
+                executable='/bin/true', prefix_arguments=[],
+                zchildren=[dict(arguments=[str(index)])
+                           for index in range(children)])
+    managers.propagate_inheritance(root, chained=True)
+    request_id = request_manager.add_worker(dict(t=root,
+                                                 id=str(uuid4())))
+    root['request_id'] = request_id
+    request = request_manager.registry[request_id]
+    request.root_task.start(broker)
+    request_manager.save_worker(request)
+
+
+def large_tree(leaf_count, fanout=100):
+    """Return a request tree mapping with about `leaf_count` leaves, as a
+    parallel root with parallel children of `fanout` subprocesses each."""
+    return dict(
+        type='parallel', child_type='parallel', cores=1, timeout=3600,
+        executable='/usr/bin/md5sum', prefix_arguments=['--binary'],
+        zchildren=[
+            dict(child_type='subprocess',
+                 zchildren=[dict(arguments=[f'file{group}_{index}'])
+                            for index in range(fanout)])
+            for group in range(max(1, leaf_count // fanout))
+        ]
+    )
+
+
+def bench_load_state(root, leaf_count, repeat):
+    """Time loading the latest state of a request with a large tree, after
+    enough saves for compaction to have happened."""
+    state_dir = root / str(uuid4())
+    state_dir.mkdir()
+    tree = large_tree(leaf_count)
+    managers.propagate_inheritance(tree, chained=True)
+    state = dict(id=state_dir.name, t=tree)
+    for _ in range(3):
+        managers.save_new_state(state_dir, state)
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        managers.load_most_recent_state(state_dir)
+        durations.append(time.perf_counter() - start)
+    return dict(name='load_most_recent_state', leaves=leaf_count,
+                bytes=sum(path.stat().st_size
+                          for path in state_dir.glob('*.json')) // 3,
+                p50_ms=percentile(durations, 0.5) * 1000,
+                p99_ms=percentile(durations, 0.99) * 1000)
+
+
+def bench_save_state(root, leaf_count, repeat, saves):
+    """Time `Manager.save_worker_state` for a request with a large tree,
+    finishing one leaf per save, with every state saved in full if `saves`
+    is "full", or with the default `state_snapshot_every` if "delta"."""
+    directory = root / f'save_{saves}'
+    directory.mkdir()
+    snapshot_every = 1 if saves == 'full' else managers.STATE_SNAPSHOT_EVERY
+    manager = managers.RequestManager(directory=directory,
+                                      state_snapshot_every=snapshot_every)
+    tree = large_tree(leaf_count)
+    managers.propagate_inheritance(tree, chained=True)
+    request_id = str(uuid4())
+    state = dict(id=request_id, t=tree)
+    manager.save_worker_state(request_id, state)
+    leaves = [leaf for group in tree['zchildren']
+              for leaf in group['zchildren']]
+    durations = []
+    for leaf in leaves[:repeat]:
+        leaf['state'] = SUCCEEDED
+        start = time.perf_counter()
+        manager.save_worker_state(request_id, state)
+        durations.append(time.perf_counter() - start)
+    state_dir = manager.worker_dir(request_id)
+    written = sum(path.stat().st_size for path in state_dir.iterdir()
+                  if not path.is_symlink())
+    return dict(name='save_worker_state', leaves=leaf_count,
+                saves=saves,
+                bytes_per_save=written // (len(durations) + 1),
+                p50_ms=percentile(durations, 0.5) * 1000,
+                p99_ms=percentile(durations, 0.99) * 1000)
+
+
+def bench_propagate(leaf_count, chained, repeat):
+    """Time `propagate_inheritance` over a fresh large tree."""
+    durations = []
+    for _ in range(repeat):
+        tree = large_tree(leaf_count)
+        start = time.perf_counter()
+        managers.propagate_inheritance(tree, chained=chained)
+        durations.append(time.perf_counter() - start)
+    return dict(name='propagate_inheritance', chained=chained,
+                leaves=leaf_count,
+                p50_ms=percentile(durations, 0.5) * 1000,
+                p99_ms=percentile(durations, 0.99) * 1000)
+
+
+def percentile(values, fraction):
+    """Return the value at `fraction` of the way through the sorted
+    values."""
+    ordered = sorted(values)
+    return ordered[round(fraction * (len(ordered) - 1))]
+
+
+def result_key(result):
+    """Return what identifies a result across runs."""
+    return tuple(sorted((key, value) for key, value in result.items()
+                        if isinstance(value, (str, bool)) and
+                        key != 'directory'))
+
+
+def compare(baseline, report, tolerance):
+    """Return descriptions of the measurements in `report` that are worse
+    than the same ones in `baseline` by more than `tolerance`."""
+    regressions = []
+    old_results = {result_key(result): result
+                   for result in baseline['results']}
+    for result in report['results']:
+        old = old_results.get(result_key(result))
+        if old is None:
+            continue
+        for key in ('messages_per_second', 'p50_ms', 'p99_ms'):
+            if key not in result or key not in old:
+                continue
+            if key in HIGHER_IS_BETTER:
+                worse = result[key] < old[key] * (1 - tolerance)
+            else:
+                worse = result[key] > old[key] * (1 + tolerance)
+            if worse:
+                regressions.append(f'{dict(result_key(result))} {key}: '
+                                   f'{old[key]:.3f} -> {result[key]:.3f}')
+    return regressions
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,26 @@
 """User interface to the Seneschal automation system. Everything is a
-subcommand."""
+subcommand.
+
+Users run this from shell loops, so startup time matters. The client only
+needs the "paths" section of the config, which it keeps in a small JSON
+cache under $XDG_CACHE_HOME/seneschal (default ~/.cache/seneschal), keyed by
+the real path, modification time, and size of the config file. PyYAML is
+only imported when the cache is missing or stale, and the daemon's modules
+are never imported; see `seneschal.client`."""
 
 
 import argparse
 import json
+import os
 import sys
+import zlib
+
+from seneschal.client import (FAILED, STATUS, SUCCEEDED, leave_new_request,
+                              leave_new_requests, read_status)
 
-import yaml
 
-from seneschal.messaging import leave_new_request
+CACHE_VERSION = 1  # Change when the format of the cached config changes.
+WATCH_INTERVAL = 5.0  # Longest wait between checks with status --watch
 
 
 emit = lambda *args: None  # Do nothing
@@ -19,8 +31,7 @@ def main():
     args = parse_args()
     if args.verbose:
         emit = err_output
-    config = load_config_file(args.config_file)
-    seneschal_config = config['seneschal']
+    seneschal_config = load_config_file(args.config_file)
     try:
         args.func(seneschal_config, args)
     except BrokenPipeError as e:
@@ -40,10 +51,29 @@ def parse_args():
         'submit',
         help='Submit a request to the Seneschal automation system.'
     )
-    parser_submit.add_argument('workflow', help='what to do')
+    parser_submit.add_argument('workflow', nargs='?', help='what to do')
     parser_submit.add_argument('args', nargs='*', help='workflow-specific')
+    parser_submit.add_argument(
+        '--batch', metavar='FILE',
+        help='submit one request per line of FILE (- for stdin), each a JSON '
+             'object with "workflow" and optional "args"; prints one UUID '
+             'per line, in order'
+    )
+    parser_submit.add_argument('--durable', action='store_true',
+                               help='sync the batch to disk before it is '
+                                    'seen by the daemon')
     parser_submit.set_defaults(func=submit)
 
+    # create the parser for the "status" command
+    parser_status = subparsers.add_parser(
+        'status', help='Show the status of a request.'
+    )
+    parser_status.add_argument('uuid', help='unique ID printed by submit')
+    parser_status.add_argument('--watch', action='store_true',
+                               help='print every change until the request '
+                                    'finishes')
+    parser_status.set_defaults(func=status)
+
     # create the parser for the "ls" command
     parser_ls = subparsers.add_parser('ls', help='List workflows')
     parser_ls.set_defaults(func=ls)
@@ -52,28 +82,137 @@ def parse_args():
 
     if not hasattr(args, 'func'):
         parser.error('missing subcommand (subcommand, ls, etc.)')
+    if args.func is submit and (args.workflow is None) == (args.batch is None):
+        parser.error('submit needs either a workflow or --batch, not both')
 
     return args
 
 
 def load_config_file(config_file):
-    with open(config_file) as fin:
-        config = yaml.load(fin)
-    return config
+    """Return the part of the "seneschal" section of the config that the
+    client uses, from the cache if it is still valid."""
+    real_path = os.path.realpath(config_file)
+    stat = os.stat(real_path)
+    key = [real_path, stat.st_mtime_ns, stat.st_size, CACHE_VERSION]
+    cache_path = config_cache_path(real_path)
+    try:
+        with open(cache_path) as fin:
+            cached = json.load(fin)
+        if cached['key'] == key:
+            return cached['config']
+    except (OSError, ValueError, KeyError):
+        pass  # Missing, unreadable, or stale: parse the config instead.
+    import yaml  # Slow to import, so only on a cache miss
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    with open(real_path) as fin:
+        config = yaml.load(fin, Loader=loader)
+    client_config = dict(paths=config['seneschal']['paths'])
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        temp_path = f'{cache_path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as fout:
+            json.dump(dict(key=key, config=client_config), fout)
+        os.replace(temp_path, cache_path)
+    except OSError as e:
+        emit('not caching config:', e)
+    return client_config
+
+
+def config_cache_path(real_path):
+    """Return the path of the cache file for the config at `real_path`."""
+    cache_home = (os.environ.get('XDG_CACHE_HOME') or
+                  os.path.join(os.path.expanduser('~'), '.cache'))
+    checksum = zlib.crc32(real_path.encode())
+    return os.path.join(cache_home, 'seneschal', f'config-{checksum:08x}.json')
 
 
 def submit(seneschal_config, args):
     """Submit a request to the Seneschal automation system."""
+    directory = seneschal_config['paths']['user_messages']
+    if args.batch is not None:
+        submit_batch(directory, args.batch, args.durable)
+        return
     emit('workflow:', args.workflow)
     for arg in args.args:
         emit(arg)
-    directory = seneschal_config['paths']['user_events']
     uuid_str = leave_new_request(directory, args.workflow, args.args)
     print(uuid_str)
 
 
+def submit_batch(directory, batch_path, durable):
+    """Submit the requests in the JSON-lines file at `batch_path`, or on
+    stdin if it is "-", printing each UUID once its request is in the
+    inbox."""
+    fin = sys.stdin if batch_path == '-' else open(batch_path)
+    try:
+        for uuid_str in leave_new_requests(directory, read_batch(fin),
+                                           durable=durable):
+            print(uuid_str)
+        sys.stdout.flush()
+    finally:
+        if fin is not sys.stdin:
+            fin.close()
+
+
+def read_batch(fin):
+    """Yield (workflow, arg_list) pairs from the JSON lines of `fin`,
+    skipping blank lines. Exits with a message on a malformed line."""
+    for line_number, line in enumerate(fin, 1):
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+            workflow = request['workflow']
+            arg_list = request.get('args', [])
+            if not isinstance(workflow, str) or not isinstance(arg_list,
+                                                                 list):
+                raise TypeError('"workflow" must be a string and "args" a '
+                                'list')
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            fail(f'line {line_number}: bad request: {e!r}')
+        emit('workflow:', workflow, *arg_list)
+        yield workflow, [str(arg) for arg in arg_list]
+
+
+def status(seneschal_config, args):
+    """Print the status snapshot of a request as a JSON line."""
+    outbox = seneschal_config['paths']['outbox']
+    snapshot = read_status(outbox, args.uuid)
+    if args.watch:
+        watch_status(outbox, args.uuid, snapshot)
+    elif snapshot is None:
+        fail(f'no status for {args.uuid}')
+    else:
+        print(json.dumps(snapshot, sort_keys=True))
+
+
+def watch_status(outbox, request_id, snapshot):
+    """Print the status snapshot of a request each time it changes, until
+    the request finishes. Between changes, waits on the status directory
+    with a `DirectoryWatcher`, which wakes on each snapshot written by the
+    local daemon, and otherwise checks every `WATCH_INTERVAL` seconds."""
+    from seneschal.watcher import DirectoryWatcher  # Only needed here
+    status_dir = os.path.join(outbox, STATUS)
+    if not os.path.isdir(status_dir):
+        fail(f'no status directory {status_dir}')
+    watcher = DirectoryWatcher([status_dir], poll_interval=WATCH_INTERVAL)
+    printed = None
+    try:
+        while True:
+            if snapshot is not None and snapshot != printed:
+                print(json.dumps(snapshot, sort_keys=True), flush=True)
+                printed = snapshot
+                if snapshot['state'] in (SUCCEEDED, FAILED):
+                    return
+            watcher.wait()
+            snapshot = read_status(outbox, request_id)
+    finally:
+        watcher.close()
+
+
 def ls(seneschal_config, args):
     """List workflows."""
+    import yaml
     print(args)
     yaml.safe_dump(seneschal_config, sys.stdout, default_flow_style=False)
     pass  # TODO
@@ -84,5 +223,12 @@ def err_output(*args):
     print(*args, file=sys.stderr)
 
 
+def fail(message):
+    """Report `message` on sys.stderr and exit with status 1. Unlike
+    `sys.exit(message)`, this prints before `main` closes sys.stderr."""
+    err_output(message)
+    sys.exit(1)
+
+
 if __name__ == "__main__":
     main()
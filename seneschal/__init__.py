@@ -23,22 +23,28 @@ The lifecycle of a message:
     d. Apply business rules.
     e. Execute and log the action.
     f. Move the message the the finished directory.
-3. Cleanup automation (crontab):
-    a. Creates a new directory named after a time period.
-    b. Moves all messages in the finished directory into the new directory.
-    c. Creates a tarball based on the new directory.
-    d. Verifies the tarball.
-    e. Deletes the new directory and its contents.
+3. Cleanup automation (crontab running "seneschald CONFIG archive"):
+    a. Selects the finished messages older than a minimum age.
+    b. Streams them into a compressed tarball named after a time period.
+    c. Verifies the tarball.
+    d. Indexes the tarball, so that old messages can be looked up.
+    e. Deletes the archived messages.
 
 Some messages simply result in sending a request for human approval. The
 arrival of such an approval, triggers the matching requested action.
 """
 
-from .engine import Engine
-
-
 __author__ = """Walker Hale IV"""
 __email__ = 'walker.hale.iv@gmail.com'
 __version__ = '0.1.0'
 
 __all__ = ['__author__', '__email__', '__version__', 'Engine']
+
+
+def __getattr__(name):
+    """Import `Engine` on first use, so that clients importing only
+    `messaging` do not pay for the daemon's modules."""
+    if name == 'Engine':
+        from .engine import Engine
+        return Engine
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
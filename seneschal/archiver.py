@@ -0,0 +1,334 @@
+"""Archiving of processed messages. `MessageDrop.fetch_message` moves every
+message into `RECEIVED` or `ERROR`, where it would otherwise stay forever,
+slowing every rename and listing in the drop. An `Archiver` moves the older
+ones into compressed tar segments in the `ARCHIVE` directory of the drop:
+
+    4_archive/
+        index.lock
+        index/
+            00.jsonl
+            ...
+            ff.jsonl
+        2_received.20261017T000000Z.0.tar.gz
+        3_error.20261017T000000Z.0.tar.gz
+
+Messages are bucketed by modification time, in buckets of `bucket_seconds`.
+Each run of the archiver writes new segments, numbered after any existing
+segments of the same bucket. Every tar entry is compressed as its own gzip
+member, so that the whole segment is an ordinary tar.gz file, but a single
+message can also be read by seeking to its member. The sidecar index has one
+JSON line per archived message, with its UUID, the directory it came from,
+its segment, and the byte offset of its gzip member, which is what `lookup`
+uses. The index is sharded by the first `INDEX_SHARD_WIDTH` characters of
+the UUID, so that `lookup` reads only one shard, however large the archive
+grows. An "index.jsonl" left by an older version is split into shards by
+the next run.
+
+It is safe to run the archiver while the daemon is live: the daemon never
+touches a message after moving it out of `INBOX`, only messages older than
+`min_age` seconds are archived, a segment is written under a temporary name,
+verified, and renamed into place before its index lines are appended, and
+only then are the source files unlinked. A run that dies part way leaves
+files that the next run recognizes from the index and simply unlinks. An
+exclusive lock on "index.lock" keeps concurrent archivers apart.
+
+Settings are read from the optional "archive" section of the config:
+
+    archive:
+      min_age: 3600
+      bucket_seconds: 86400
+      max_members: 10000
+"""
+
+import fcntl
+import hashlib
+import io
+from json import dumps, loads
+import logging
+import os
+from pathlib import Path
+import tarfile
+import time
+import zlib
+
+from .messaging import RECEIVED, ERROR, make_message_drops, owner_cache
+
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE = '4_archive'
+INDEX = 'index'  # Directory of index shards
+INDEX_LOCK = 'index.lock'
+INDEX_SHARD_WIDTH = 2  # Characters of the UUID per index shard
+LEGACY_INDEX = 'index.jsonl'  # Unsharded index of older versions
+SEGMENT_SUFFIX = '.tar.gz'
+TEMP_SUFFIX = '.tmp'
+ARCHIVED_DIRECTORIES = (RECEIVED, ERROR)
+BLOCK_SIZE = tarfile.BLOCKSIZE
+END_OF_ARCHIVE = b'\0' * (2 * BLOCK_SIZE)
+
+
+class Archiver:
+    """Archives the `RECEIVED` and `ERROR` directories of one message
+    drop."""
+
+    def __init__(self, *, directory, min_age=3600, bucket_seconds=86400,
+                 max_members=10000, **kwds):
+        """Parameters: `directory` is the root of the message drop;
+        `min_age` is the age in seconds before a message may be archived;
+        `bucket_seconds` is the time span of the messages in one segment;
+        `max_members` is the most messages in one segment."""
+        super().__init__(**kwds)
+        self.directory = Path(directory)
+        self.min_age = min_age
+        self.bucket_seconds = bucket_seconds
+        self.max_members = max_members
+
+    @property
+    def archive(self):
+        """Returns `self.directory / ARCHIVE`."""
+        return self.directory / ARCHIVE
+
+    @property
+    def index(self):
+        """Returns the path of the directory of index shards."""
+        return self.archive / INDEX
+
+    def index_shard(self, uuid_str):
+        """Returns the path of the index shard for `uuid_str`."""
+        return self.index / f'{uuid_str[:INDEX_SHARD_WIDTH]}.jsonl'
+
+    def run(self, now=None):
+        """Archive every message old enough, and return a `dict` mapping
+        each archived directory name to the number of messages archived."""
+        now = time.time() if now is None else now
+        self.index.mkdir(parents=True, exist_ok=True)
+        counts = {}
+        with (self.archive / INDEX_LOCK).open('a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            for temp_path in self.archive.glob('*' + TEMP_SUFFIX):
+                temp_path.unlink()  # Left by a run that died
+            self._split_legacy_index()
+            indexed = {}  # Shard path -> names, loaded as needed
+            for subdir in ARCHIVED_DIRECTORIES:
+                counts[subdir] = self._archive_directory(
+                    subdir, now - self.min_age, indexed
+                )
+        return counts
+
+    def indexed_names(self, uuid_str):
+        """Return the set of (directory name, file name) pairs in the
+        index shard for `uuid_str`."""
+        return {(entry['directory'], entry['uuid_str'] + '.json')
+                for entry in self._shard_entries(self.index_shard(uuid_str))}
+
+    def lookup(self, uuid_str):
+        """Return the archived message with the UUID `uuid_str` as a `dict`,
+        or None if it is not in the index. Reads only the index shard of
+        `uuid_str`, and only the gzip member of the message, not the whole
+        segment."""
+        entry = None
+        for path in (self.index_shard(uuid_str), self.archive / LEGACY_INDEX):
+            for candidate in self._shard_entries(path, uuid_str):
+                if candidate['uuid_str'] == uuid_str:
+                    entry = candidate
+        if entry is None:
+            return None
+        data = read_member(self.archive / entry['segment'], entry['offset'])
+        return loads(data)
+
+    @staticmethod
+    def _shard_entries(path, uuid_str=''):
+        """Generator function that yields the entries of the index shard at
+        `path`, if it exists, skipping lines without `uuid_str`."""
+        try:
+            with path.open() as fin:
+                for line in fin:
+                    if uuid_str in line:  # Cheap filter before parsing
+                        yield loads(line)
+        except FileNotFoundError:
+            pass
+
+    def _split_legacy_index(self):
+        """Append the entries of an unsharded index to the shards, then
+        remove it. A split that dies part way is repeated, which only
+        duplicates entries."""
+        legacy_path = self.archive / LEGACY_INDEX
+        if not legacy_path.exists():
+            return
+        self._append_index_entries(
+            list(self._shard_entries(legacy_path)))
+        legacy_path.unlink()
+        logger.info(f'split {legacy_path} into shards')
+
+    def _append_index_entries(self, entries):
+        """Append `entries` to their index shards, and fsync them."""
+        shards = {}
+        for entry in entries:
+            shards.setdefault(self.index_shard(entry['uuid_str']),
+                              []).append(dumps(entry, sort_keys=True) + '\n')
+        for path, lines in shards.items():
+            with path.open('a') as fout:
+                fout.writelines(lines)
+                fout.flush()
+                os.fsync(fout.fileno())
+
+    def _archive_directory(self, subdir, cutoff, indexed):
+        source = self.directory / subdir
+        if not source.is_dir():
+            return 0
+        buckets = {}  # bucket start -> list of (name, stat result)
+        for entry in os.scandir(source):
+            if not entry.name.endswith('.json'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            # Renaming sets st_ctime, so this also covers recent arrivals.
+            if max(stat.st_mtime, stat.st_ctime) > cutoff:
+                continue
+            shard_path = self.index_shard(entry.name)
+            if shard_path not in indexed:
+                indexed[shard_path] = {
+                    (record['directory'], record['uuid_str'] + '.json')
+                    for record in self._shard_entries(shard_path)
+                }
+            if (subdir, entry.name) in indexed[shard_path]:
+                logger.info(f'unlinking {subdir}/{entry.name}, '
+                            f'already archived')
+                os.unlink(entry.path)
+                continue
+            bucket = int(stat.st_mtime // self.bucket_seconds *
+                         self.bucket_seconds)
+            buckets.setdefault(bucket, []).append((entry.name, stat))
+        count = 0
+        for bucket, members in sorted(buckets.items()):
+            members.sort(key=lambda member: member[1].st_mtime_ns)
+            for start in range(0, len(members), self.max_members):
+                count += self._write_segment(
+                    subdir, bucket, members[start:start + self.max_members]
+                )
+        return count
+
+    def _write_segment(self, subdir, bucket, members):
+        source = self.directory / subdir
+        segment_name = self._next_segment_name(subdir, bucket)
+        temp_path = self.archive / (segment_name + TEMP_SUFFIX)
+        entries = []  # (index entry, sha256 digest, source path)
+        with temp_path.open('wb') as fout:
+            for name, stat in members:
+                path = source / name
+                try:
+                    data = path.read_bytes()
+                except FileNotFoundError:
+                    continue
+                entry = dict(uuid_str=path.stem, directory=subdir,
+                             segment=segment_name, offset=fout.tell(),
+                             size=len(data))
+                fout.write(gzip_member(tar_entry(f'{subdir}/{name}', data,
+                                                 stat)))
+                entries.append((entry, hashlib.sha256(data).digest(), path))
+            fout.write(gzip_member(END_OF_ARCHIVE))
+            fout.flush()
+            os.fsync(fout.fileno())
+        if not entries:
+            temp_path.unlink()
+            return 0
+        verify_segment(temp_path, [(entry['offset'], digest)
+                                   for entry, digest, _ in entries])
+        segment_path = self.archive / segment_name
+        temp_path.rename(segment_path)
+        self._append_index_entries([entry for entry, _, _ in entries])
+        for _, _, path in entries:
+            path.unlink()
+        logger.info(f'archived {len(entries)} messages in {segment_name}')
+        return len(entries)
+
+    def _next_segment_name(self, subdir, bucket):
+        stamp = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(bucket))
+        prefix = f'{subdir}.{stamp}.'
+        sequence = 0
+        for path in self.archive.glob(prefix + '*' + SEGMENT_SUFFIX):
+            number = path.name[len(prefix):-len(SEGMENT_SUFFIX)]
+            if number.isdigit():
+                sequence = max(sequence, int(number) + 1)
+        return f'{prefix}{sequence}{SEGMENT_SUFFIX}'
+
+
+def tar_entry(name, data, stat):
+    """Return the bytes of one tar entry: header, data, and padding. The
+    owner of the message file is kept, since it is the sender."""
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(stat.st_mtime)
+    info.mode = stat.st_mode & 0o7777
+    info.uid = stat.st_uid
+    info.gid = stat.st_gid
+    info.uname = owner_cache.user_name(stat.st_uid)
+    padding = -len(data) % BLOCK_SIZE
+    return info.tobuf(tarfile.PAX_FORMAT) + data + b'\0' * padding
+
+
+def gzip_member(data):
+    """Return `data` compressed as one complete gzip member."""
+    compressor = zlib.compressobj(wbits=31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def read_member(segment_path, offset):
+    """Return the data of the tar entry in the gzip member at `offset` in
+    the segment."""
+    decompressor = zlib.decompressobj(wbits=31)
+    chunks = []
+    with Path(segment_path).open('rb') as fin:
+        fin.seek(offset)
+        while not decompressor.eof:
+            chunk = fin.read(65536)
+            if not chunk:
+                raise EOFError(f'truncated member at {offset} in '
+                               f'{segment_path}')
+            chunks.append(decompressor.decompress(chunk))
+    entry_bytes = b''.join(chunks) + END_OF_ARCHIVE
+    with tarfile.open(fileobj=io.BytesIO(entry_bytes)) as tar:
+        member = tar.next()
+        return tar.extractfile(member).read()
+
+
+def verify_segment(segment_path, expected):
+    """Raise `ArchiveVerificationError` unless the segment reads back as a
+    whole tar.gz file and each (offset, sha256 digest) pair in `expected`
+    reads back by offset with the same digest."""
+    try:
+        with tarfile.open(segment_path, 'r:gz') as tar:
+            member_count = sum(1 for _ in tar)
+        if member_count != len(expected):
+            raise ArchiveVerificationError(
+                f'{segment_path.name} has {member_count} members, '
+                f'not {len(expected)}'
+            )
+        for offset, digest in expected:
+            data = read_member(segment_path, offset)
+            if hashlib.sha256(data).digest() != digest:
+                raise ArchiveVerificationError(
+                    f'{segment_path.name} differs at offset {offset}'
+                )
+    except (OSError, EOFError, tarfile.TarError, zlib.error) as e:
+        raise ArchiveVerificationError(f'{segment_path.name}: {e}') from e
+
+
+def archive_message_drops(seneschal_config):
+    """Run an `Archiver` over every message drop named in the config, with
+    the settings of the optional "archive" section. Returns a `dict` mapping
+    each channel to the counts returned by `Archiver.run`."""
+    archive_config = seneschal_config.get('archive', None) or {}
+    return {
+        message_drop.channel: Archiver(directory=message_drop.directory,
+                                       **archive_config).run()
+        for message_drop in make_message_drops(seneschal_config)
+    }
+
+
+class ArchiveVerificationError(RuntimeError):
+    """A segment did not read back as written. Its messages are left in
+    place."""
@@ -0,0 +1,212 @@
+"""The audit trail. Security relevant events are reported by calling `audit`,
+which formats them as key=value lines for the special "audit" logger:
+
+    audit('message_received', channel='REQUEST', user='alice', uuid=...)
+
+gives
+
+    event=message_received channel=REQUEST user=alice uuid=...
+
+The "audit" logger is configured like any other logger in the "logging"
+section of the config. Once the daemon is running, an `AuditPipeline` moves
+the handlers of that logger onto a background writer thread, and leaves a
+handler in their place that only puts records on a bounded queue. The writer
+takes records off the queue in batches, and writes each batch to each file
+handler with one write, one flush, and at most one rotation, so neither
+writing nor rotating the audit log ever happens on the delivery thread.
+
+When the queue is full, the "when_full" policy decides:
+
+* "block" (the default) makes the caller wait for room, so that the audit
+  trail is complete, at the cost of slowing delivery to the speed of the
+  audit log.
+* "drop" discards the record and counts it. The writer then reports the
+  number of dropped records in an "audit_records_dropped" event, so the
+  audit trail says that it has a gap.
+
+Settings are read from the optional "audit" section of the config:
+
+    audit:
+      queue_size: 10000
+      batch_size: 500
+      when_full: block
+
+`AuditPipeline.stop` writes every queued record before returning, and puts
+the original handlers back."""
+
+import logging
+import queue
+import re
+import threading
+
+
+logger = logging.getLogger(__name__)
+audit_logger = logging.getLogger('audit')
+
+BLOCK = 'block'
+DROP = 'drop'
+WHEN_FULL_POLICIES = (BLOCK, DROP)
+SAFE_VALUE = re.compile(r'[^\s"=\\]+')  # Values that need no quoting
+_STOP = object()  # Tells the writer thread to finish
+
+
+def audit(event, **fields):
+    """Log one audit event, with the fields in the order given."""
+    if not audit_logger.isEnabledFor(logging.INFO):
+        return
+    parts = ['event=' + format_value(event)]
+    parts.extend(f'{key}={format_value(value)}'
+                 for key, value in fields.items())
+    audit_logger.info(' '.join(parts))
+
+
+def format_value(value):
+    """Return `value` as it appears on the right of "key=": as is if that is
+    unambiguous, and otherwise double quoted with backslash escapes."""
+    text = str(value)
+    if SAFE_VALUE.fullmatch(text):
+        return text
+    escaped = (text.replace('\\', '\\\\').replace('"', '\\"')
+               .replace('\n', '\\n'))
+    return f'"{escaped}"'
+
+
+class AuditPipeline:
+    """Moves the handlers of the "audit" logger onto a background writer
+    thread fed by a bounded queue. See the module docstring."""
+
+    def __init__(self, *, queue_size=10000, batch_size=500,
+                 when_full=BLOCK, **kwds):
+        super().__init__(**kwds)
+        if when_full not in WHEN_FULL_POLICIES:
+            raise ValueError(f'when_full must be one of {WHEN_FULL_POLICIES}')
+        self.queue = queue.Queue(queue_size)
+        self.batch_size = batch_size
+        self.when_full = when_full
+        # Both counts are guarded by _dropped_lock, since any thread may
+        # drop a record while the writer thread reports.
+        self.dropped = 0  # Records dropped since the last report
+        self.dropped_total = 0
+        self._dropped_lock = threading.Lock()
+        self.handlers = []  # The original handlers, run by the writer
+        self._queue_handler = None
+        self._thread = None
+
+    def start(self):
+        """Install the queueing handler and start the writer thread. Call
+        this after configuring logging and after daemonizing."""
+        assert self._thread is None
+        self.handlers = list(audit_logger.handlers)
+        self._queue_handler = AuditQueueHandler(self)
+        for handler in self.handlers:
+            audit_logger.removeHandler(handler)
+        audit_logger.addHandler(self._queue_handler)
+        self._thread = threading.Thread(target=self._write_batches,
+                                        name='audit-writer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Write every queued record, stop the writer thread, and put the
+        original handlers back on the "audit" logger."""
+        if self._thread is None:
+            return
+        audit_logger.removeHandler(self._queue_handler)
+        self.queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+        for handler in self.handlers:
+            audit_logger.addHandler(handler)
+            handler.flush()
+
+    def enqueue(self, record):
+        """Put a record on the queue, applying the `when_full` policy."""
+        if self.when_full == BLOCK:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+                self.dropped_total += 1
+
+    def _write_batches(self):
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if _STOP in batch:
+                stopping = True
+                batch = [record for record in batch if record is not _STOP]
+            with self._dropped_lock:
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                batch.append(audit_logger.makeRecord(
+                    audit_logger.name, logging.WARNING, __file__, 0,
+                    f'event=audit_records_dropped count={dropped}', (), None
+                ))
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch):
+        for handler in self.handlers:
+            records = [record for record in batch
+                       if record.levelno >= handler.level]
+            try:
+                if isinstance(handler, logging.FileHandler):
+                    write_batch(handler, records)
+                else:
+                    for record in records:
+                        handler.handle(record)
+            except Exception:
+                logger.exception(f'problem writing audit records to '
+                                 f'{handler}')
+
+
+class AuditQueueHandler(logging.Handler):
+    """Stands in for the handlers of the "audit" logger, and only puts
+    records on the queue of an `AuditPipeline`."""
+
+    def __init__(self, pipeline):
+        super().__init__()
+        self.pipeline = pipeline
+
+    def emit(self, record):
+        # Merge any arguments now, as the arguments may change later.
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        self.pipeline.enqueue(record)
+
+
+def write_batch(handler, records):
+    """Write `records` to a `logging.FileHandler` with a single write and
+    flush, rotating first if the handler rotates and the batch calls for
+    it. A size-rotated file may grow past its limit by most of one batch."""
+    # Imported here, since clients that import this module never write.
+    from logging.handlers import BaseRotatingHandler, RotatingFileHandler
+    records = [record for record in records if handler.filter(record)]
+    if not records:
+        return
+    text = ''.join(handler.format(record) + handler.terminator
+                   for record in records)
+    with handler.lock:
+        if handler.stream is None:
+            handler.stream = handler._open()
+        if isinstance(handler, RotatingFileHandler):
+            handler.stream.seek(0, 2)  # Other processes may append too.
+            rollover = (handler.maxBytes > 0 and
+                        handler.stream.tell() + len(text) >= handler.maxBytes)
+        else:
+            rollover = (isinstance(handler, BaseRotatingHandler) and
+                        handler.shouldRollover(records[0]))
+        if rollover:
+            handler.doRollover()
+            if handler.stream is None:
+                handler.stream = handler._open()
+        handler.stream.write(text)
+        handler.stream.flush()
@@ -0,0 +1,177 @@
+"""Support for batch jobs, and in particular for array jobs. When the
+children of a `managers.ParallelTask` are batch jobs that differ only in
+their "arguments", they are submitted as a single array job instead of one
+job per child. The arguments of array task i are line i of an argument file,
+written as JSON lines, next to a table of fixed-width line offsets, so that
+each array task finds its line in O(1). The job wrapper reports start and
+finish events with an "array_index", which the `managers.Job` maps back to
+the path of the corresponding `Task`.
+
+A batch scheduler is any object with a `submit(job_spec)` method that
+returns the scheduler's job ID. The job spec is a `dict` with these keys:
+
+* job_id: the ID of the `managers.Job`, the target of its events
+* argv: the command line shared by all array tasks
+* argument_file: path of the JSON lines file of per-task arguments
+* array_size: the number of array tasks (1 for a plain job)
+* cwd: working directory, or None
+* cores: cores per array task
+
+`PluginScheduler` hands the job spec to the "batch_scheduler" plugin, which
+knows the site's batch system. `LocalScheduler` is a stand-in for tests that
+runs nothing unless asked, and emits the same events as the job wrapper."""
+
+from collections import deque
+from json import dumps, loads
+import logging
+from pathlib import Path
+import subprocess
+
+from .messaging import STARTED, SUCCEEDED, FAILED, leave_message
+
+
+logger = logging.getLogger(__name__)
+
+# Keys of a batch_job Task mapping that may differ between array tasks:
+ARRAY_VARYING_KEYS = frozenset({'arguments', 'index', 'path', 'state'})
+BATCH_SCHEDULER_PLUGIN = 'batch_scheduler'  # Name of the plugin
+# Added to the name of an argument file for its table of line offsets, each
+# OFFSET_WIDTH hexadecimal digits and a newline:
+OFFSETS_SUFFIX = '.offsets'
+OFFSET_WIDTH = 16
+
+
+def coalescable(tasks):
+    """Return True if the `Task`s are all batch jobs with the same parent
+    that differ only in `ARRAY_VARYING_KEYS`, so that they can be submitted
+    as one array job."""
+    if len(tasks) < 2:
+        return False
+    first = tasks[0]
+    signature = array_signature(first)
+    return all(task.__task_type_id__ == 'batch_job' and
+               task._parent is first._parent and
+               array_signature(task) == signature
+               for task in tasks)
+
+
+def array_signature(task):
+    """Return the attributes of a `Task` mapping that must be the same
+    across an array job."""
+    return {key: value for key, value in task.__dict__.items()
+            if key not in ARRAY_VARYING_KEYS}
+
+
+def write_argument_file(path, argument_lists):
+    """Write one JSON line per array task, and the table of the offsets of
+    the lines (see `offsets_path`)."""
+    path = Path(path)
+    offset = 0
+    with path.open('wb') as fout, offsets_path(path).open('wb') as offsets:
+        for arguments in argument_lists:
+            line = (dumps(arguments) + '\n').encode()
+            offsets.write(b'%0*x\n' % (OFFSET_WIDTH, offset))
+            fout.write(line)
+            offset += len(line)
+
+
+def offsets_path(path):
+    """Return the path of the table of line offsets of the argument file
+    at `path`."""
+    path = Path(path)
+    return path.with_name(path.name + OFFSETS_SUFFIX)
+
+
+def read_arguments(path, array_index):
+    """Return the arguments of one array task, as used by the job wrapper.
+    Seeks to the line through the table of offsets, so that every task of
+    a large array job does not scan the whole file; argument files without
+    a table are scanned."""
+    path = Path(path)
+    if array_index < 0:
+        raise IndexError(array_index)
+    try:
+        with offsets_path(path).open('rb') as offsets:
+            offsets.seek(array_index * (OFFSET_WIDTH + 1))
+            entry = offsets.read(OFFSET_WIDTH)
+    except FileNotFoundError:
+        entry = None
+    with path.open('rb') as fin:
+        if entry is not None:
+            if not entry:
+                raise IndexError(array_index)
+            fin.seek(int(entry, 16))
+            return loads(fin.readline())
+        for index, line in enumerate(fin):
+            if index == array_index:
+                return loads(line)
+    raise IndexError(array_index)
+
+
+def array_task_argv(job_spec, array_index):
+    """Return the full command line of one array task."""
+    return (list(job_spec['argv']) +
+            read_arguments(job_spec['argument_file'], array_index))
+
+
+class PluginScheduler:
+    """Submits jobs through a plugin, called with the job spec, which must
+    return an object with the "scheduler_job_id". The plugin is only loaded
+    when the first job is submitted."""
+
+    def __init__(self, plugin_manager, name=BATCH_SCHEDULER_PLUGIN):
+        self.plugin_manager = plugin_manager
+        self.name = name
+
+    def submit(self, job_spec):
+        """Return the scheduler job ID that the plugin reports."""
+        return self.plugin_manager.invoke(self.name,
+                                          job_spec)['scheduler_job_id']
+
+
+class LocalScheduler:
+    """A stand-in batch scheduler for tests. `submit` only records the job
+    spec. `run_pending` then plays the part of the job wrapper, leaving
+    `STARTED` and `SUCCEEDED` or `FAILED` messages for each array task in
+    the job messages drop, and, if asked, actually running the tasks."""
+
+    def __init__(self, job_messages):
+        self.job_messages = Path(job_messages)
+        self.submissions = []  # Job specs, with "scheduler_job_id" added
+        self._pending = deque()  # (job_spec, array_index) pairs
+
+    def submit(self, job_spec):
+        """Record the job spec and return a scheduler job ID."""
+        scheduler_job_id = f'local.{len(self.submissions)}'
+        job_spec = dict(job_spec, scheduler_job_id=scheduler_job_id)
+        self.submissions.append(job_spec)
+        for array_index in range(job_spec['array_size']):
+            self._pending.append((job_spec, array_index))
+        return scheduler_job_id
+
+    def run_pending(self, execute=False, fail=()):
+        """Report every pending array task as started and then finished.
+        If `execute` is True, run each task and report its exit status;
+        otherwise report success, except for array indices in `fail`.
+        Returns the number of array tasks run."""
+        count = 0
+        while self._pending:
+            job_spec, array_index = self._pending.popleft()
+            self._leave(job_spec, STARTED, array_index)
+            if execute:
+                returncode = subprocess.call(
+                    array_task_argv(job_spec, array_index),
+                    cwd=job_spec.get('cwd')
+                )
+                succeeded = returncode == 0
+            else:
+                succeeded = array_index not in fail
+            self._leave(job_spec, SUCCEEDED if succeeded else FAILED,
+                        array_index)
+            count += 1
+        return count
+
+    def _leave(self, job_spec, message_type, array_index):
+        leave_message(self.job_messages, message_type,
+                      target_id=job_spec['job_id'],
+                      array_index=array_index)
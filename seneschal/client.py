@@ -0,0 +1,213 @@
+"""What client software needs to leave messages in a message drop, and
+nothing more, so that commands run from shell loops start quickly. Only
+standard library modules that the interpreter loads anyway, plus `json` and
+`uuid`, are imported here. `messaging` imports everything from this module,
+so daemon code can keep using `messaging.leave_message` and friends."""
+
+from json import JSONEncoder, dump, load
+import os
+from uuid import uuid4
+
+
+# MessageDrop directory names
+TEMP = '0_temp'
+INBOX = '1_inbox'
+RECEIVED = '2_received'
+ERROR = '3_error'
+
+STATUS = 'status'  # Subdirectory of the outbox with request snapshots
+
+HEX_PREFIX = frozenset('0123456789abcdef')  # Digits of related UUIDs
+
+CHUNK_SIZE = 1000  # Messages per durability barrier in leave_messages
+
+_syncfs = None  # The C library's syncfs, or False; see _load_syncfs
+
+# Message types
+NEW = 'NEW'
+STARTED = 'STARTED'
+SUCCEEDED = 'SUCCEEDED'
+FAILED = 'FAILED'
+
+
+def leave_new_request(directory, workflow, arg_list):
+    """On behalf of a user, creates a new Request message file, using
+    `directory` as the root of a message drop. The requested automation is
+    named by `workflow`. This is the only code in this module that client
+    software needs to invoke in order to create a request."""
+    uuid_str = leave_message(directory, NEW,
+                             workflow=workflow, arg_list=arg_list)
+    return uuid_str
+
+
+def leave_message(directory, message_type, target_id=None, **kwds):
+    """Using `directory` as the root of a message drop, write a new JSON file
+    into the `TEMP` directory and then move that file into the `INBOX`
+    directory. The JSON file is an object (dict) that contains the combination
+    of message_type, target_id, kwds, and a UUID, which is also used to name
+    the file. The UUID is generated inside this method by `new_uuid`, so as to
+    insure that the message and file have unique names. Returns the UUID as a
+    str. This function is usually invoked from client software that does not
+    call anything else in this module."""
+    assert 'uuid_str' not in kwds, kwds
+    assert 'channel' not in kwds, kwds
+    uuid_str = new_uuid(target_id)
+    file_name = uuid_str + '.json'
+    initial_path = os.path.join(directory, TEMP, file_name)
+    final_path = os.path.join(directory, INBOX, file_name)
+    message = dict(uuid_str=uuid_str,
+                   message_type=message_type,
+                   target_id=target_id,
+                   **kwds)
+    with open(initial_path, 'w') as fout:
+        dump(message, fout, sort_keys=True)
+    os.rename(initial_path, final_path)
+    return uuid_str
+
+
+def new_uuid(related_id=None):
+    """Return a new random UUID as a str. If `related_id`, the UUID of the
+    worker that a message targets or that a new worker belongs to, is given,
+    the new UUID starts with the same 8 hex digits, so that it falls in the
+    same partition (see `cluster`)."""
+    uuid_str = str(uuid4())
+    prefix = (related_id or '')[:8]
+    if len(prefix) == 8 and HEX_PREFIX.issuperset(prefix):
+        uuid_str = prefix + uuid_str[8:]
+    return uuid_str
+
+
+def read_status(outbox, request_id):
+    """Return the status snapshot of a request, as written by
+    `status.StatusWriter` into the `outbox` directory, or None if there is
+    none (yet)."""
+    try:
+        with open(os.path.join(outbox, STATUS, request_id + '.json')) as fin:
+            return load(fin)
+    except FileNotFoundError:
+        return None
+
+
+def leave_new_requests(directory, requests, **kwds):
+    """Bulk version of `leave_new_request`: creates a new Request message
+    file for each (workflow, arg_list) pair in the iterable `requests`, and
+    yields the UUIDs in the same order. Keyword arguments are passed to
+    `leave_messages`."""
+    return leave_messages(directory,
+                          ((NEW, None, dict(workflow=workflow,
+                                            arg_list=arg_list))
+                           for workflow, arg_list in requests),
+                          **kwds)
+
+
+def leave_messages(directory, messages, *, durable=False,
+                   chunk_size=CHUNK_SIZE):
+    """Bulk version of `leave_message`: for each (message_type, target_id,
+    kwds) triple in the iterable `messages`, writes a new JSON file into the
+    `TEMP` directory and later moves it into the `INBOX` directory. This is a
+    generator that yields the UUIDs in order, each chunk of up to
+    `chunk_size` once its files are in the `INBOX`, so that a long stream of
+    messages is delivered as it goes.
+
+    Both directories are opened once, and files are created and renamed
+    relative to those handles. If `durable` is True, each chunk is written,
+    then the filesystem of `TEMP` is synced once with syncfs, as the barrier
+    that gets the data on disk before any file becomes visible in the
+    `INBOX`, and the renames are followed by an fsync of the `INBOX`. Where
+    syncfs is missing, each file of the chunk is fsynced instead. If writing
+    a chunk fails, or `messages` raises an exception, the files of that
+    chunk are removed from `TEMP` and none of them reach the `INBOX`."""
+    encoder = JSONEncoder(sort_keys=True)
+    flags = os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0)
+    temp_fd = os.open(os.path.join(directory, TEMP), flags)
+    try:
+        inbox_fd = os.open(os.path.join(directory, INBOX), flags)
+        try:
+            chunk = []  # File names written to TEMP, not yet renamed
+            try:
+                for message_type, target_id, kwds in messages:
+                    assert 'uuid_str' not in kwds, kwds
+                    assert 'channel' not in kwds, kwds
+                    uuid_str = new_uuid(target_id)
+                    file_name = uuid_str + '.json'
+                    message = dict(uuid_str=uuid_str,
+                                   message_type=message_type,
+                                   target_id=target_id,
+                                   **kwds)
+                    chunk.append(file_name)
+                    _write_new_file(temp_fd, file_name,
+                                    encoder.encode(message).encode())
+                    if len(chunk) >= chunk_size:
+                        uuids = _publish(temp_fd, inbox_fd, chunk, durable)
+                        chunk = []
+                        yield from uuids
+                if chunk:
+                    uuids = _publish(temp_fd, inbox_fd, chunk, durable)
+                    chunk = []
+                    yield from uuids
+            except BaseException:
+                _discard(temp_fd, chunk)
+                raise
+        finally:
+            os.close(inbox_fd)
+    finally:
+        os.close(temp_fd)
+
+
+def _write_new_file(dir_fd, file_name, data):
+    fd = os.open(file_name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644,
+                 dir_fd=dir_fd)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+
+def _publish(temp_fd, inbox_fd, file_names, durable):
+    if durable:
+        _sync_files(temp_fd, file_names)
+    uuids = []
+    for file_name in file_names:
+        os.rename(file_name, file_name, src_dir_fd=temp_fd,
+                  dst_dir_fd=inbox_fd)
+        uuids.append(file_name[:-len('.json')])
+    if durable:
+        os.fsync(inbox_fd)
+    return uuids
+
+
+def _sync_files(dir_fd, file_names):
+    syncfs = _load_syncfs()
+    if syncfs is not None and syncfs(dir_fd) == 0:
+        return
+    for file_name in file_names:
+        fd = os.open(file_name, os.O_RDONLY, dir_fd=dir_fd)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def _load_syncfs():
+    global _syncfs
+    if _syncfs is None:
+        _syncfs = False
+        try:
+            # Imported here, since only durable writes need it.
+            import ctypes
+            syncfs = ctypes.CDLL(None, use_errno=True).syncfs
+            syncfs.argtypes = [ctypes.c_int]
+            _syncfs = syncfs
+        except (ImportError, OSError, AttributeError):
+            pass
+    return _syncfs or None
+
+
+def _discard(dir_fd, file_names):
+    for file_name in file_names:
+        try:
+            os.unlink(file_name, dir_fd=dir_fd)
+        except FileNotFoundError:
+            pass
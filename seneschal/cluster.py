@@ -0,0 +1,278 @@
+"""Active-active operation of several daemons, each a "node", sharing one
+set of directories on a shared filesystem.
+
+Work is divided into a fixed number of partitions by UUID: a message or
+worker whose UUID starts with the 8 hex digits h belongs to partition
+`int(h, 16) % partitions`. A message that targets a worker gets a UUID
+starting with the same 8 hex digits as the target, and a `Job` or
+`Subprocess` gets an ID starting with those of its `Request` (see
+`client.new_uuid`), so a request and everything it causes stay in one
+partition, and the partition of a message file is known from its name.
+
+Each node holds leases on some partitions, and only handles the messages
+and workers in those. A lease is a file, DIRECTORY/leases/<partition>, that
+names its node and whose modification time the node renews every third of
+`lease_seconds`. Times are compared with the modification time of the
+node's own heartbeat file, DIRECTORY/nodes/<node>, touched just before, so
+only the clock of the file server matters. A lease is taken
+
+* when free, by hard linking a new file to the lease name, which fails if
+  another node got there first, or
+* when expired, by renaming the lease file to a name of the taker's, which
+  only one taker can do. If the lease turns out to have been renewed
+  meanwhile, it is linked back; otherwise the taker removes it and links
+  its own.
+
+A new lease only counts once the next heartbeat finds it still in place.
+Each node aims for an equal share of the partitions among the live nodes
+(those whose heartbeat file is fresher than `lease_seconds`), so a node
+that joins gets its share within a few heartbeats, and the partitions of a
+node that dies move to the survivors once its leases expire. A node that
+misses its renewals for `lease_seconds` gives up all of its leases.
+
+The rest is done by `messaging.MessageBroker.heartbeat` when the partitions
+of a node change. In a message drop, a node claims a message by renaming it
+out of the `INBOX` into its own directory, 1_claimed/<node>/, before
+loading it, so no two nodes deliver the same message file. When a node
+gains a partition, it moves messages of that partition left in any claims
+directory back into the `INBOX`, registers workers that other nodes added,
+and restarts interrupted work. When it loses one, it forgets the loaded
+workers of that partition. A message delivered in memory to a worker of a
+partition owned by another node, which only happens with IDs from before
+clustering, is forwarded through the message drop of its channel.
+
+Configured by the optional "cluster" section of the config:
+
+    cluster:
+      directory: /var/local/lib/seneschal/cluster
+      node: host1  # Defaults to the host name
+      partitions: 64
+      lease_seconds: 30
+
+Every node needs the same number of partitions, which should be several
+times the largest number of nodes. The limits of the "scheduling" section
+are shared among the live nodes (see `scheduling`). A node that stalls
+for longer than `lease_seconds` while delivering a message may deliver it
+again after another node takes over, so `lease_seconds` should be well
+above the longest delivery."""
+
+from json import dumps, loads
+import logging
+import math
+import os
+from pathlib import Path
+import socket
+import time
+import zlib
+
+
+logger = logging.getLogger(__name__)
+
+LEASES = 'leases'
+NODES = 'nodes'
+RENEWALS_PER_LEASE = 3  # Heartbeats per lease_seconds
+
+
+def partition_of(uuid_str, partitions):
+    """Return the partition of a UUID, or of a file name that starts with
+    one. Names that do not start with 8 hex digits are in partition 0."""
+    try:
+        return int(uuid_str[:8], 16) % partitions
+    except ValueError:
+        return 0
+
+
+class Cluster:
+    """The leases of this node. See the module docstring."""
+
+    def __init__(self, *, directory, node=None, partitions=64,
+                 lease_seconds=30.0, **kwds):
+        super().__init__(**kwds)
+        self.directory = Path(directory)
+        self.node = node or socket.gethostname()
+        assert '/' not in self.node and not self.node.startswith('.')
+        assert partitions >= 1, partitions
+        self.partitions = partitions
+        self.lease_seconds = lease_seconds
+        self.owned = set()  # Partitions this node handles
+        self.pending = set()  # Leases taken, confirmed by the next heartbeat
+        self.live_nodes = 1  # Counting this node, as of the last heartbeat
+        self._heartbeat_time = None  # time.monotonic() of last success
+        for name in (LEASES, NODES):
+            (self.directory / name).mkdir(parents=True, exist_ok=True)
+
+    @property
+    def heartbeat_interval(self):
+        """Seconds between heartbeats."""
+        return self.lease_seconds / RENEWALS_PER_LEASE
+
+    def partition(self, uuid_str):
+        """Return the partition of a UUID or a message file name."""
+        return partition_of(uuid_str, self.partitions)
+
+    def owns(self, uuid_str):
+        """Return True if this node handles the UUID or message file
+        name."""
+        return partition_of(uuid_str, self.partitions) in self.owned
+
+    def due(self):
+        """Return True if it is time for a `heartbeat`."""
+        return (self._heartbeat_time is None or
+                time.monotonic() - self._heartbeat_time >=
+                self.heartbeat_interval)
+
+    def heartbeat(self, busy=()):
+        """Renew the leases of this node, release those above its share,
+        except partitions in `busy`, and take free or expired ones up to its
+        share. Returns the sets of partitions (gained, lost)."""
+        start = time.monotonic()
+        before = set(self.owned)
+        if (self._heartbeat_time is not None and
+                start - self._heartbeat_time >= self.lease_seconds):
+            logger.warning(f'{self.node} missed its lease renewals')
+            self.owned.clear()
+            self.pending.clear()
+        try:
+            now = self._touch_node()
+            for partition in sorted(self.owned | self.pending):
+                if self._renew(partition):
+                    self.owned.add(partition)
+                else:
+                    logger.warning(f'{self.node} lost partition {partition}')
+                    self.owned.discard(partition)
+                self.pending.discard(partition)
+            share = self._fair_share(now)
+            extra = len(self.owned) - share
+            for partition in sorted(self.owned - set(busy), reverse=True):
+                if extra <= 0:
+                    break
+                self._release(partition)
+                extra -= 1
+            for partition in self._candidates():
+                if len(self.owned) + len(self.pending) >= share:
+                    break
+                if self._take(partition, now):
+                    self.pending.add(partition)
+        except OSError:
+            logger.exception(f'problem with heartbeat of {self.node}')
+        else:
+            self._heartbeat_time = start
+        gained = self.owned - before
+        lost = before - self.owned
+        if gained or lost:
+            logger.info(f'{self.node} gained partitions {sorted(gained)} and '
+                        f'lost {sorted(lost)}, now has {len(self.owned)}')
+        return gained, lost
+
+    def release_all(self):
+        """Give up every lease, so that other nodes can take over at once,
+        such as when the daemon shuts down."""
+        for partition in sorted(self.owned | self.pending):
+            try:
+                self._release(partition)
+            except OSError:
+                logger.exception(f'problem releasing partition {partition}')
+        self.owned.clear()
+        self.pending.clear()
+
+    def _lease_path(self, partition):
+        return self.directory / LEASES / str(partition)
+
+    def _touch_node(self):
+        """Touch the heartbeat file of this node and return its new
+        modification time, which is the current time of the file server."""
+        path = self.directory / NODES / self.node
+        path.touch()
+        os.utime(path)
+        return path.stat().st_mtime
+
+    def _fair_share(self, now):
+        horizon = now - self.lease_seconds
+        live = 1  # This node
+        with os.scandir(self.directory / NODES) as entries:
+            for entry in entries:
+                if entry.name == self.node:
+                    continue
+                try:
+                    live += entry.stat().st_mtime > horizon
+                except FileNotFoundError:
+                    pass
+        self.live_nodes = live
+        return math.ceil(self.partitions / live)
+
+    def _candidates(self):
+        """Yield the partitions not held, starting at a place that depends
+        on the node, so that nodes do not all contend for the same ones."""
+        offset = zlib.crc32(self.node.encode()) % self.partitions
+        for index in range(self.partitions):
+            partition = (offset + index) % self.partitions
+            if partition not in self.owned and partition not in self.pending:
+                yield partition
+
+    def _holder(self, path):
+        try:
+            return loads(path.read_text())['node']
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError, TypeError):
+            return ''  # Unreadable, so not this node
+
+    def _renew(self, partition):
+        path = self._lease_path(partition)
+        if self._holder(path) != self.node:
+            return False
+        os.utime(path)
+        return True
+
+    def _release(self, partition):
+        path = self._lease_path(partition)
+        self.owned.discard(partition)
+        self.pending.discard(partition)
+        if self._holder(path) == self.node:
+            path.unlink()
+            logger.info(f'{self.node} released partition {partition}')
+
+    def _take(self, partition, now):
+        """Try to take the lease on `partition`. Returns True on success."""
+        path = self._lease_path(partition)
+        if self._link_new_lease(path):
+            return True
+        try:
+            if path.stat().st_mtime > now - self.lease_seconds:
+                return False  # Held
+        except FileNotFoundError:
+            return self._link_new_lease(path)
+        stale_path = path.with_name(f'.{path.name}.{self.node}.stale')
+        try:
+            path.rename(stale_path)
+        except FileNotFoundError:
+            return False  # Another node is taking it.
+        try:
+            if stale_path.stat().st_mtime > now - self.lease_seconds:
+                # Renewed between the stat and the rename: put it back.
+                try:
+                    os.link(stale_path, path)
+                except FileExistsError:
+                    pass
+                return False
+            holder = self._holder(stale_path)
+        finally:
+            stale_path.unlink()
+        logger.warning(f'{self.node} took expired lease on partition '
+                       f'{partition} from {holder}')
+        return self._link_new_lease(path)
+
+    def _link_new_lease(self, path):
+        """Create the lease file at `path` naming this node, unless it
+        exists. Returns True on success."""
+        temp_path = path.with_name(f'.{self.node}.tmp')
+        temp_path.write_text(dumps(dict(node=self.node)))
+        try:
+            os.link(temp_path, path)
+            return True
+        except FileExistsError:
+            # Over NFS, a retried link can fail although the first try
+            # succeeded, which shows in the link count.
+            return temp_path.stat().st_nlink == 2
+        finally:
+            temp_path.unlink()
@@ -5,6 +5,15 @@ modules."""
 
 
 import logging
+import time
+
+from .batch import PluginScheduler
+from .cluster import Cluster
+from .managers import JobManager, RequestManager, SubprocessManager
+from .messaging import MessageBroker, make_message_drops
+from .metrics import MetricsExporter
+from .plugins import PluginManager
+from .watcher import DirectoryWatcher
 
 
 logger = logging.getLogger(__name__)
@@ -14,19 +23,157 @@ class Engine(object):
     """Object responsible for fetching messages and delegating to
     the business rules."""
     running = True  # When False, start shutting down.
+    watcher = None  # See start_watching
+    message_broker = None  # See set_message_broker
+    plugin_manager = None  # See start_plugins
+    metrics_exporter = None  # Set if there is a "metrics" config section
+    delivery = None  # Optional config section
 
     def __init__(self, config):
         self.__dict__.update(config)  # Absorb config
+        metrics_config = config.get('metrics', None)
+        if metrics_config:
+            self.metrics_exporter = MetricsExporter(**metrics_config)
+
+    def start_managers(self):
+        """Construct the managers of requests, jobs, and subprocesses, with
+        their directories from the "paths" section and their keyword
+        arguments from the optional "storage" section of the config, plus
+        the optional "status" section for the status snapshots, and
+        install a `messaging.MessageBroker` over them. Jobs are submitted
+        through the "batch_scheduler" plugin, so call `start_plugins` first.
+        Call this after daemonizing, since the subprocess supervisor runs a
+        thread."""
+        paths = self.paths
+        storage = getattr(self, 'storage', None) or {}
+        request_manager = RequestManager(
+            directory=paths['requests'], outbox=paths.get('outbox'),
+            status_options=getattr(self, 'status', None), **storage
+        )
+        job_manager = JobManager(
+            directory=paths['jobs'],
+            batch_scheduler=PluginScheduler(self.plugin_manager),
+            **storage
+        )
+        subprocess_manager = SubprocessManager(
+            directory=paths['subprocesses'], **storage
+        )
+        self.set_message_broker(MessageBroker(vars(self), request_manager,
+                                              job_manager,
+                                              subprocess_manager))
+
+    def set_message_broker(self, message_broker):
+        """Install the `messaging.MessageBroker` that `sweep` drains. Should
+        only be called once. Messages posted to the broker wake the
+        engine. If the config has a "cluster" section, the broker is put in
+        cluster mode."""
+        assert self.message_broker is None
+        self.message_broker = message_broker
+        message_broker.wakeup = Engine.wake
+        cluster_config = getattr(self, 'cluster', None)
+        if cluster_config:
+            message_broker.set_cluster(Cluster(**cluster_config))
+
+    @staticmethod
+    def wake():
+        """Interrupt any wait in progress. Safe to call from a signal
+        handler or another thread."""
+        if Engine.watcher is not None:
+            Engine.watcher.wake()
+
+    @staticmethod
+    def shutdown():
+        """Set `running` to False and interrupt any wait in progress. Safe to
+        call from a signal handler."""
+        Engine.running = False
+        Engine.wake()
+
+    def resume(self):
+        """Let the managers restart interrupted work. Call this after
+        daemonizing."""
+        if self.message_broker is not None:
+            self.message_broker.resume()
+
+    def close(self):
+        """Stop watching, let the managers shut down, and stop any warm
+        plugin workers."""
+        self.stop_watching()
+        if self.message_broker is not None:
+            self.message_broker.shutdown()
+        if self.plugin_manager is not None:
+            self.plugin_manager.shutdown()
+
+    def start_plugins(self):
+        """Install the `plugins.PluginManager`, configured by the
+        "plugins" path and the optional "plugins" and "plugin_host" sections
+        of the config. Plugins are loaded on first use."""
+        assert self.plugin_manager is None
+        self.plugin_manager = PluginManager(
+            directory=self.paths['plugins'],
+            plugins_config=getattr(self, 'plugins', None),
+            host_options=getattr(self, 'plugin_host', None)
+        )
+
+    def inbox_directories(self):
+        """Return the list of `INBOX` directories of all message drops."""
+        return [message_drop.inbox
+                for message_drop in make_message_drops(vars(self))]
+
+    def start_watching(self):
+        """Install the `watcher.DirectoryWatcher` that `wait_for_messages`
+        uses, configured by the optional "watch" section of the config. Call
+        this after daemonizing, since daemonizing closes open files."""
+        assert Engine.watcher is None
+        watch_config = getattr(self, 'watch', None) or {}
+        Engine.watcher = DirectoryWatcher(self.inbox_directories(),
+                                          **watch_config)
+
+    def stop_watching(self):
+        """Close and remove the watcher, if any."""
+        watcher, Engine.watcher = Engine.watcher, None
+        if watcher is not None:
+            watcher.close()
+
+    def wait_for_messages(self):
+        """Block until a message may have arrived or shutdown has begun.
+        Returns the list of arrived message paths reported by the watcher.
+        Without a watcher, returns an empty list immediately."""
+        if not Engine.running or Engine.watcher is None:
+            return []
+        message_paths = Engine.watcher.wait()
+        if message_paths and self.message_broker is not None:
+            self.message_broker.note_arrivals(message_paths)
+        return message_paths
 
     def sweep(self):
-        """Loop over work queue until it is exhausted, then return."""
+        """Loop over work queue until it is exhausted, then return. Messages
+        are delivered in batches of up to "batch_size" (from the optional
+        "delivery" config section), each limited to "batch_seconds", so that
+        shutdown is noticed between batches. In cluster mode, the leases are
+        renewed between batches when due. Ends with a checkpoint of the
+        managers and an export of metrics, which are forced during shutdown.
+        Returns a `dict` mapping each channel to the number of messages
+        delivered."""
+        totals = {}
+        if self.message_broker is None:
+            logger.debug('no message broker')
+            return totals
+        delivery_config = self.delivery or {}
+        batch_size = delivery_config.get('batch_size', 500)
+        batch_seconds = delivery_config.get('batch_seconds', 1.0)
         while Engine.running:
-            did_work = self.do_one_mesage()
-            if not did_work:
+            self.message_broker.heartbeat()
+            deadline = time.monotonic() + batch_seconds
+            counts = self.message_broker.deliver_up_to(batch_size, deadline)
+            for channel, count in counts.items():
+                totals[channel] = totals.get(channel, 0) + count
+            if not any(counts.values()):
                 logger.debug('no more work')
                 break
-
-    def do_one_mesage(self):
-        """Check for incoming messages, and process the first. Return
-        True if a message was found, False otherwise."""
-        return False  # TODO
+            logger.debug(f'delivered {counts}')
+        self.message_broker.checkpoint(force=not Engine.running)
+        if self.plugin_manager is not None:
+            self.plugin_manager.reap_idle()
+        if self.metrics_exporter is not None:
+            self.metrics_exporter.maybe_export(force=not Engine.running)
+        return totals
@@ -14,19 +14,97 @@ In this example, SOME_ROOT is the directory associated with a manager, 123...
 is the UUID or ID of the worker and 2.json is the most recent state for that
 worker
 
+The same subdirectory contains a symlink, latest.json, that points to the
+most recent state file, so that loading the current state takes a single
+open. Every so often, all but the most recent state files are compacted:
+they are appended to history.jsonl.gz, one JSON line per state, and then
+deleted. That keeps both the load cost and the number of files per worker
+bounded, no matter how many times the worker changes state.
+
+Rewriting the whole state on every change costs a lot for a `Request` with a
+large task tree, where one event usually changes a few fields of one or two
+tasks. So, after a full state file such as 2.json, a manager saves only the
+changes of the next few states, each as one JSON line appended to
+2.deltas.jsonl (see `state_changes`). Loading replays the deltas of the most
+recent full state file, and there are never more of them than the manager's
+`state_snapshot_every`, nor more bytes of them than in the full state file,
+before it writes the next full state file.
+
+With hundreds of thousands of workers, a single "by_uuid" directory is slow
+to list and to search, especially on network filesystems. A manager may
+instead be configured with a `shard_depth`, the number of levels of
+two-character prefixes of the UUID between "by_uuid" and the worker
+subdirectory. With a `shard_depth` of 2, the example above becomes:
+
+    SOME_ROOT/by_uuid/12/30/12300000-0000-0000-0000-000000000000/2.json
+
+Managers find workers in either layout, and `Manager.migrate` moves them
+into the configured layout a batch at a time while the daemon runs, leaving
+a symlink behind in case anything outside the daemon holds the old path.
+The symlinks are removed once they are `migration_link_grace` seconds old.
+
+Each manager also keeps a registry snapshot, SOME_ROOT/registry.json, which
+lists the IDs of all workers. At startup the manager reads the snapshot
+instead of scanning "by_uuid", and workers are only loaded from their
+subdirectories when first accessed.
+
+The `RequestManager` also keeps a small marker file per request in
+flight, SOME_ROOT/in_flight/<UUID>, holding the uid of its user, so that
+the counts of requests in flight per user (see
+`messaging.FairInboxIndex`) are rebuilt at startup without loading every
+request.
+
+In cluster mode (see `cluster`), several daemons share SOME_ROOT, and each
+handles only the workers in its partitions. No daemon then sees all the
+workers, so registry snapshots are not written, and workers are only moved
+between layouts by their owner.
+
 """
 
-from json import dump, load
+from collections import Counter, deque
+from collections.abc import Mapping, MutableMapping, Sequence
+import gzip
+from json import dump, dumps, load, loads
 import logging
+import marshal
+import os
 from pathlib import Path
+import time
 
-from .messaging import NEW, STARTED, SUCCEEDED, FAILED
+from .batch import coalescable, write_argument_file
+from .client import new_uuid
+from .messaging import (NEW, STARTED, SUCCEEDED, FAILED, RESUME, REQUEST,
+                        JOB, SUBPROCESS, TRUSTED_UIDS, Message,
+                        UntrustedMessageError)
+from .metrics import metrics
+from .status import StatusWriter
+from .supervisor import SubprocessSupervisor
 
 
 logger = logging.getLogger(__name__)
 
 UUID_GLOB = '????????-????-????-????-????????????'
-WORKER_GLOB = 'by_uuid/' + UUID_GLOB
+BY_UUID = 'by_uuid'
+WORKER_GLOB = BY_UUID + '/' + UUID_GLOB  # Unsharded layout
+SHARD_WIDTH = 2  # Characters of the UUID per shard level
+MAX_SHARD_DEPTH = 2
+REGISTRY_SNAPSHOT = 'registry.json'
+IN_FLIGHT = 'in_flight'  # Directory of markers of requests in flight
+ROOT_TASK_KEY = 't'  # Key of the root Task in a Request, and its path
+# Fields of a NEW request message, which a user wrote, kept in the Request:
+REQUEST_KEYS = frozenset({'workflow', 'arg_list', 'uuid_str', 'uid',
+                          'user_name'})
+# Keys of a Task mapping that record its own progress while it runs:
+RUNTIME_KEYS = frozenset({'failed', 'next_child', 'reason', 'returncode',
+                          'running', 'state'})
+# Keys of a Task mapping that children never inherit:
+NON_INHERITABLE_KEYS = frozenset({'child_type', 'index', 'path', 'type',
+                                  'zchildren'}) | RUNTIME_KEYS
+LATEST_STATE = 'latest.json'
+STATE_HISTORY = 'history.jsonl.gz'
+DELTAS_SUFFIX = '.deltas.jsonl'  # After the number of the full state file
+STATE_SNAPSHOT_EVERY = 20  # Default most states per full state file
+MARSHAL_VERSION = 2  # The last without references, which vary with refcounts
 
 
 class Manager:
@@ -36,17 +114,333 @@ class Manager:
     a registry of workers by ID, and the ability to send messages to a
     `messaging.MessageBroker`. Subclasses must implement `load`."""
 
-    def __init__(self, *, directory, worker_class, **kwds):
-        """Load state from directory into memory."""
+    def __init__(self, *, directory, worker_class, snapshot_interval=60,
+                 compact_every=100,
+                 state_snapshot_every=STATE_SNAPSHOT_EVERY, shard_depth=0,
+                 migrate_batch=100, migration_link_grace=86400, **kwds):
+        """Load the registry of worker IDs from directory into memory.
+        Workers themselves are loaded lazily. `snapshot_interval` is the
+        minimum number of seconds between registry snapshots written by
+        `checkpoint`. `compact_every` is passed to `save_new_state`.
+        `state_snapshot_every` is the most states saved per full state
+        file; the rest are saved as deltas, and 1 turns deltas off, which
+        also saves the memory of the copies kept for them.
+        `shard_depth` selects the layout of new worker subdirectories, and
+        `migrate_batch` is the most subdirectories that `checkpoint` moves
+        into that layout at a time, or 0 to leave existing ones alone.
+        The symlinks left at the old paths are removed by `checkpoint` once
+        they are `migration_link_grace` seconds old."""
         super().__init__(**kwds)
         self.directory = Path(directory)
         self.worker_class = worker_class
+        self.snapshot_interval = snapshot_interval
+        self.compact_every = compact_every
+        assert state_snapshot_every >= 1, state_snapshot_every
+        self.state_snapshot_every = state_snapshot_every
+        self.saved_states = {}  # ID -> SavedState; see save_worker_state
+        assert 0 <= shard_depth <= MAX_SHARD_DEPTH, shard_depth
+        self.shard_depth = shard_depth
+        self.migrate_batch = migrate_batch
+        self.migration_link_grace = migration_link_grace
         self.message_broker = None  # See set_message_broker
+        self.cluster = None  # See messaging.MessageBroker.set_cluster
         assert self.directory.is_dir()
-        self.registry = dict()  # ID -> worker
-        for subdir in self.directory.glob(WORKER_GLOB):
-            worker_params = self.load(subdir)
-            self.add_worker(worker_params)
+        self.registry = WorkerRegistry(self.load_worker)  # ID -> worker
+        self._snapshot_time = None  # time.monotonic() of last snapshot
+        self._migration_queue = None  # Paths to move; see migrate
+        # (Creation time, path) of the symlinks left by migrate, oldest first
+        self._migration_links = deque()
+        self.load_registry()
+
+    @property
+    def registry_snapshot_path(self):
+        """Returns `self.directory / REGISTRY_SNAPSHOT`."""
+        return self.directory / REGISTRY_SNAPSHOT
+
+    def load_registry(self):
+        """Fill the `registry` with unloaded worker IDs, preferably from the
+        registry snapshot. Falls back to scanning for worker subdirectories
+        if the snapshot is missing, unreadable, or stale. The snapshot is
+        stale if the modification time of "by_uuid" has changed since the
+        snapshot was written, which means that workers were added or removed
+        behind its back."""
+        snapshot = read_registry_snapshot(self.registry_snapshot_path)
+        by_uuid_mtime_ns = self.by_uuid_mtime_ns()
+        fresh = (snapshot is not None and
+                 snapshot['by_uuid_mtime_ns'] == by_uuid_mtime_ns)
+        if fresh:
+            worker_ids = snapshot['ids']
+        else:
+            if snapshot:
+                logger.info(f'stale registry snapshot in {self.directory}')
+            worker_ids = {subdir.name
+                          for depth in range(MAX_SHARD_DEPTH + 1)
+                          for subdir in self.directory.glob(
+                              worker_glob(depth))}
+        for worker_id in worker_ids:
+            self.registry.add_unloaded(worker_id)
+        self.registry.dirty = not fresh
+        logger.debug(f'{len(worker_ids)} workers in {self.directory}')
+
+    def by_uuid_mtime_ns(self):
+        """Return the modification time of the "by_uuid" directory, or None
+        if it does not exist."""
+        try:
+            return os.stat(self.directory / BY_UUID).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def touch_by_uuid(self):
+        """Update the modification time of the "by_uuid" directory. In a
+        sharded layout, adding a worker only changes the modification time
+        of its shard directory, so this keeps registry snapshots honest."""
+        os.utime(self.directory / BY_UUID)
+
+    def checkpoint(self, force=False):
+        """Write a registry snapshot if the registry changed and either
+        `force` is True or at least `snapshot_interval` seconds have passed
+        since the last snapshot, after moving up to `migrate_batch` workers
+        into the configured layout and removing the symlinks they left that
+        are old enough. Returns True if a snapshot was written. In cluster
+        mode, snapshots are never written."""
+        now = time.monotonic()
+        if self.migrate_batch:
+            self.migrate(self.migrate_batch)
+            self.remove_migration_links()
+        if not self.registry.dirty or self.cluster is not None:
+            return False
+        if (not force and self._snapshot_time is not None and
+                now - self._snapshot_time < self.snapshot_interval):
+            return False
+        self.write_registry_snapshot()
+        self._snapshot_time = now
+        return True
+
+    def write_registry_snapshot(self):
+        """Atomically replace the registry snapshot with the current list of
+        worker IDs."""
+        snapshot = dict(by_uuid_mtime_ns=self.by_uuid_mtime_ns(),
+                        ids=sorted(self.registry))
+        temp_path = self.registry_snapshot_path.with_suffix('.tmp')
+        with temp_path.open('w') as fout:
+            dump(snapshot, fout)
+        temp_path.rename(self.registry_snapshot_path)
+        self.registry.dirty = False
+
+    def worker_dir(self, worker_id):
+        """Return the subdirectory that holds the state of a worker. That
+        is the subdirectory in the configured layout, unless only one in
+        another layout exists."""
+        by_uuid = self.directory / BY_UUID
+        subdir = shard_path(by_uuid, worker_id, self.shard_depth)
+        if subdir.is_dir():
+            return subdir
+        for depth in range(MAX_SHARD_DEPTH + 1):
+            if depth != self.shard_depth:
+                other = shard_path(by_uuid, worker_id, depth)
+                if other.is_dir():
+                    return other
+        return subdir
+
+    def make_worker_dir(self, worker_id):
+        """Return the subdirectory of a worker, creating it in the
+        configured layout if it does not exist yet."""
+        subdir = self.worker_dir(worker_id)
+        try:
+            subdir.mkdir(parents=True)
+        except FileExistsError:
+            pass
+        else:
+            if self.shard_depth:
+                self.touch_by_uuid()
+        return subdir
+
+    def save_worker_state(self, worker_id, state):
+        """Persist `state` as the newest state of a worker, creating the
+        worker subdirectory if needed. Returns the new state number.
+
+        Unless deltas are turned off, the manager keeps a copy of the last
+        state saved for each worker in `saved_states`. The changes since
+        then are appended with `save_state_delta`, and a state without
+        changes is not saved at all. A full state file (see
+        `save_new_state`) is written instead for the first save of a worker
+        since it was loaded, and when the deltas since the last full state
+        file have reached `state_snapshot_every - 1` or the size of that
+        file.
+
+        The copies about double the memory held by the workers that are
+        saved while loaded. A copy is dropped when its worker is purged or
+        released, and `state_snapshot_every` of 1 keeps none."""
+        start = time.perf_counter()
+        saved = self.saved_states.get(worker_id)
+        if (saved is None or
+                saved.num - saved.base + 1 >= self.state_snapshot_every or
+                saved.delta_bytes >= saved.full_bytes):
+            kind = 'full'
+            state_number = self.save_full_state(worker_id, state, saved)
+        else:
+            kind = 'delta'
+            state_number = self.save_state_changes(worker_id, state, saved)
+        metrics.observe('worker_save_seconds', time.perf_counter() - start,
+                        manager=type(self).__name__, kind=kind)
+        return state_number
+
+    def save_full_state(self, worker_id, state, saved=None):
+        """Write `state` as a full state file, and start a new `SavedState`
+        for the worker after it, given its current one, `saved`, if any.
+        Returns the new state number."""
+        if saved is None:
+            subdir = self.make_worker_dir(worker_id)
+            previous = None  # Read from the subdirectory
+        else:
+            subdir = saved.subdir
+            previous = saved.num
+        self.saved_states.pop(worker_id, None)
+        text = dumps(state, sort_keys=True)
+        num = save_encoded_state(subdir, text, self.compact_every,
+                                 previous=previous)
+        if self.state_snapshot_every > 1:
+            self.saved_states[worker_id] = SavedState(subdir, num, len(text),
+                                                      copy_state(state))
+        return num
+
+    def save_state_changes(self, worker_id, state, saved):
+        """Append the changes from the state in `saved`, the `SavedState`
+        of the worker, to `state` as a delta, and return the new state
+        number, or the old one if nothing changed."""
+        changes = state_changes(saved.state, state)
+        if not changes:
+            return saved.num
+        num = saved.num + 1
+        try:
+            saved.delta_bytes += save_state_delta(saved.subdir, saved.base,
+                                                  num, changes)
+        except BaseException:
+            # A partial line may be left, so only a full state is safe next.
+            del self.saved_states[worker_id]
+            raise
+        apply_state_changes(saved.state, loads(dumps(changes)))
+        saved.num = num
+        return num
+
+    def migrate(self, limit=None):
+        """Move up to `limit` worker subdirectories (all if None) from
+        other layouts into the configured layout, and return the number
+        moved. Each move is a single rename, so a worker is always complete
+        in exactly one place, and a relative symlink is left at the old path
+        (see `remove_migration_links`). The other layouts are scanned once
+        per manager; after that, this is free."""
+        if self._migration_queue is None:
+            self._migration_queue = deque()
+            links = []
+            for depth in range(MAX_SHARD_DEPTH + 1):
+                if depth == self.shard_depth:
+                    continue
+                for subdir in self.directory.glob(worker_glob(depth)):
+                    if subdir.is_symlink():
+                        links.append((subdir.lstat().st_mtime, subdir))
+                    else:
+                        self._migration_queue.append(subdir)
+            self._migration_links.extend(sorted(links))
+        by_uuid = self.directory / BY_UUID
+        moved = 0
+        while self._migration_queue and (limit is None or moved < limit):
+            old = self._migration_queue.popleft()
+            if self.cluster is not None and not self.cluster.owns(old.name):
+                continue  # Left to its owner
+            new = shard_path(by_uuid, old.name, self.shard_depth)
+            new.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                old.rename(new)
+            except FileNotFoundError:
+                continue
+            old.symlink_to(os.path.relpath(new, old.parent))
+            self._migration_links.append((time.time(), old))
+            moved += 1
+        if moved:
+            logger.info(f'moved {moved} workers into shard depth '
+                        f'{self.shard_depth} in {self.directory}')
+            self.touch_by_uuid()
+            self.registry.dirty = True
+        return moved
+
+    def remove_migration_links(self, now=None):
+        """Remove the symlinks left by `migrate` that are at least
+        `migration_link_grace` seconds old, and return the number
+        removed."""
+        now = time.time() if now is None else now
+        cutoff = now - self.migration_link_grace
+        removed = 0
+        while self._migration_links and self._migration_links[0][0] <= cutoff:
+            _, link = self._migration_links.popleft()
+            try:
+                link.unlink()
+            except FileNotFoundError:
+                continue
+            removed += 1
+        if removed:
+            logger.info(f'removed {removed} migrated worker symlinks in '
+                        f'{self.directory}')
+            self.touch_by_uuid()
+            self.registry.dirty = True
+        return removed
+
+    def resume(self, worker_filter=None):
+        """Hook called once the daemon is running, to restart any work that
+        was interrupted, only for the worker IDs accepted by `worker_filter`
+        if given. Does nothing by default."""
+        pass
+
+    def running_ids(self):
+        """Hook that returns the IDs of the workers with work running in
+        this process. Returns nothing by default."""
+        return ()
+
+    def adopt(self, partitions):
+        """Called in cluster mode when this node gains `partitions`.
+        Registers the workers that other nodes added, then resumes the
+        workers in `partitions`."""
+        self.load_registry()
+        partition = self.cluster.partition
+        self.resume(lambda worker_id: partition(worker_id) in partitions)
+
+    def release(self, partitions):
+        """Called in cluster mode when this node loses `partitions`. Forgets
+        the loaded workers in them, so that they are loaded afresh if they
+        come back."""
+        for worker_id in self.loaded_ids(partitions):
+            self.registry.unload(worker_id)
+            self.saved_states.pop(worker_id, None)
+
+    def loaded_ids(self, partitions):
+        """Return a list of the IDs of the loaded workers in
+        `partitions`."""
+        partition = self.cluster.partition
+        return [worker_id for worker_id in self.registry
+                if self.registry.is_loaded(worker_id) and
+                partition(worker_id) in partitions]
+
+    def shutdown(self):
+        """Hook called when the daemon shuts down. Does nothing by
+        default."""
+        pass
+
+    def purge(self, worker_id):
+        """Remove a finished worker from the `registry`. Its subdirectory
+        is kept."""
+        del self.registry[worker_id]
+        self.saved_states.pop(worker_id, None)
+
+    def load_worker(self, worker_id):
+        """Construct a worker from the state in its subdirectory. Used by
+        the `registry` to load workers on first access. Raises `KeyError` if
+        the subdirectory does not exist."""
+        subdir = self.worker_dir(worker_id)
+        if not subdir.is_dir():
+            raise KeyError(worker_id)
+        worker = self.worker_class(self.load(subdir))
+        assert worker.id == worker_id, (worker.id, worker_id)
+        return worker
 
     def set_message_broker(self, message_broker):
         """Called after construction to install the `messaging.MessageBroker`.
@@ -67,9 +461,87 @@ class Manager:
         return worker.id
 
 
+class WorkerRegistry(MutableMapping):
+    """A mapping of worker ID to worker that loads workers on demand. IDs
+    are added with `add_unloaded`, and the corresponding worker is only
+    constructed, by calling `load_worker` with the ID, when first accessed.
+    Iteration and `len` never load workers. The `dirty` flag is set whenever
+    the set of IDs changes."""
+
+    def __init__(self, load_worker):
+        self._workers = dict()  # ID -> worker, or None if not yet loaded
+        self._load_worker = load_worker
+        self.dirty = False
+
+    def __getitem__(self, worker_id):
+        worker = self._workers[worker_id]
+        if worker is None:
+            try:
+                worker = self._load_worker(worker_id)
+            except KeyError:
+                del self[worker_id]
+                raise
+            self._workers[worker_id] = worker
+        return worker
+
+    def __setitem__(self, worker_id, worker):
+        if worker_id not in self._workers:
+            self.dirty = True
+        self._workers[worker_id] = worker
+
+    def __delitem__(self, worker_id):
+        del self._workers[worker_id]
+        self.dirty = True
+
+    def __iter__(self):
+        return iter(self._workers)
+
+    def __len__(self):
+        return len(self._workers)
+
+    def __contains__(self, worker_id):
+        return worker_id in self._workers
+
+    def add_unloaded(self, worker_id):
+        """Register `worker_id` without loading the worker."""
+        if worker_id not in self._workers:
+            self._workers[worker_id] = None
+            self.dirty = True
+
+    def is_loaded(self, worker_id):
+        """Return True if the worker for `worker_id` is in memory."""
+        return self._workers.get(worker_id) is not None
+
+    def unload(self, worker_id):
+        """Forget the worker for `worker_id`, if loaded, but keep the ID, so
+        that the worker is loaded again on next access."""
+        if worker_id in self._workers:
+            self._workers[worker_id] = None
+
+
+class SavedState:
+    """What a `Manager` remembers about the last state that it saved for a
+    worker: the worker's `subdir`, the number of the last full state file,
+    `base`, the size of that file in bytes, `full_bytes`, the number of the
+    last state saved, `num`, the bytes of deltas since the full state file,
+    `delta_bytes`, and a private copy of the last `state` saved."""
+    __slots__ = ('subdir', 'base', 'full_bytes', 'num', 'delta_bytes',
+                 'state')
+
+    def __init__(self, subdir, base, full_bytes, state):
+        self.subdir = subdir
+        self.base = base
+        self.full_bytes = full_bytes
+        self.num = base
+        self.delta_bytes = 0
+        self.state = state
+
+
 class MessageReceiver(Manager):
     """Abstract base class for Manager that can receive external messages.
-    Subclasses must implement `load`."""
+    Subclasses must implement `load`. Workers must implement
+    `receive_message(message_type, worker_params, message_broker)`. Workers
+    with a true `finished` attribute are purged after being saved."""
 
     def receive_message(self, message):
         """Called by `messaging.MessageReceiver`, returns nothing. If
@@ -79,29 +551,291 @@ class MessageReceiver(Manager):
         should pass the message to that object by method call."""
         worker_params = dict(vars(message))
         # Remove parameters no longer needed.
-        worker_params.pop(channel)
-        worker_params.pop(message_type)
-        worker_params.pop(target_id)
+        worker_params.pop('channel')
+        message_type = worker_params.pop('message_type')
+        worker_params.pop('target_id')
         if message.target_id is None:
-            assert message.message_type is NEW
-            worker = self.add_worker(worker_params)
+            assert message_type == NEW, message_type
+            worker_params = self.new_worker_params(worker_params)
+            worker = self.registry[self.add_worker(worker_params)]
+            self.worker_added(worker)
         else:
             worker = self.registry[message.target_id]
-            worker.receive_message(worker_params)
-        worker.save()
+            worker.receive_message(message_type, worker_params,
+                                   self.message_broker)
+        self.save_worker(worker)
+        if getattr(worker, 'finished', False):
+            self.purge(worker.id)
+
+    def new_worker_params(self, worker_params):
+        """Return the state of a new worker, given the parameters of its
+        `NEW` message. By default, that is all of them, with the "id" set
+        to the "uuid_str" of the message, or if there is none, to a new
+        UUID in the partition of the "request_id", so that a worker started
+        for a request shares its partition."""
+        worker_params['id'] = (worker_params.get('uuid_str') or
+                               new_uuid(worker_params.get('request_id')))
+        return worker_params
+
+    def worker_added(self, worker):
+        """Hook called after `receive_message` creates a new worker, before
+        the worker is saved. Does nothing by default."""
+        pass
+
+    def save_worker(self, worker):
+        """Persist the current state of `worker`."""
+        self.save_worker_state(worker.id, vars(worker))
 
 
 class RequestManager(MessageReceiver):
-    """The Manager for all Request objects."""
+    """The Manager for all Request objects. Given an `outbox` directory, it
+    also keeps a status snapshot of each request there for clients; see
+    `status`."""
 
-    def __init__(self, **kwds):
-        """Load state from directory into memory."""
+    def __init__(self, *, outbox=None, status_interval=1.0,
+                 status_options=None, **kwds):
+        """Load state from directory into memory. `status_interval` is the
+        `min_interval` of the `status.StatusWriter`, and `status_options`
+        are any other keyword arguments for it, such as the "status"
+        section of the config."""
         super().__init__(**kwds, worker_class=Request)
+        self.status_writer = None
+        if outbox is not None:
+            options = dict(min_interval=status_interval)
+            options.update(status_options or {})
+            self.status_writer = StatusWriter(directory=outbox, **options)
+
+    @property
+    def in_flight_dir(self):
+        """Returns `self.directory / IN_FLIGHT`."""
+        return self.directory / IN_FLIGHT
+
+    def receive_message(self, message):
+        """Extends `MessageReceiver.receive_message` to refuse the events
+        for existing requests that come from a user's message file: they
+        may only come from the `JobManager` and `SubprocessManager`, in
+        memory, or from a file of the daemon (see `TRUSTED_UIDS`), such as
+        one forwarded by another node of a cluster."""
+        uid = getattr(message, 'uid', None)
+        if message.target_id is not None and (
+                uid is not None and uid not in TRUSTED_UIDS):
+            raise UntrustedMessageError(
+                f'{message.message_type} for {message.target_id} '
+                f'from uid {uid}'
+            )
+        super().receive_message(message)
+
+    def new_worker_params(self, worker_params):
+        """Overrides `MessageReceiver.new_worker_params`. A new `Request`
+        comes from a file that a user wrote, so it only keeps the fields in
+        `REQUEST_KEYS`, and its "id" is always the "uuid_str", which the
+        message drop checked against the name of the file."""
+        params = {key: worker_params[key] for key in REQUEST_KEYS
+                  if key in worker_params}
+        params['id'] = params['uuid_str']
+        return params
+
+    def worker_added(self, worker):
+        """Extends `MessageReceiver.worker_added` to leave the marker of a
+        new `Request` in flight, holding the uid of its user."""
+        super().worker_added(worker)
+        uid = worker.__dict__.get('uid')
+        self.in_flight_dir.mkdir(exist_ok=True)
+        (self.in_flight_dir / worker.id).write_text(
+            '' if uid is None else str(uid))
+
+    def save_worker(self, worker):
+        """Extends `MessageReceiver.save_worker` to mark the status snapshot
+        of the `Request` for rewriting, and to tell the message broker when
+        the `Request` is done."""
+        super().save_worker(worker)
+        if self.status_writer is not None:
+            self.status_writer.mark(worker)
+        if worker.done:
+            self.request_finished(worker.id)
+
+    def purge(self, worker_id):
+        """Extends `Manager.purge` to stop counting the `Request` in
+        flight."""
+        super().purge(worker_id)
+        self.request_finished(worker_id)
+
+    def request_finished(self, worker_id):
+        """Remove the marker of a `Request` in flight, if any, and tell the
+        message broker."""
+        try:
+            (self.in_flight_dir / worker_id).unlink()
+        except FileNotFoundError:
+            pass
+        if self.message_broker is not None:
+            self.message_broker.request_finished(worker_id)
+
+    def resume(self, worker_filter=None):
+        """Extends `Manager.resume` to tell the message broker about the
+        requests in flight, only for the IDs accepted by `worker_filter` if
+        given, according to their markers. Markers of requests that no
+        longer exist are removed."""
+        super().resume(worker_filter)
+        if self.message_broker is None or not self.in_flight_dir.is_dir():
+            return
+        for entry in os.scandir(self.in_flight_dir):
+            worker_id = entry.name
+            if worker_filter is not None and not worker_filter(worker_id):
+                continue
+            if worker_id not in self.registry:
+                logger.info(f'removing stale in-flight marker {worker_id}')
+                self.request_finished(worker_id)
+                continue
+            try:
+                text = Path(entry.path).read_text()
+            except FileNotFoundError:
+                continue
+            if text.isdigit():
+                self.message_broker.request_started(worker_id, int(text))
+
+    def checkpoint(self, force=False):
+        """Extends `Manager.checkpoint` to write the status snapshots that
+        are due, and to expire old ones."""
+        written = super().checkpoint(force)
+        if self.status_writer is not None:
+            self.status_writer.flush(force)
+            self.status_writer.expire()
+        return written
+
+    def load(self, subdir):
+        """Required by `Manager`. Delegates to `load_most_recent_state`."""
+        return load_most_recent_state(subdir)
+
+    def load_worker(self, worker_id):
+        """Extends `Manager.load_worker` to re-acquire the resources of the
+        tasks that were running when the `Request` was saved. Since workers
+        load lazily, the scheduler undercounts until every `Request` with
+        running tasks has been loaded."""
+        request = super().load_worker(worker_id)
+        if self.message_broker is not None and ROOT_TASK_KEY in vars(request):
+            request.restore(self.message_broker.scheduler)
+        return request
+
+    def release(self, partitions):
+        """Extends `Manager.release` to give back the resources that the
+        forgotten requests hold."""
+        if self.message_broker is not None:
+            for worker_id in self.loaded_ids(partitions):
+                request = self.registry[worker_id]
+                if ROOT_TASK_KEY in vars(request):
+                    request.restore(self.message_broker.scheduler,
+                                    release=True)
+        super().release(partitions)
+
+
+class SubprocessManager(MessageReceiver):
+    """The Manager for all Subprocess objects. The subprocesses run under a
+    `supervisor.SubprocessSupervisor`, which reports each exit back as a
+    `SUBPROCESS` message posted to the message broker. On shutdown,
+    running subprocesses are killed and re-queued, and `resume` restarts
+    them when the daemon starts again."""
+
+    def __init__(self, *, kill_grace=5.0, **kwds):
+        """Load state from directory into memory. `kill_grace` is passed to
+        the supervisor."""
+        super().__init__(**kwds, worker_class=Subprocess)
+        self.supervisor = SubprocessSupervisor(self.post_exit,
+                                               kill_grace=kill_grace)
+
+    def load(self, subdir):
+        """Required by `Manager`. Delegates to `load_most_recent_state`."""
+        return load_most_recent_state(subdir)
+
+    def worker_added(self, worker):
+        """Required by `MessageReceiver`. Starts the new subprocess."""
+        self.spawn(worker)
+
+    def spawn(self, worker):
+        """Start the subprocess of `worker` under the supervisor."""
+        worker.state = STARTED
+        worker.attempts = worker.__dict__.get('attempts', 0) + 1
+        self.supervisor.spawn(worker.id, worker.argv,
+                              cwd=worker.__dict__.get('cwd'),
+                              timeout=worker.__dict__.get('timeout'))
+
+    def post_exit(self, worker_id, returncode, reason):
+        """Called from the supervisor thread when a subprocess exits. Posts
+        a `SUBPROCESS` message for the worker."""
+        succeeded = returncode == 0 and reason is None
+        message = Message(channel=SUBPROCESS,
+                          target_id=worker_id,
+                          message_type=SUCCEEDED if succeeded else FAILED,
+                          returncode=returncode,
+                          reason=reason)
+        self.message_broker.post_message(message)
+
+    def resume(self, worker_filter=None):
+        """Required by `Manager`. Restart the subprocesses that were queued
+        or running when the daemon stopped, and purge finished workers."""
+        for worker_id in list(self.registry):
+            if worker_filter is not None and not worker_filter(worker_id):
+                continue
+            try:
+                worker = self.registry[worker_id]
+            except KeyError:
+                continue  # Vanished
+            if worker.finished:
+                self.purge(worker_id)
+            else:
+                logger.info(f'restarting subprocess {worker_id}')
+                self.spawn(worker)
+                self.save_worker(worker)
+
+    def running_ids(self):
+        """Required by `Manager`. Returns the IDs of the subprocesses that
+        the supervisor is running."""
+        return self.supervisor.keys()
+
+    def shutdown(self):
+        """Required by `Manager`. Kill the running subprocesses and save them
+        as queued, so that `resume` restarts them."""
+        for worker_id in self.supervisor.shutdown():
+            worker = self.registry[worker_id]
+            worker.state = NEW
+            self.save_worker(worker)
+            logger.info(f're-queued subprocess {worker_id}')
+
+
+class JobManager(MessageReceiver):
+    """The Manager for all Job objects. A new `Job` writes its argument file
+    into its own subdirectory and is submitted to `batch_scheduler`, which
+    is anything with the `submit` method described in `batch`. The job
+    wrapper reports events back through the job messages drop."""
+
+    def __init__(self, *, batch_scheduler, **kwds):
+        """Load state from directory into memory."""
+        super().__init__(**kwds, worker_class=Job)
+        self.batch_scheduler = batch_scheduler
 
     def load(self, subdir):
         """Required by `Manager`. Delegates to `load_most_recent_state`."""
         return load_most_recent_state(subdir)
 
+    def worker_added(self, worker):
+        """Required by `MessageReceiver`. Submits the new job."""
+        subdir = self.make_worker_dir(worker.id)
+        argument_file = subdir / 'arguments.jsonl'
+        write_argument_file(argument_file, worker.argument_lists)
+        del worker.argument_lists  # Now in the argument file
+        worker.argument_file = str(argument_file)
+        worker.finished_count = 0
+        worker.scheduler_job_id = self.batch_scheduler.submit(dict(
+            job_id=worker.id,
+            argv=worker.argv,
+            argument_file=worker.argument_file,
+            array_size=len(worker.paths),
+            cwd=worker.__dict__.get('cwd'),
+            cores=worker.__dict__.get('cores', 1),
+        ))
+        worker.state = STARTED
+        logger.info(f'submitted job {worker.id} as {worker.scheduler_job_id} '
+                    f'array_size={len(worker.paths)}')
+
 
 class DictProxy:
     """A class that links its state to an existing dict; a flyweight facade
@@ -113,8 +847,159 @@ class DictProxy:
         return '%s(%r)' % (self.__class__.__name__, self.__dict__)
 
 
+class Subprocess(DictProxy):
+    """A command line run by the `SubprocessManager` on behalf of a `Task`.
+    The state has "argv", optional "cwd" and "timeout", and, when started by
+    a `SubprocessTask`, the "request_id" and task "path" to report back
+    to."""
+
+    @property
+    def finished(self):
+        """True if the subprocess succeeded or failed."""
+        return self.__dict__.get('state') in (SUCCEEDED, FAILED)
+
+    def receive_message(self, message_type, worker_params, message_broker):
+        """Called by `MessageReceiver` with the exit status from the
+        supervisor. Records it and forwards it to the `Request`."""
+        self.state = message_type
+        self.returncode = worker_params.get('returncode')
+        self.reason = worker_params.get('reason')
+        request_id = self.__dict__.get('request_id')
+        if request_id is not None:
+            message_broker.deliver_one_message(
+                Message(channel=REQUEST,
+                        target_id=request_id,
+                        message_type=message_type,
+                        path=self.path,
+                        returncode=self.returncode)
+            )
+
+
+class Job(DictProxy):
+    """A batch job, possibly an array job, submitted by the `JobManager` on
+    behalf of one or more `BatchJobTask`s. The state has the shared "argv",
+    the "paths" of the tasks (the path at index i belongs to array task i),
+    the "request_id" to report back to, and optional "cwd" and "cores"."""
+
+    @property
+    def finished(self):
+        """True once every array task has finished."""
+        return self.__dict__.get('finished_count', 0) >= len(self.paths)
+
+    def receive_message(self, message_type, worker_params, message_broker):
+        """Called by `MessageReceiver` with an event from the job wrapper.
+        Forwards it to the `Request`, addressed to the matching `Task`."""
+        array_index = worker_params.get('array_index', 0)
+        path = self.paths[array_index]
+        if message_type in (SUCCEEDED, FAILED):
+            self.finished_count += 1
+        message_broker.deliver_one_message(
+            Message(channel=REQUEST,
+                    target_id=self.request_id,
+                    message_type=message_type,
+                    path=path)
+        )
+
+
 class Request(DictProxy):
-    pass  # TODO
+    """A user's request to run a workflow. The root `Task` mapping of the
+    workflow is stored under the key `ROOT_TASK_KEY`, which is also the path
+    of the root `Task`."""
+    # Derived, in-memory only structures are kept out of the mapping.
+    __slots__ = ('_path_index', '_root_task')
+
+    def __init__(self, mapping):
+        super().__init__(mapping)
+        self._path_index = None
+        self._root_task = None
+
+    @property
+    def path_index(self):
+        """Returns the `PathIndex` of the task tree, building it on first
+        use. Raises `KeyError` if there is no task tree yet."""
+        root_mapping = self.__dict__[ROOT_TASK_KEY]
+        index = self._path_index
+        if index is None or index.root is not root_mapping:
+            index = self._path_index = PathIndex(root_mapping)
+        return index
+
+    @property
+    def done(self):
+        """True once the root `Task` has succeeded or failed."""
+        root_mapping = self.__dict__.get(ROOT_TASK_KEY)
+        return (root_mapping is not None and
+                leaf_state(root_mapping) in (SUCCEEDED, FAILED))
+
+    @property
+    def root_task(self):
+        """Returns the cached root `Task`. The root `Task` is given the
+        "request_id" and "user_name" of this `Request`, unless it has its
+        own, so that every `Task` of the tree inherits them."""
+        root_mapping = self.__dict__[ROOT_TASK_KEY]
+        task = self._root_task
+        if task is None or task.__dict__ is not root_mapping:
+            root_mapping.setdefault('request_id', self.__dict__.get('id'))
+            user_name = self.__dict__.get('user_name')
+            if user_name is not None:
+                root_mapping.setdefault('user_name', user_name)
+            task = self._root_task = Task.from_dict(root_mapping)
+            task._path_index = self.path_index
+        return task
+
+    def receive_message(self, message_type, worker_params, message_broker):
+        """Called by `MessageReceiver` with an event for the `Task` at
+        "path", such as the exit of its subprocess."""
+        path = worker_params['path']
+        if message_type in (SUCCEEDED, FAILED):
+            self.task_at(path).finish(message_type == SUCCEEDED,
+                                      message_broker)
+        elif message_type == STARTED:
+            self.path_index.set_state(path, STARTED)
+        elif message_type == RESUME:
+            task = self.task_at(path)
+            if task.__dict__.get('state') == STARTED:
+                task.release_queued(message_broker)
+        else:
+            logger.warning(f'unexpected {message_type} for {path}')
+
+    def status(self):
+        """Return a `dict` summarizing the progress of the request in O(1):
+        its "id", overall "state", the number of "leaves" of its task tree,
+        and "leaf_states", the number of leaves in each state. The state is
+        that of the root `Task` once it has finished, otherwise `STARTED`
+        if any leaf has started, and otherwise `NEW`."""
+        counts = {}
+        state = NEW
+        if ROOT_TASK_KEY in self.__dict__:
+            counts = dict(self.path_index.leaf_state_counts)
+            state = leaf_state(self.__dict__[ROOT_TASK_KEY])
+            if state not in (SUCCEEDED, FAILED):
+                state = STARTED if set(counts) - {NEW} else NEW
+        result = dict(id=self.id, state=state, leaves=sum(counts.values()),
+                      leaf_states=counts)
+        if 'workflow' in self.__dict__:
+            result['workflow'] = self.workflow
+        return result
+
+    def restore(self, scheduler, release=False):
+        """Re-acquire scheduler resources for every `ParallelTask` with
+        running children, and put those with queued children back in line,
+        or if `release` is True, give the resources back and leave the
+        line."""
+        for mapping in self.path_index.values():
+            if mapping.get('running') or ParallelTask.has_queued(mapping):
+                self.task_at(mapping['path']).restore(scheduler, release)
+
+    def task_at(self, path):
+        """Return the `Task` at `path`, such as "t/0/1/1", by walking down
+        from the root in O(depth). Unlike `path_index`, which gives the
+        bare mapping, the `Task` can see its inherited attributes."""
+        task = self.root_task
+        root_path, *indices = path.split('/')
+        assert root_path == ROOT_TASK_KEY, path
+        for index in indices:
+            task = task[int(index)]
+        return task
 
 
 class Task(DictProxy):
@@ -123,20 +1008,40 @@ class Task(DictProxy):
     # The static method `register_concrete_subclass` is a class decorator
     # that will populate concrete_subclasses, which enables `from_dict`.
     concrete_subclasses = {}
+    # The parent Task, if known, and the PathIndex of the Request, which is
+    # only set on the root, are kept out of the proxied mapping.
+    __slots__ = ('_parent', '_path_index')
 
-    def __init__(self, mapping):
-        """Validates mapping and delegates construction to superclass."""
+    def __init__(self, mapping, parent=None):
+        """Validates mapping and delegates construction to superclass.
+        `parent` is the enclosing `CompoundTask`, if any."""
         assert 'type' in mapping
         super().__init__(mapping)
+        self._parent = parent
+        self._path_index = None
+
+    def __getattr__(self, name):
+        """Only called for attributes missing from the mapping. Implements
+        chained inheritance (see `propagate_inheritance`) by looking up
+        inheritable attributes in the mappings of the ancestors."""
+        if name.startswith('_') or name in NON_INHERITABLE_KEYS:
+            raise AttributeError(name)
+        ancestor = self._parent
+        while ancestor is not None:
+            mapping = ancestor.__dict__
+            if name in mapping:
+                return mapping[name]
+            ancestor = ancestor._parent
+        raise AttributeError(name)
 
     @staticmethod
-    def from_dict(mapping):
+    def from_dict(mapping, parent=None):
         """Return the appropriate type of `Task` object based on the contents
         of `mapping`."""
         assert isinstance(mapping, dict)
         subclass_selection = mapping['type']
         subclass = Task.concrete_subclasses[subclass_selection]
-        return subclass(mapping)
+        return subclass(mapping, parent)
 
     @staticmethod
     def register_concrete_subclass(cls):
@@ -154,33 +1059,167 @@ class Task(DictProxy):
         `message_broker.deliver_one_message`."""
         raise NotImplementedError
 
+    def set_state(self, state):
+        """Set "state", through the `PathIndex` of the `Request` if the root
+        `Task` has one, so that its leaf counts stay right."""
+        root = self
+        while root._parent is not None:
+            root = root._parent
+        path_index = root._path_index
+        if path_index is not None and self.__dict__.get('path') in path_index:
+            path_index.set_state(self.path, state)
+        else:
+            self.state = state
+
+    def finish(self, succeeded, message_broker):
+        """Record that this `Task` has finished, and tell the parent
+        `CompoundTask`, if any."""
+        self.set_state(SUCCEEDED if succeeded else FAILED)
+        if self._parent is not None:
+            self._parent.child_finished(self.index, succeeded, message_broker)
+
 
 @Task.register_concrete_subclass
 class BatchJobTask(Task):
     """Executes asynchronously in a batch job."""
     __task_type_id__ = 'batch_job'
-    pass  # TODO
+
+    def start(self, message_broker):
+        """Required by `Task`. Asks the `JobManager` for a batch job."""
+        BatchJobTask.start_array([self], message_broker)
+
+    @staticmethod
+    def start_array(tasks, message_broker):
+        """Ask the `JobManager` for one array job that runs all of `tasks`,
+        which must satisfy `batch.coalescable` (unless there is only one).
+        Array task i runs `tasks[i]`."""
+        first = tasks[0]
+        for task in tasks:
+            task.set_state(STARTED)
+        message_broker.deliver_one_message(
+            Message(channel=JOB,
+                    target_id=None,
+                    message_type=NEW,
+                    argv=task_command(first),
+                    argument_lists=[list(getattr(task, 'arguments', ()))
+                                    for task in tasks],
+                    paths=[task.path for task in tasks],
+                    cwd=getattr(first, 'cwd', None),
+                    cores=getattr(first, 'cores', 1),
+                    request_id=getattr(first, 'request_id', None))
+        )
 
 
 @Task.register_concrete_subclass
 class SubprocessTask(Task):
     """Executes asynchronously in a subprocess."""
     __task_type_id__ = 'subprocess'
-    pass  # TODO
+
+    def start(self, message_broker):
+        """Required by `Task`. Asks the `SubprocessManager` to run the
+        command line built by `task_argv`, in "cwd" if given."""
+        self.set_state(STARTED)
+        message_broker.deliver_one_message(
+            Message(channel=SUBPROCESS,
+                    target_id=None,
+                    message_type=NEW,
+                    argv=task_argv(self),
+                    cwd=getattr(self, 'cwd', None),
+                    timeout=getattr(self, 'timeout', None),
+                    request_id=getattr(self, 'request_id', None),
+                    path=self.path)
+        )
+
+
+def task_command(task):
+    """Return the part of the command line of a leaf `Task` that does not
+    depend on its "arguments": its "executable" (if any), followed by its
+    "prefix_arguments"."""
+    command = []
+    executable = getattr(task, 'executable', None)
+    if executable is not None:
+        command.append(executable)
+    command.extend(getattr(task, 'prefix_arguments', ()))
+    return command
+
+
+def task_argv(task):
+    """Return the command line of a leaf `Task`: `task_command` followed by
+    its "arguments"."""
+    return task_command(task) + list(getattr(task, 'arguments', ()))
 
 
 class CompoundTask(Task):
     """A `Task` that implements `children`, which must be a list of `Tasks`."""
     # We store the children under a key named "zchildren" for a serialized
     # state that is easier to read.
+    # The slot keeps the cached ChildView out of the proxied mapping.
+    __slots__ = ('_child_view',)
+
+    def __init__(self, mapping, parent=None):
+        super().__init__(mapping, parent)
+        self._child_view = None
 
     def __getitem__(self, key):
         return self.children[key]
 
+    def child_finished(self, index, succeeded, message_broker):
+        """Abstract method. Invoked by the child at `index` when it
+        finishes."""
+        raise NotImplementedError
+
     @property
     def children(self):
-        """Returns a list of the appropriate `Task` objects."""
-        return [Task.from_dict(child) for child in self.zchildren]
+        """Returns a `ChildView` of the appropriate `Task` objects. The view
+        is cached, and it is replaced if "zchildren" is replaced."""
+        view = self._child_view
+        if view is None or view.mappings is not self.zchildren:
+            view = self._child_view = ChildView(self.zchildren, self)
+        return view
+
+
+class ChildView(Sequence):
+    """A sequence of `Task` objects wrapping the mappings in a "zchildren"
+    list. Each `Task` is created on first access and then reused, so that
+    indexing and iteration do not allocate. Since a `Task` is only a facade,
+    changes to a child mapping are always visible through its `Task`. The
+    view also follows the list: appended mappings get new `Task` objects,
+    and a cached `Task` is replaced if its slot in the list now holds a
+    different mapping or a different type of task. Each `Task` gets
+    `parent` as its parent."""
+    __slots__ = ('mappings', 'parent', '_tasks')
+
+    def __init__(self, mappings, parent=None):
+        self.mappings = mappings
+        self.parent = parent
+        self._tasks = []  # Task or None, parallel to mappings
+
+    def __len__(self):
+        return len(self.mappings)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        mapping = self.mappings[index]  # May raise IndexError
+        if index < 0:
+            index += len(self.mappings)
+        tasks = self._tasks
+        if index >= len(tasks):
+            tasks.extend([None] * (len(self.mappings) - len(tasks)))
+        task = tasks[index]
+        if (task is None or task.__dict__ is not mapping or
+                task.__task_type_id__ != mapping['type']):
+            task = tasks[index] = Task.from_dict(mapping, self.parent)
+        return task
+
+    def __iter__(self):
+        for index in range(len(self.mappings)):
+            yield self[index]
+
+    def append(self, mapping):
+        """Append `mapping` to the underlying list and return its `Task`."""
+        self.mappings.append(mapping)
+        return self[len(self.mappings) - 1]
 
 
 @Task.register_concrete_subclass
@@ -192,23 +1231,405 @@ class SequenceTask(CompoundTask):
 
 @Task.register_concrete_subclass
 class ParallelTask(CompoundTask):
-    """Executes a list of child `Task`s in parallel."""
+    """Executes a list of child `Task`s in parallel, as far as the
+    `scheduling.ResourceScheduler` of the message broker allows. Each child
+    needs its "cores" (default 1) and one process, charged to the
+    inheritable "request_id" and "user_name" attributes. Children start in
+    order, as resources become available. Batch job children that are
+    admitted together and differ only in their arguments are submitted as
+    one array job (see `batch`). The queue state is persisted in
+    the mapping: "next_child" is the index of the first child not yet
+    started, "running" lists the indices of the children in flight, and
+    "failed" counts the children that failed."""
     __task_type_id__ = 'parallel'
-    pass  # TODO
+
+    def start(self, message_broker):
+        """Required by `Task`. Starts as many children as the scheduler
+        admits."""
+        self.set_state(STARTED)
+        self.next_child = 0
+        self.running = []
+        self.failed = 0
+        self.release_queued(message_broker)
+
+    def release_queued(self, message_broker):
+        """Start queued children, in order, until the scheduler refuses one.
+        Finishes this `Task` if there is nothing left to do. Returns the
+        number of children started."""
+        scheduler = message_broker.scheduler
+        children = self.children
+        admitted = []
+        while self.next_child < len(children):
+            child = children[self.next_child]
+            resources = self.child_resources(child)
+            if not scheduler.try_acquire(*resources):
+                scheduler.wait(*resources, self.path)
+                break
+            self.running.append(self.next_child)
+            self.next_child += 1
+            admitted.append(child)
+        if coalescable(admitted):
+            BatchJobTask.start_array(admitted, message_broker)
+        else:
+            for child in admitted:
+                child.start(message_broker)
+        if not self.running and self.next_child >= len(children):
+            self.finish(not self.failed, message_broker)
+        return len(admitted)
+
+    def child_finished(self, index, succeeded, message_broker):
+        """Required by `CompoundTask`. Releases the child's resources and
+        starts more children. If the message broker admits in batches (see
+        `messaging.MessageBroker.admit_in_batches`), the queued children
+        wait in line instead, so that the children freed by a whole
+        delivery pass are admitted, and coalesced, together."""
+        self.running.remove(index)
+        scheduler = message_broker.scheduler
+        scheduler.release(*self.child_resources(self[index]))
+        if not succeeded:
+            self.failed += 1
+        if (getattr(message_broker, 'admit_in_batches', False) and
+                ParallelTask.has_queued(self.__dict__)):
+            scheduler.wait(*self.child_resources(self[self.next_child]),
+                           self.path)
+        else:
+            self.release_queued(message_broker)
+
+    def restore(self, scheduler, release=False):
+        """Re-acquire the resources of the running children and wait for
+        those of the next queued child, such as after the daemon restarts,
+        or if `release` is True, give them back and stop waiting, such as
+        when another node takes over the request."""
+        method = scheduler.release if release else scheduler.acquire
+        for index in self.running:
+            method(*self.child_resources(self[index]))
+        if release:
+            scheduler.forget_waiters(getattr(self, 'request_id', None))
+        elif ParallelTask.has_queued(self.__dict__):
+            scheduler.wait(*self.child_resources(self[self.next_child]),
+                           self.path)
+
+    @staticmethod
+    def has_queued(mapping):
+        """Return True if `mapping` is that of a started `ParallelTask`
+        with children not yet started."""
+        return (mapping.get('type') == ParallelTask.__task_type_id__ and
+                mapping.get('state') == STARTED and
+                mapping.get('next_child', 0) < len(mapping['zchildren']))
+
+    def child_resources(self, child):
+        """Return the arguments for the scheduler: request ID, user name,
+        and cores."""
+        return (getattr(self, 'request_id', None),
+                getattr(self, 'user_name', None),
+                getattr(child, 'cores', 1))
+
+
+def worker_glob(shard_depth):
+    """Return the glob pattern, relative to the directory of a manager, of
+    worker subdirectories in the layout with `shard_depth`."""
+    return BY_UUID + '/' + ('?' * SHARD_WIDTH + '/') * shard_depth + UUID_GLOB
+
+
+def shard_path(by_uuid, worker_id, shard_depth):
+    """Return the path of a worker subdirectory under `by_uuid` in the
+    layout with `shard_depth`."""
+    shards = [worker_id[level * SHARD_WIDTH:(level + 1) * SHARD_WIDTH]
+              for level in range(shard_depth)]
+    return Path(by_uuid).joinpath(*shards, worker_id)
+
+
+def read_registry_snapshot(snapshot_path):
+    """Return the registry snapshot at `snapshot_path` as a `dict`, or None
+    if it is missing or unreadable."""
+    try:
+        with snapshot_path.open() as fin:
+            snapshot = load(fin)
+        assert isinstance(snapshot['ids'], list)
+        assert 'by_uuid_mtime_ns' in snapshot
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.exception(f'bad registry snapshot {snapshot_path}')
+        return None
+    return snapshot
 
 
 def load_most_recent_state(state_files_dir):
-    """Read the highest numbered state file as JSON and return the result."""
+    """Read the most recent full state file as JSON, replay the deltas
+    saved after it, and return the result. Follows the `LATEST_STATE`
+    symlink if there is one, and otherwise searches for the highest
+    numbered state file."""
     assert isinstance(state_files_dir, Path), state_files_dir
     assert state_files_dir.match(UUID_GLOB), state_files_dir
-    state_files = sorted(enumerate_numbered_json_files(state_files_dir))
-    assert state_files, state_files_dir
-    state_file = state_files[-1][1]
-    with state_file.open() as fin:
-        state = load(fin)
+    try:
+        target = os.readlink(state_files_dir / LATEST_STATE)
+        base = int(Path(target).stem)
+        with (state_files_dir / target).open() as fin:
+            state = load(fin)
+    except (OSError, ValueError):
+        # No pointer yet, a dangling one, or not a symlink.
+        state_files = sorted(enumerate_numbered_json_files(state_files_dir))
+        assert state_files, state_files_dir
+        base, state_file = state_files[-1]
+        with state_file.open() as fin:
+            state = load(fin)
+    for record in read_state_deltas(state_files_dir, base):
+        apply_state_changes(state, record['changes'])
+    return state
+
+
+def most_recent_state_number(state_files_dir):
+    """Return the number of the most recent state, counting the deltas
+    after the most recent full state file, or None if there are no state
+    files."""
+    num = most_recent_full_state_number(state_files_dir)
+    if num is not None:
+        for record in read_state_deltas(state_files_dir, num):
+            num = record['num']
+    return num
+
+
+def most_recent_full_state_number(state_files_dir):
+    """Return the number of the most recent full state file, or None if
+    there are none."""
+    try:
+        target = os.readlink(state_files_dir / LATEST_STATE)
+        return int(Path(target).stem)
+    except (OSError, ValueError):
+        pass  # Fall back to searching.
+    numbers = [num for num, _ in
+               enumerate_numbered_json_files(state_files_dir)]
+    return max(numbers, default=None)
+
+
+def save_new_state(state_files_dir, state, compact_every=100, *,
+                   previous=None):
+    """Write `state` as the next numbered state file, atomically repoint
+    `LATEST_STATE` at it, and return its number. Every `compact_every`
+    states (if not 0 or None), counting deltas, calls
+    `compact_state_history`. The number of
+    the most recent state is read from `state_files_dir`, unless the caller
+    knows it and passes it as `previous`."""
+    return save_encoded_state(state_files_dir, dumps(state, sort_keys=True),
+                              compact_every, previous=previous)
+
+
+def save_encoded_state(state_files_dir, text, compact_every=100, *,
+                       previous=None):
+    """Like `save_new_state`, for a state already encoded as JSON
+    `text`."""
+    last_full = most_recent_full_state_number(state_files_dir)
+    if previous is None and last_full is not None:
+        previous = last_full
+        for record in read_state_deltas(state_files_dir, last_full):
+            previous = record['num']
+    num = 0 if previous is None else previous + 1
+    file_name = f'{num}.json'
+    temp_path = state_files_dir / f'{num}.tmp'
+    temp_path.write_text(text)
+    temp_path.rename(state_files_dir / file_name)
+    temp_link = state_files_dir / 'latest.tmp'
+    if os.path.lexists(temp_link):
+        temp_link.unlink()
+    os.symlink(file_name, temp_link)
+    os.replace(temp_link, state_files_dir / LATEST_STATE)
+    if (compact_every and last_full is not None and
+            num // compact_every > last_full // compact_every):
+        compact_state_history(state_files_dir)
+    return num
+
+
+def save_state_delta(state_files_dir, base, num, changes):
+    """Append `changes`, as returned by `state_changes`, as state number
+    `num` to the deltas of the full state file numbered `base`. The line is
+    written with a single append, so a crash can at worst leave the last
+    line incomplete, which `read_state_deltas` ignores. Returns the number
+    of bytes written."""
+    data = (dumps(dict(num=num, changes=changes), sort_keys=True) +
+            '\n').encode()
+    fd = os.open(state_files_dir / f'{base}{DELTAS_SUFFIX}',
+                 os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+    return len(data)
+
+
+def read_state_deltas(state_files_dir, base):
+    """Generator function that yields the records, with "num" and
+    "changes", of the deltas saved after the full state file numbered
+    `base`, in order. Stops at a line that is incomplete or unreadable."""
+    last_num = base
+    try:
+        with (state_files_dir / f'{base}{DELTAS_SUFFIX}').open() as fin:
+            for line in fin:
+                try:
+                    record = loads(line)
+                    num = record['num']
+                    record['changes']
+                except (ValueError, KeyError, TypeError):
+                    logger.warning(f'ignoring bad delta after state {base} '
+                                   f'in {state_files_dir}')
+                    return
+                if num > last_num:  # Skip duplicates, as in the history.
+                    last_num = num
+                    yield record
+    except FileNotFoundError:
+        pass  # No deltas.
+
+
+def state_changes(old, new):
+    """Return a list of the changes that turn the JSON state `old` into
+    `new`, or an empty list if they are equal. Each change is a list of
+    three: the keys that lead from the state to a mapping (strings, and
+    indices into lists), a `dict` of the fields of that mapping that were
+    added or replaced, and a list of the fields that were removed. Mappings
+    with changes are compared field by field, and so are lists of mappings
+    of the same length, so that a change to one `Task` of a large tree only
+    records the fields of that `Task` that changed. Any other value that
+    changed, also only in type, is recorded whole."""
+    changes = []
+    _mapping_changes(old, new, [], changes)
+    return changes
+
+
+def _mapping_changes(old, new, keys, changes):
+    changed = {}
+    for key, value in new.items():
+        try:
+            old_value = old[key]
+        except KeyError:
+            changed[key] = value
+            continue
+        if old_value == value and _same_types(old_value, value):
+            continue
+        if type(old_value) is dict and type(value) is dict:
+            _mapping_changes(old_value, value, keys + [key], changes)
+        elif (type(old_value) is list and type(value) is list and
+                len(old_value) == len(value) and
+                all(type(item) is dict for item in old_value) and
+                all(type(item) is dict for item in value)):
+            for index, item in enumerate(value):
+                old_item = old_value[index]
+                if not (old_item == item and _same_types(old_item, item)):
+                    _mapping_changes(old_item, item,
+                                     keys + [key, index], changes)
+        else:
+            changed[key] = value
+    removed = [key for key in old if key not in new]
+    if changed or removed:
+        changes.append([keys, changed, removed])
+
+
+def _same_types(old, new):
+    """Given JSON values `old` and `new` that are `==`, return True if
+    they also have the same type at every level, which `==` does not check:
+    `False == 0` and `1 == 1.0`, but they encode differently. Containers
+    are compared by their `marshal` encoding, which keeps the types and,
+    for a `dict`, the order of the keys; so a `dict` in another order only
+    costs a needless change."""
+    if type(old) is not type(new):
+        return False
+    if type(new) in (dict, list, tuple):
+        try:
+            return (marshal.dumps(old, MARSHAL_VERSION) ==
+                    marshal.dumps(new, MARSHAL_VERSION))
+        except ValueError:
+            return False  # Subclasses of JSON types
+    return True
+
+
+def copy_state(state):
+    """Return a copy of the JSON `state` that keeps the order of its keys,
+    to compare later states with (see `state_changes`)."""
+    try:
+        return marshal.loads(marshal.dumps(state, MARSHAL_VERSION))
+    except ValueError:
+        return loads(dumps(state))
+
+
+def apply_state_changes(state, changes):
+    """Apply `changes`, as returned by `state_changes`, to `state` in place,
+    and return it. The values in `changes` become part of `state`."""
+    for keys, changed, removed in changes:
+        mapping = state
+        for key in keys:
+            mapping = mapping[key]
+        mapping.update(changed)
+        for key in removed:
+            del mapping[key]
     return state
 
 
+def compact_state_history(state_files_dir, keep=1):
+    """Append all but the `keep` most recent numbered state files, and the
+    deltas after them, to the `STATE_HISTORY` segment, then delete them.
+    Each compaction appends a new gzip member, so the segment is never
+    rewritten. Returns the number of state files compacted."""
+    assert keep >= 1
+    state_files = sorted(enumerate_numbered_json_files(state_files_dir))
+    old_state_files = state_files[:-keep]
+    if not old_state_files:
+        return 0
+    lines = []
+    for num, state_file in old_state_files:
+        state = loads(state_file.read_text())
+        lines.append(dumps(dict(num=num, state=state), sort_keys=True))
+        lines.extend(dumps(record, sort_keys=True)
+                     for record in read_state_deltas(state_files_dir, num))
+    with gzip.open(state_files_dir / STATE_HISTORY, 'at') as fout:
+        fout.write('\n'.join(lines) + '\n')
+    for num, state_file in old_state_files:
+        state_file.unlink()
+        try:
+            (state_files_dir / f'{num}{DELTAS_SUFFIX}').unlink()
+        except FileNotFoundError:
+            pass
+    return len(old_state_files)
+
+
+def iterate_state_history(state_files_dir):
+    """Generator function that yields pairs of num & state for every state
+    of a worker, oldest first, including compacted states and those saved
+    as deltas."""
+    last_num = -1
+    state = None
+    for record in iterate_state_records(state_files_dir):
+        if record['num'] <= last_num:
+            continue  # Skip duplicates from crashes.
+        if 'state' in record:
+            state = record['state']
+        elif state is None:
+            continue  # Deltas without their full state
+        else:
+            # A copy, so that the states yielded earlier stay as they were
+            state = apply_state_changes(loads(dumps(state)),
+                                        record['changes'])
+        last_num = record['num']
+        yield last_num, state
+
+
+def iterate_state_records(state_files_dir):
+    """Generator function that yields the records of every state of a
+    worker, oldest first, as stored: a full state has "num" and "state",
+    and a delta has "num" and "changes"."""
+    try:
+        with gzip.open(state_files_dir / STATE_HISTORY, 'rt') as fin:
+            for line in fin:
+                yield loads(line)
+    except FileNotFoundError:
+        pass  # Nothing compacted yet.
+    for num, state_file in sorted(
+            enumerate_numbered_json_files(state_files_dir)):
+        with state_file.open() as fin:
+            yield dict(num=num, state=load(fin))
+        yield from read_state_deltas(state_files_dir, num)
+
+
 def enumerate_numbered_json_files(directory):
     """Yield pairs of num & json_file_path."""
     for json_file_path in directory.glob('*.json'):
@@ -219,12 +1640,18 @@ def enumerate_numbered_json_files(directory):
             pass  # TODO: log the unusual file
 
 
-def propagate_inheritance(mapping, path='t'):
+def propagate_inheritance(mapping, path='t', *, chained=False):
     """Given a mapping that represents the state of a possibly compound `Task`,
     bestows inheritable attributes to children that have not overridden
     those attributes. Each `Task` will have a path relative to the `Request`
     object. The root `Task` has a path of "t", the zeroth child has a path
-    of "t/0", and the zeroth grandchild has a path of "t/0/0"."""
+    of "t/0", and the zeroth grandchild has a path of "t/0/0".
+
+    If `chained` is True, the inheritable attributes are not copied. The
+    child mappings only hold their overrides (plus "path", "index", and
+    "type"), and `Task` objects resolve everything else through their
+    parents on read. Serialized state then only holds the overrides. Use
+    `expand_inheritance` to get the equivalent copied form."""
     mapping['path'] = path
     if 'zchildren' not in mapping:
         return  # Nothing to do
@@ -234,6 +1661,9 @@ def propagate_inheritance(mapping, path='t'):
     keys.discard('zchildren')
     keys.discard('child_type')  # optional
     keys.remove('type')  # but they can get type from child_type
+    keys -= RUNTIME_KEYS
+    if chained:
+        keys.clear()  # Children will look them up instead.
     # Give the children their inheritances:
     for index, child_mapping in enumerate(mapping['zchildren']):
         child_mapping['index'] = index
@@ -244,7 +1674,43 @@ def propagate_inheritance(mapping, path='t'):
             if key not in child_mapping:
                 child_mapping[key] = mapping[key]
         # Give the child object a chance to initialize state:
-        propagate_inheritance(child_mapping, f'{path}/{index}')
+        propagate_inheritance(child_mapping, f'{path}/{index}',
+                              chained=chained)
+
+
+def expand_inheritance(mapping, inherited=None):
+    """Return a new mapping tree equivalent to `mapping`, in which every
+    child holds copies of all its inherited attributes, like the result of
+    `propagate_inheritance` without `chained`. `inherited` is a `dict` of
+    the attributes inherited by `mapping` itself. Attribute values are
+    shared, not copied. The argument is not modified."""
+    result = dict(inherited or {})
+    result.update(mapping)
+    if 'zchildren' in mapping:
+        inheritance = {key: value for key, value in result.items()
+                       if key not in NON_INHERITABLE_KEYS}
+        result['zchildren'] = [expand_inheritance(child, inheritance)
+                               for child in mapping['zchildren']]
+    return result
+
+
+def compress_inheritance(mapping, inherited=None):
+    """The inverse of `expand_inheritance`: in place, remove every attribute
+    of a child that equals the attribute it would inherit, which converts a
+    copied tree into the form used by chained inheritance. Returns
+    `mapping`."""
+    inherited = inherited or {}
+    for key in list(mapping):
+        if (key not in NON_INHERITABLE_KEYS and key in inherited and
+                mapping[key] == inherited[key]):
+            del mapping[key]
+    if 'zchildren' in mapping:
+        inheritance = dict(inherited)
+        inheritance.update((key, value) for key, value in mapping.items()
+                           if key not in NON_INHERITABLE_KEYS)
+        for child in mapping['zchildren']:
+            compress_inheritance(child, inheritance)
+    return mapping
 
 
 def index_mappings(mapping):
@@ -260,10 +1726,102 @@ def iterate_nested_mappings(mapping):
     """Generator function that top-down iterates all the mapping objects.
     Children are expected to be in a iterable under the key `zchildren`. The
     iterator always yields something, since the first value is always
-    the `mapping` parameter."""
-    yield mapping
-    for child_mapping in mapping.get('zchildren', ()):
-        yield from iterate_nested_mappings(child_mapping)
+    the `mapping` parameter. Uses an explicit stack instead of recursion, so
+    the depth of the tree is not limited by the recursion limit."""
+    stack = [mapping]
+    while stack:
+        mapping = stack.pop()
+        yield mapping
+        stack.extend(reversed(mapping.get('zchildren', ())))
+
+
+class PathIndex(Mapping):
+    """A maintained index of a task tree: a read-only mapping of path to
+    `Task` mapping, built once and then updated incrementally with `add`,
+    `remove`, and `set_state`. Besides O(1) lookup by path, it supports
+    O(subtree) queries by path prefix and keeps O(1) counts of leaves by
+    state. Leaves without a "state" are counted as `NEW`. For the counts to
+    stay right, leaf states must be changed through `set_state`."""
+
+    def __init__(self, root):
+        self.root = root
+        self._mappings = dict()  # path -> mapping
+        self.leaf_state_counts = Counter()
+        self.add(root)
+
+    def __getitem__(self, path):
+        return self._mappings[path]
+
+    def __iter__(self):
+        return iter(self._mappings)
+
+    def __len__(self):
+        return len(self._mappings)
+
+    def add(self, mapping):
+        """Index `mapping` and all its descendants, replacing any mappings
+        previously indexed under the same paths. Every mapping needs a
+        "path", so call `propagate_inheritance` first."""
+        for nested_mapping in iterate_nested_mappings(mapping):
+            path = nested_mapping['path']
+            if path in self._mappings:
+                self._discard(path)
+            self._mappings[path] = nested_mapping
+            if 'zchildren' not in nested_mapping:
+                self.leaf_state_counts[leaf_state(nested_mapping)] += 1
+
+    def remove(self, path):
+        """Remove the mapping at `path` and its descendants from the
+        index."""
+        for nested_mapping in list(self.subtree(path)):
+            self._discard(nested_mapping['path'])
+
+    def _discard(self, path):
+        mapping = self._mappings.pop(path)
+        if 'zchildren' not in mapping:
+            self._uncount(leaf_state(mapping))
+
+    def _uncount(self, state):
+        counts = self.leaf_state_counts
+        counts[state] -= 1
+        if not counts[state]:
+            del counts[state]
+
+    def subtree(self, prefix):
+        """Iterate the mapping at path `prefix` and all its descendants,
+        top-down."""
+        return iterate_nested_mappings(self._mappings[prefix])
+
+    def leaves(self, prefix=ROOT_TASK_KEY, state=None):
+        """Iterate the leaf mappings under path `prefix`, optionally only
+        those whose state is `state`. For example, the running leaves under
+        "t/0" are `leaves('t/0', STARTED)`."""
+        for mapping in self.subtree(prefix):
+            if 'zchildren' not in mapping and (
+                    state is None or leaf_state(mapping) == state):
+                yield mapping
+
+    def set_state(self, path, state):
+        """Set the "state" of the mapping at `path`, keeping the leaf counts
+        up to date. Returns the mapping."""
+        mapping = self._mappings[path]
+        if 'zchildren' not in mapping:
+            self._uncount(leaf_state(mapping))
+            self.leaf_state_counts[state] += 1
+        mapping['state'] = state
+        return mapping
+
+
+def leaf_state(mapping):
+    """Return the "state" of a `Task` mapping, defaulting to `NEW`."""
+    return mapping.get('state', NEW)
+
+
+def parent_path(path):
+    """Return the path of the parent of the `Task` at `path`, or None for
+    the root."""
+    head, sep, _ = path.rpartition('/')
+    return head if sep else None
 
 
 # TODO: Synchonize documentation in messaging.py and tech_specs.md.
@@ -1,47 +1,65 @@
 """JSON file based messaging. User client software makes requests by executing
-`leave_new_request`. The rest of this module supports the automation engine."""
+`leave_new_request`, which lives in `client` with the rest of what clients
+need, and is imported here too. This module supports the automation
+engine."""
 
-from json import dump, load
+from collections import OrderedDict, deque
+import heapq
+from json import loads
 import logging
+import os
 from pathlib import Path
-from uuid import uuid4
+import pwd
+import re
+import stat as stat_module
+import time
 
+from .audit import audit
+from .client import (TEMP, INBOX, RECEIVED, ERROR, NEW, STARTED, SUCCEEDED,
+                     FAILED, leave_message, leave_messages, leave_new_request,
+                     leave_new_requests, new_uuid)
+from .metrics import metrics
+from .scheduling import ResourceScheduler
 
-# TODO: Start auditing messages.
+# Message type, only sent by the daemon, that retries starting the queued
+# children of a ParallelTask after resources were released
+RESUME = 'RESUME'
+MESSAGE_TYPES = frozenset({NEW, STARTED, SUCCEEDED, FAILED, RESUME})
+# Metric label for any other message type, which comes from user JSON
+OTHER = 'other'
 
 # Channels
 REQUEST = 'REQUEST'
 JOB = 'JOB'
 SUBPROCESS = 'SUBPROCESS'
 
-# MessageDrop directory names
-TEMP = '0_temp'
-INBOX = '1_inbox'
-RECEIVED = '2_received'
-ERROR = '3_error'
-
-# Message types
-NEW = 'NEW'
-STARTED = 'STARTED'
-SUCCEEDED = 'SUCCEEDED'
-FAILED = 'FAILED'
-
 # JSON message keys
 ILLEGAL_JSON_KEYS = {'channel', 'uid', 'user_name'}
 REQUIRED_JSON_KEYS = {'message_type', 'target_id', 'uuid_str'}
+# Keys of worker state that users may not set in the user message drop
+RESERVED_JSON_KEYS = {'id', 't', 'path', 'request_id', 'state', 'uid',
+                      'user_name'}
 
+# Default limits on message files; see load_message
+MAX_MESSAGE_BYTES = 1024 * 1024
+MAX_MESSAGE_DEPTH = 32
+MAX_MESSAGE_ELEMENTS = 10000
+# Message types that may arrive in message files; RESUME is only in memory
+FILE_MESSAGE_TYPES = frozenset({NEW, STARTED, SUCCEEDED, FAILED})
+# Message types that users may leave in the user message drop
+USER_MESSAGE_TYPES = frozenset({NEW})
+# Owners of message files that are not treated as a user's; see load_message
+TRUSTED_UIDS = frozenset({os.geteuid()})
+UUID_PATTERN = re.compile(
+    r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+# Strings, which are skipped, and the bytes that open or separate values:
+JSON_STRUCTURE = re.compile(rb'"(?:[^"\\]|\\.)*"|[\[{,]|[\]}]', re.DOTALL)
 
-logger = logging.getLogger(__name__)
+# Parent of the claims directory of each node, in cluster mode
+CLAIMED = '1_claimed'
 
 
-def leave_new_request(directory, workflow, arg_list):
-    """On behalf of a user, creates a new Request message file, using
-    `directory` as the root of a message drop. The requested automation is
-    named by `workflow`. This is the only code in this module that client
-    software needs to invoke in order to create a request."""
-    uuid_str = leave_message(directory, NEW,
-                             workflow=workflow, arg_list=arg_list)
-    return uuid_str
+logger = logging.getLogger(__name__)
 
 
 class Message:
@@ -60,15 +78,34 @@ class Message:
 
 class MessageBroker:
     """Responsible for creating, receiving, and dispatching messages, which
-    are serialized as JSON files."""
+    are serialized as JSON files. Message drops are drained in weighted
+    round-robin order, so that a flood of messages in one drop cannot starve
+    the others. The weights come from the optional "delivery" section of
+    the config, keyed by channel, and default to 1. The broker also carries
+    the `scheduling.ResourceScheduler` shared by all tasks, and in cluster
+    mode, the `cluster.Cluster` (see `set_cluster`)."""
+    cluster = None  # See set_cluster
+    # Tells a ParallelTask to leave its queued children waiting when one
+    # finishes; deliver_up_to wakes them once per pass, so that they are
+    # admitted together.
+    admit_in_batches = True
+
     def __init__(self, seneschal_config,
                  request_manager, job_manager, subprocess_manager):
-        job_messages_path = seneschal_config['paths']['job_messages']
-        user_messages_path = seneschal_config['paths']['user_messages']
-        self.message_drops = (
-            MessageDrop(directory=user_messages_path, channel=REQUEST),
-            MessageDrop(directory=job_messages_path, channel=JOB)
+        self.message_drops = make_message_drops(seneschal_config)
+        self.scheduler = ResourceScheduler.from_config(
+            seneschal_config.get('scheduling', None)
         )
+        delivery_config = seneschal_config.get('delivery', None) or {}
+        weights = delivery_config.get('weights', None) or {}
+        self.weights = tuple(int(weights.get(message_drop.channel, 1))
+                             for message_drop in self.message_drops)
+        assert all(weight >= 1 for weight in self.weights), weights
+        self._cursor = 0  # Index of the message drop to take from next
+        self._credit = self.weights[0]  # Messages left in this turn
+        self.posted_messages = deque()  # See post_message
+        self._delivery_depth = 0  # Nesting of deliver_one_message
+        self.wakeup = None  # Optional callable, see post_message
         self.managers = {
             REQUEST: request_manager,
             JOB: job_manager,
@@ -77,21 +114,268 @@ class MessageBroker:
         for manager in self.managers.values():
             manager.set_message_broker(self)
 
+    def set_cluster(self, cluster):
+        """Switch to cluster mode, where this daemon only handles the
+        partitions leased by `cluster`, a `cluster.Cluster`, and tell the
+        message drops and the managers. Should only be called once, before
+        `resume`."""
+        assert self.cluster is None
+        self.cluster = cluster
+        for message_drop in self.message_drops:
+            message_drop.set_cluster(cluster)
+        for manager in set(self.managers.values()):
+            manager.cluster = cluster
+
+    def heartbeat(self):
+        """In cluster mode, when due, renew and rebalance the leases, and
+        adapt to the partitions gained and lost: forget the loaded workers
+        of lost partitions, and for gained partitions, put messages
+        stranded in claims directories back into the inboxes, register new
+        workers, and restart interrupted work. Stops counting the requests
+        of lost partitions in flight, and shares the scheduler's limits
+        among the live nodes. Returns True if the partitions changed."""
+        if self.cluster is None or not self.cluster.due():
+            return False
+        gained, lost = self.cluster.heartbeat(busy=self.busy_partitions())
+        self.scheduler.set_nodes(self.cluster.live_nodes)
+        if lost:
+            partition = self.cluster.partition
+            for message_drop in self.message_drops:
+                message_drop.inbox_index.forget(
+                    lambda request_id: partition(request_id) in lost)
+            for manager in set(self.managers.values()):
+                manager.release(lost)
+        if gained:
+            for message_drop in self.message_drops:
+                message_drop.requeue_claims(gained)
+            for manager in set(self.managers.values()):
+                manager.adopt(gained)
+        return bool(gained or lost)
+
+    def request_started(self, request_id, uid):
+        """Called by the `managers.RequestManager` for each request in
+        flight when the daemon starts or gains a partition, to let the
+        message drops count it in flight for the user `uid` again."""
+        for message_drop in self.message_drops:
+            message_drop.inbox_index.track(request_id, uid)
+
+    def request_finished(self, request_id):
+        """Called by the `managers.RequestManager` when a request finishes
+        or is purged, and when a new request fails to be created, to let
+        the message drops stop counting it in flight."""
+        for message_drop in self.message_drops:
+            message_drop.inbox_index.finished(request_id)
+
+    def busy_partitions(self):
+        """Return the set of partitions with work running on this node,
+        which the node keeps when rebalancing."""
+        return {self.cluster.partition(worker_id)
+                for manager in set(self.managers.values())
+                for worker_id in manager.running_ids()}
+
     def attempt_to_deliver_one_left_message(self):
         """Check the message drops for messages and if possible, deliver one
         message to the corresponding manager. Returns True if the MessageBroker
         delivered a message."""
-        for message_drop in self.message_drops:
-            message = message_drop.fetch_message()
-            if message:
+        return any(self.deliver_up_to(1).values())
+
+    def deliver_up_to(self, n, deadline=None):
+        """Deliver at most `n` messages, taking any posted messages (see
+        `post_message`) first, and otherwise taking them from the message
+        drops in weighted round-robin order. The tasks waiting for released
+        resources are woken (see `wake_waiters`) at the start, and again
+        once every drop is empty or `time.monotonic()` reaches `deadline`
+        (if not None), after which it stops. The round-robin position
+        carries over between calls. Returns a `dict` mapping each channel
+        to the number of messages delivered from it."""
+        counts = {message_drop.channel: 0
+                  for message_drop in self.message_drops}
+        delivered = 0
+        empty = set()  # Indices of drops found empty during this call
+        self.wake_waiters()
+        while delivered < n:
+            # Posted messages are few and urgent, so they go first.
+            if self.posted_messages:
+                message = self.posted_messages.popleft()
                 self.deliver_one_message(message)
-                return True
-        return False
+                counts[message.channel] = counts.get(message.channel, 0) + 1
+                delivered += 1
+                continue
+            if (len(empty) >= len(self.message_drops) or
+                    deadline is not None and time.monotonic() >= deadline):
+                if self.wake_waiters():
+                    continue
+                break
+            message_drop = self.message_drops[self._cursor]
+            message = None
+            if self._cursor not in empty:
+                message = message_drop.fetch_message()
+            if message is None:
+                empty.add(self._cursor)
+                self._next_turn()
+                continue
+            self.deliver_one_message(message)
+            counts[message_drop.channel] += 1
+            delivered += 1
+            self._credit -= 1
+            if self._credit <= 0:
+                self._next_turn()
+        return counts
+
+    def wake_waiters(self):
+        """Post a `RESUME` message for each task that waits for resources
+        and now fits (see `scheduling.ResourceScheduler.ready_waiters`).
+        Returns the number posted."""
+        ready = self.scheduler.ready_waiters()
+        for request_id, path in ready:
+            self.posted_messages.append(Message(channel=REQUEST,
+                                                target_id=request_id,
+                                                message_type=RESUME,
+                                                path=path))
+        return len(ready)
+
+    def _next_turn(self):
+        """Advance the round-robin cursor to the next message drop."""
+        self._cursor = (self._cursor + 1) % len(self.message_drops)
+        self._credit = self.weights[self._cursor]
+
+    def note_arrivals(self, message_paths):
+        """Pass the paths of newly arrived files to every message drop. See
+        `MessageDrop.note_arrival`."""
+        for message_path in message_paths:
+            for message_drop in self.message_drops:
+                message_drop.note_arrival(message_path)
+
+    def post_message(self, message):
+        """Queue an in-memory `Message`, such as the exit status of a
+        subprocess, for delivery by the next `deliver_up_to`, and call
+        `wakeup` if it is set. Safe to call from any thread."""
+        self.posted_messages.append(message)
+        if self.wakeup is not None:
+            self.wakeup()
+
+    def resume(self):
+        """Tell each manager that the daemon is running. See
+        `managers.Manager.resume`. In cluster mode, partitions are resumed
+        as they are gained, instead; see `heartbeat`."""
+        if self.cluster is not None:
+            return
+        for manager in set(self.managers.values()):
+            manager.resume()
+
+    def shutdown(self):
+        """Tell each manager that the daemon is shutting down. See
+        `managers.Manager.shutdown`. In cluster mode, then give up the
+        leases, so that other nodes take over at once."""
+        for manager in set(self.managers.values()):
+            manager.shutdown()
+        if self.cluster is not None:
+            self.cluster.release_all()
+
+    def checkpoint(self, force=False):
+        """Give each manager a chance to persist periodic state, such as a
+        registry snapshot (see `managers.Manager.checkpoint`), and record
+        the queue depths and requests in flight of each user as gauges."""
+        for manager in set(self.managers.values()):
+            manager.checkpoint(force)
+        for name in ('inbox_queue_depth', 'requests_in_flight'):
+            metrics.clear_gauges(name)
+        for message_drop in self.message_drops:
+            inbox_index = message_drop.inbox_index
+            for user_name, depth in inbox_index.queue_depths().items():
+                metrics.set_gauge('inbox_queue_depth', depth,
+                                  channel=message_drop.channel,
+                                  user=user_name)
+            for user_name, count in inbox_index.in_flight().items():
+                metrics.set_gauge('requests_in_flight', count,
+                                  channel=message_drop.channel,
+                                  user=user_name)
 
     def deliver_one_message(self, message):
-        """Deliver the message to the target manager, based on channel."""
-        manager = self.managers[message.channel]
-        manager.receive_message(message)
+        """Deliver the message to the target manager, based on channel. In
+        cluster mode, a message for a worker in a partition of another node
+        is forwarded instead, if its channel has a message drop. If the
+        manager raises an exception, it is logged and audited, and the
+        message counts as failed, so that one bad message cannot stop the
+        daemon. Returns True if the message was delivered or forwarded.
+        Metrics are only recorded for the outermost delivery, since it
+        includes the deliveries that a manager makes in turn."""
+        start = time.perf_counter()
+        self._delivery_depth += 1
+        try:
+            if (self.cluster is not None and
+                    message.target_id is not None and
+                    not self.cluster.owns(message.target_id)):
+                for message_drop in self.message_drops:
+                    if message_drop.channel == message.channel:
+                        self.forward(message_drop, message)
+                        return True
+            self.managers[message.channel].receive_message(message)
+        except Exception as e:
+            self.delivery_failed(message, e)
+            return False
+        finally:
+            self._delivery_depth -= 1
+        if not self._delivery_depth:
+            labels = dict(channel=message.channel,
+                          message_type=metric_message_type(message))
+            metrics.observe('delivery_seconds', time.perf_counter() - start,
+                            **labels)
+            metrics.inc('messages_delivered_total', **labels)
+        return True
+
+    def delivery_failed(self, message, error):
+        """Log, count, and audit a message that its manager failed to
+        handle. A message from a message drop stays in `RECEIVED`. A new
+        request that failed to be created no longer counts in flight."""
+        uuid_str = getattr(message, 'uuid_str', None)
+        if (message.channel == REQUEST and message.message_type == NEW and
+                message.target_id is None and uuid_str is not None):
+            self.request_finished(uuid_str)
+        logger.exception(f'failed to deliver {message.message_type} '
+                         f'{uuid_str} for {message.target_id}')
+        metrics.inc('messages_failed_total', channel=message.channel)
+        audit('message_failed', channel=message.channel, uuid=uuid_str,
+              message_type=message.message_type,
+              target_id=message.target_id, reason=error)
+
+    def forward(self, message_drop, message):
+        """Leave `message` in `message_drop`, for the node that owns its
+        target. The owner of the new file is this daemon."""
+        kwds = {key: value for key, value in vars(message).items()
+                if key not in ILLEGAL_JSON_KEYS | REQUIRED_JSON_KEYS}
+        uuid_str = message_drop.leave_message(message.message_type,
+                                              message.target_id, **kwds)
+        logger.info(f'forwarded {message.message_type} for '
+                    f'{message.target_id} as {uuid_str}')
+        metrics.inc('messages_forwarded_total', channel=message.channel)
+
+
+def metric_message_type(message):
+    """Return the message type of `message` as a metric label: one of
+    `MESSAGE_TYPES`, or `OTHER`, so that user JSON cannot add labels."""
+    message_type = message.message_type
+    if isinstance(message_type, str) and message_type in MESSAGE_TYPES:
+        return message_type
+    return OTHER
+
+
+def make_message_drops(seneschal_config):
+    """Return a tuple of the `MessageDrop` objects named in the `paths`
+    section of `seneschal_config`, in delivery priority order."""
+    job_messages_path = seneschal_config['paths']['job_messages']
+    user_messages_path = seneschal_config['paths']['user_messages']
+    delivery_config = seneschal_config.get('delivery', None) or {}
+    rescan_interval = delivery_config.get('rescan_interval', 1.0)
+    fair_queueing = seneschal_config.get('fair_queueing', None) or {}
+    limits = seneschal_config.get('message_limits', None) or {}
+    return (
+        MessageDrop(directory=user_messages_path, channel=REQUEST,
+                    rescan_interval=rescan_interval,
+                    fair_queueing=fair_queueing, limits=limits),
+        MessageDrop(directory=job_messages_path, channel=JOB,
+                    rescan_interval=rescan_interval, limits=limits)
+    )
 
 
 class MessageDrop(object):
@@ -101,12 +385,29 @@ class MessageDrop(object):
     file to the `INBOX` directory. Messages left here should not contain uid,
     user_name, or channel. When messages are read back into memory, they are
     augmented with these values. The user is the owner of the file."""
-    def __init__(self, *, directory, channel, **kwds):
+    def __init__(self, *, directory, channel, rescan_interval=1.0,
+                 fair_queueing=None, limits=None, **kwds):
         """Parameters: `directory` must contain `TEMP`, `INBOX`, and
-        `RECEIVED`; `channel` is only used when fetching messages."""
+        `RECEIVED`; `channel` is only used when fetching messages;
+        `rescan_interval` is passed to the `InboxIndex`. If `fair_queueing`
+        is not None, it holds the keyword arguments of a `FairInboxIndex`,
+        which is used instead, to take messages fairly between users.
+        `limits` holds keyword arguments for `load_message`, such as
+        "max_bytes"."""
         super().__init__(**kwds)
         self.directory = Path(directory)
         self.channel = channel
+        self.limits = limits or {}
+        if fair_queueing is None:
+            self.inbox_index = InboxIndex(self.inbox,
+                                          rescan_interval=rescan_interval)
+        else:
+            self.inbox_index = FairInboxIndex(self.inbox,
+                                              rescan_interval=rescan_interval,
+                                              **fair_queueing)
+        self.cluster = None  # See set_cluster
+        self.claims = None  # Claims directory of this node, in cluster mode
+        self.trusted_uids = TRUSTED_UIDS  # Passed to load_message
 
     @property
     def inbox(self):
@@ -135,56 +436,404 @@ class MessageDrop(object):
         # TODO: Consider that we may want to create a UUID based on a previous
         # UUID, such as events for an existing job or request, using a
         # UUID5 algorith taking the existing UUID as the namespace.
-        leave_message(self.directory, message_type, target_id, **kwds)
+        return leave_message(self.directory, message_type, target_id, **kwds)
+
+    def set_cluster(self, cluster):
+        """Switch to cluster mode: only fetch messages in the partitions of
+        `cluster`, a `cluster.Cluster`, and claim each one by moving it into
+        the claims directory of this node before loading it."""
+        self.cluster = cluster
+        self.claims = self.directory / CLAIMED / cluster.node
+        self.claims.mkdir(parents=True, exist_ok=True)
+        self.inbox_index.accept = cluster.owns
+
+    def requeue_claims(self, partitions):
+        """Move the claimed messages in `partitions` from the claims
+        directories of every node, including this one, back into the
+        `INBOX`, such as after a node died while holding them. Renaming
+        keeps the modification times, so they keep their places in line.
+        Returns the number moved."""
+        moved = 0
+        for claims in (self.directory / CLAIMED).iterdir():
+            with os.scandir(claims) as entries:
+                for entry in entries:
+                    name = entry.name
+                    if (not name.endswith('.json') or
+                            self.cluster.partition(name) not in partitions):
+                        continue
+                    try:
+                        os.rename(entry.path, self.inbox / name)
+                    except FileNotFoundError:
+                        continue
+                    logger.info(f'requeued {name} claimed by {claims.name}')
+                    moved += 1
+        self.inbox_index.invalidate()
+        return moved
+
+    def note_arrival(self, message_path):
+        """Tell the `inbox_index` about a file that arrived in the `INBOX`
+        directory, such as one reported by a `watcher.DirectoryWatcher`.
+        Ignores paths in other directories."""
+        message_path = Path(message_path)
+        if message_path.parent == self.inbox:
+            self.inbox_index.add(message_path.name)
 
     def fetch_message(self):
-        """Return the next message or `None`. Locates the oldest JSON file in
-        the `INBOX` directory, loads it, moves it into the `RECEIVED`
-        directory, and returns the resulting `Message` object."""
-        # All messages, oldest first:
-        message_paths = sorted(self.inbox.glob('*.json'),
-                               key=lambda x: x.stat().st_mtime)
+        """Return the next message or `None`. Locates the next JSON file in
+        the `INBOX` directory (the oldest, unless the `inbox_index` is fair
+        between users), loads it, moves it into the `RECEIVED`
+        directory, and returns the resulting `Message` object. In cluster
+        mode, the file is first claimed by moving it into `claims`, so that
+        another node that tries the same file finds it gone."""
         message = None
         # If there are messages, keep processing until we find a good one:
-        for message_path in message_paths:
+        while message is None:
+            message_path = self.inbox_index.pop()  # Oldest first
+            if message_path is None:
+                break
             name = message_path.name
             try:
-                message = load_message(message_path, self.channel)
+                if self.claims is not None:
+                    message_path = message_path.rename(self.claims / name)
+                message = load_message(message_path, self.channel,
+                                       trusted_uids=self.trusted_uids,
+                                       **self.limits)
+                message_path.rename(self.received / name)
+            except FileNotFoundError:
+                logger.debug(f'{name} vanished from inbox')
+                message = None
             except ValueError as e:
-                logger.exception(f'problem loading {name}')
-                message_path.rename(self.error / name)
+                # No traceback, which would be costly for a flood of bad files
+                logger.warning(f'rejected {name}: {e}')
+                try:
+                    message_path.rename(self.error / name)
+                except FileNotFoundError:
+                    logger.debug(f'{name} vanished before moving to error')
+                metrics.inc('messages_rejected_total', channel=self.channel)
+                audit('message_rejected', channel=self.channel, file=name,
+                      reason=e)
+                message = None
             else:
-                message_path.rename(self.received / name)
+                self.inbox_index.started(message)
                 logger.info(f'received {name}')
-                break
+                audit('message_received', channel=self.channel,
+                      uuid=message.uuid_str, user=message.user_name,
+                      message_type=message.message_type,
+                      target_id=message.target_id)
         return message
 
 
-def load_message(message_path, channel):
+class InboxIndex:
+    """Persistent oldest-first index of the JSON files in an `INBOX`
+    directory. Files are kept in a min-heap keyed by modification time, so
+    that taking the oldest costs O(log N). The index learns about new files
+    from `add` (for example, when a watcher reports an arrival) and from
+    delta scans, which stat only names that the index has not seen yet. A
+    delta scan happens whenever the heap is empty, and otherwise at most
+    every `rescan_interval` seconds, to catch files that nobody reported.
+    Files that disappear are dropped when they reach the top of the heap and
+    fail to load. If `accept` is set, only names for which it returns True
+    are indexed and popped. Subclasses may change the order by overriding
+    `_push` and `_pop_name`."""
+
+    def __init__(self, directory, *, rescan_interval=1.0, accept=None):
+        self.directory = Path(directory)
+        self.rescan_interval = rescan_interval
+        self.accept = accept
+        self._heap = []  # (st_mtime_ns, name) pairs
+        self._names = set()  # Every name indexed
+        self._last_scan = None  # time.monotonic() of the last scan
+
+    def __len__(self):
+        return len(self._names)
+
+    def add(self, name, stat=None):
+        """Add the file `name` unless it is already indexed or is not a JSON
+        file. Stats the file if `stat`, an `os.stat_result`, is not given.
+        Returns True if the file was added."""
+        if name in self._names or not name.endswith('.json'):
+            return False
+        if self.accept is not None and not self.accept(name):
+            return False
+        if stat is None:
+            try:
+                stat = os.stat(self.directory / name)
+            except FileNotFoundError:
+                return False
+        self._push(name, stat)
+        self._names.add(name)
+        return True
+
+    def scan(self):
+        """Delta scan of the directory: index every JSON file that is not
+        already indexed. Returns the number of files added."""
+        self._last_scan = time.monotonic()
+        added = 0
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                name = entry.name
+                if name in self._names or not name.endswith('.json'):
+                    continue
+                if self.accept is not None and not self.accept(name):
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                added += self.add(name, stat)
+        return added
+
+    def invalidate(self):
+        """Make the next `pop` scan, such as after `accept` changed."""
+        self._last_scan = None
+
+    def pop(self):
+        """Remove and return the `Path` of the next indexed file, or `None`
+        if there is none. The file may have vanished since it was indexed,
+        so callers must handle `FileNotFoundError`. Scans first if the index
+        is empty or the last scan is older than `rescan_interval`. Files no
+        longer accepted are dropped."""
+        if (not self._names or self._last_scan is None or
+                time.monotonic() - self._last_scan >= self.rescan_interval):
+            self.scan()
+        while True:
+            name = self._pop_name()
+            if name is None:
+                return None
+            self._names.discard(name)
+            if self.accept is None or self.accept(name):
+                return self.directory / name
+
+    def started(self, message):
+        """Called with each `Message` loaded from a popped file. Does
+        nothing by default."""
+        pass
+
+    def track(self, request_id, uid):
+        """Called with each request in flight when the daemon starts or
+        gains a partition. Does nothing by default."""
+        pass
+
+    def finished(self, request_id):
+        """Called when the request `request_id` finishes. Does nothing by
+        default."""
+        pass
+
+    def forget(self, predicate):
+        """Called to stop counting the requests whose IDs satisfy
+        `predicate`, such as those of partitions lost to another node. Does
+        nothing by default."""
+        pass
+
+    def queue_depths(self):
+        """Return a `dict` of the number of indexed files by user name,
+        which is empty by default."""
+        return {}
+
+    def in_flight(self):
+        """Return a `dict` of the number of requests in flight by user
+        name, which is empty by default."""
+        return {}
+
+    def _push(self, name, stat):
+        """Index the file `name`, given its `os.stat_result`."""
+        heapq.heappush(self._heap, (stat.st_mtime_ns, name))
+
+    def _pop_name(self):
+        """Remove and return the name of the next file, or None."""
+        if not self._heap:
+            return None
+        return heapq.heappop(self._heap)[1]
+
+
+class FairInboxIndex(InboxIndex):
+    """An `InboxIndex` that takes files in weighted fair order between the
+    users who own them, and oldest first for each user, so that one user
+    with a large backlog cannot make everyone else wait behind it.
+
+    Scheduling is start-time fair queueing: each user with files has a
+    virtual start tag, the user with the smallest tag is picked, the virtual
+    time moves up to that tag, and the user's tag then grows by one over the
+    user's weight. A user who comes back after a pause starts at the current
+    virtual time, so idle time is not saved up. Users are kept in a heap by
+    tag, and each user's files in a heap by modification time, so a pick
+    costs O(log users + log files of that user).
+
+    Weights and in-flight caps are looked up by user name, with defaults for
+    users not listed. A new request counts as in flight from when its
+    message is loaded (see `started`) until `finished` is called with its
+    ID, and a user at the cap is not picked. When the daemon starts, or
+    gains a partition, the requests still in flight are counted again (see
+    `track`), and the requests of a lost partition are forgotten (see
+    `forget`).
+
+    The `managers.RequestManager` calls `finished` once the task tree of a
+    request finishes, or the request is purged. A cap therefore needs
+    requests that run to completion, and is a lifetime quota otherwise, so
+    there are no caps by default."""
+
+    def __init__(self, directory, *, weights=None, default_weight=1,
+                 max_in_flight=None, default_max_in_flight=None, **kwds):
+        super().__init__(directory, **kwds)
+        self.weights = weights or {}
+        self.default_weight = default_weight
+        self.max_in_flight = max_in_flight or {}
+        self.default_max_in_flight = default_max_in_flight
+        self._queues = {}  # uid -> heap of (st_mtime_ns, name)
+        self._tags = {}  # uid -> virtual start tag of the next file
+        self._active = []  # Heap of (tag, uid); stale if not in _tags
+        self._active_uids = set()  # Users that may be picked
+        self._virtual_time = 0.0
+        self._in_flight = {}  # uid -> number of requests in flight
+        self._request_uids = {}  # request ID -> uid, while in flight
+
+    def queue_depths(self):
+        """Return a `dict` of the number of indexed files by user name."""
+        depths = {}
+        for uid, queue in self._queues.items():
+            user_name = owner_cache.user_name(uid)
+            depths[user_name] = depths.get(user_name, 0) + len(queue)
+        return depths
+
+    def in_flight(self):
+        """Return a `dict` of the number of requests in flight by user
+        name."""
+        counts = {}
+        for uid, count in self._in_flight.items():
+            user_name = owner_cache.user_name(uid)
+            counts[user_name] = counts.get(user_name, 0) + count
+        return counts
+
+    def started(self, message):
+        """Count a new request in flight for its user."""
+        if message.message_type != NEW or message.target_id is not None:
+            return
+        self.track(message.uuid_str, message.uid)
+
+    def track(self, request_id, uid):
+        """Count the request `request_id` in flight for the user `uid`,
+        unless it is already counted."""
+        if request_id in self._request_uids:
+            return
+        self._request_uids[request_id] = uid
+        self._in_flight[uid] = self._in_flight.get(uid, 0) + 1
+        if self._at_cap(uid):
+            self._active_uids.discard(uid)
+
+    def finished(self, request_id):
+        """Stop counting the request `request_id` in flight, if it was."""
+        uid = self._request_uids.pop(request_id, None)
+        if uid is None:
+            return
+        self._in_flight[uid] -= 1
+        if not self._in_flight[uid]:
+            del self._in_flight[uid]
+        self._activate(uid)
+
+    def forget(self, predicate):
+        """Stop counting the requests whose IDs satisfy `predicate`."""
+        for request_id in [request_id for request_id in self._request_uids
+                           if predicate(request_id)]:
+            self.finished(request_id)
+
+    def _weight(self, uid):
+        return self.weights.get(owner_cache.user_name(uid),
+                                self.default_weight)
+
+    def _at_cap(self, uid):
+        cap = self.max_in_flight.get(owner_cache.user_name(uid),
+                                     self.default_max_in_flight)
+        return cap is not None and self._in_flight.get(uid, 0) >= cap
+
+    def _activate(self, uid):
+        """Make `uid` eligible to be picked, if it has files and is under
+        its cap."""
+        if (uid in self._active_uids or not self._queues.get(uid) or
+                self._at_cap(uid)):
+            return
+        tag = max(self._virtual_time, self._tags.get(uid, 0.0))
+        self._tags[uid] = tag
+        heapq.heappush(self._active, (tag, uid))
+        self._active_uids.add(uid)
+
+    def _push(self, name, stat):
+        uid = stat.st_uid
+        queue = self._queues.setdefault(uid, [])
+        heapq.heappush(queue, (stat.st_mtime_ns, name))
+        self._activate(uid)
+
+    def _pop_name(self):
+        while self._active:
+            tag, uid = heapq.heappop(self._active)
+            if uid not in self._active_uids or self._tags[uid] != tag:
+                continue  # Stale entry
+            self._active_uids.discard(uid)
+            queue = self._queues[uid]
+            _, name = heapq.heappop(queue)
+            if not queue:
+                del self._queues[uid]
+            self._virtual_time = tag
+            self._tags[uid] = tag + 1.0 / self._weight(uid)
+            self._activate(uid)
+            return name
+        return None
+
+
+def load_message(message_path, channel, *, trusted_uids=TRUSTED_UIDS,
+                 max_bytes=MAX_MESSAGE_BYTES, max_depth=MAX_MESSAGE_DEPTH,
+                 max_elements=MAX_MESSAGE_ELEMENTS):
     """Return the `Message` object at message_path, filling in `channel`,
     `uid`, and `user_name`. Will raise a subclass of `ValueError` if the file
     has a bad set of keys or the UUID in the file does not match the name of
-    the file."""
+    the file. A `REQUEST` file is a user's unless its owner is in
+    `trusted_uids`, which holds the uid of the daemon, so that the files
+    forwarded by other nodes of a cluster are trusted. A user's file must
+    pass `validate_user_message`, which only lets through `NEW` requests
+    without any of the `RESERVED_JSON_KEYS`.
+
+    Since anybody can write into the user `INBOX`, the file is treated as
+    hostile. It is opened without following symlinks, and the `fstat` of
+    the open file must show a regular file of at most `max_bytes`, before
+    anything is read. The JSON must then nest at most `max_depth` deep and
+    hold at most `max_elements` values, which `check_structure` makes sure
+    of before parsing, so that parsing cannot run out of memory or stack.
+    Every such problem raises a `ValueError`, so that `fetch_message` moves
+    the file into `ERROR`."""
     message_path = Path(message_path)
-    with message_path.open() as fin:
-        message_mapping = load(fin)
-    message_keys = set(message_mapping)
-    illegal_keys = ILLEGAL_JSON_KEYS & message_keys
-    missing_keys = REQUIRED_JSON_KEYS - message_keys
-    if illegal_keys:
-        raise IllegalJSONKeysError(
-            f'illegal keys in {message_path.name}: {illegal_keys}'
-        )
-    if missing_keys:
-        raise IllegalJSONKeysError(
-            f'missing keys in {message_path.name}: {missing_keys}'
-        )
-    uid = message_path.stat().st_uid
+    start = time.perf_counter()
+    name = message_path.name
+    try:
+        fd = os.open(message_path,
+                     os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK)
+    except FileNotFoundError:
+        raise
+    except OSError as e:
+        raise MessageFormatError(f'cannot open {name}: {e}') from e
     try:
-        user_name = message_path.owner()
-    except Exception as e:
-        logger.exception(f'problem getting owner name for {message_path.name}')
-        user_name = str(uid)
+        stat = os.fstat(fd)
+        if not stat_module.S_ISREG(stat.st_mode):
+            raise MessageFormatError(f'not a regular file: {name}')
+        if stat.st_size > max_bytes:
+            raise MessageTooLargeError(
+                f'{name} has {stat.st_size} bytes, over {max_bytes}'
+            )
+        data = os.read(fd, max_bytes + 1)  # The file may have grown.
+    finally:
+        os.close(fd)
+    if len(data) > max_bytes:
+        raise MessageTooLargeError(f'{name} grew over {max_bytes} bytes')
+    check_structure(data, name, max_depth, max_elements)
+    message_mapping = loads(data)
+    uid = stat.st_uid
+    if channel == REQUEST and uid not in trusted_uids:
+        validate_user_message(message_mapping, name)
+    else:
+        validate_message(message_mapping, name)
+    loaded = time.perf_counter()
+    user_name = owner_cache.user_name(uid)
+    metrics.observe('owner_lookup_seconds', time.perf_counter() - loaded)
     message = Message(channel=channel,
                       uid=uid,
                       user_name=user_name,
@@ -193,33 +842,157 @@ def load_message(message_path, channel):
         raise ValueError(
             f'wrong UUID in {message_path.name}: {message.uuid_str}'
         )
+    metrics.observe('json_load_seconds', loaded - start, channel=channel)
+    metrics.observe('inbox_dwell_seconds', time.time() - stat.st_mtime,
+                    channel=channel)
     return message
 
 
-def leave_message(directory, message_type, target_id=None, **kwds):
-    """Using `directory` as the root of a message drop, write a new JSON file
-    into the `TEMP` directory and then move that file into the `INBOX`
-    directory. The JSON file is an object (dict) that contains the combination
-    of message_type, target_id, kwds, and a UUID, which is also used to name
-    the file. The UUID is generated inside this method using `uuid4`, so as to
-    insure that the message and file have unique names. Returns the UUID as a
-    str. This function is usually invoked from client software that does not
-    call anything else in this module."""
-    assert 'uuid_str' not in kwds, kwds
-    assert 'channel' not in kwds, kwds
-    directory_path = Path(directory)
-    uuid_str = str(uuid4())
-    file_name = uuid_str + '.json'
-    initial_path = directory_path / TEMP / file_name
-    final_path = directory_path / INBOX / file_name
-    message = dict(uuid_str=uuid_str,
-                   message_type=message_type,
-                   target_id=target_id,
-                   **kwds)
-    with initial_path.open('w') as fout:
-        dump(message, fout, sort_keys=True)
-    initial_path.rename(final_path)
-    return uuid_str
+def check_structure(data, name, max_depth, max_elements):
+    """Raise `MessageTooComplexError` if the JSON text `data` (bytes) nests
+    deeper than `max_depth` or holds more than `max_elements` values. The
+    counts of brackets and commas are upper bounds of the depth and the
+    number of values, so the exact scan, which skips over strings, only
+    runs when those bounds are over the limits."""
+    containers = data.count(b'[') + data.count(b'{')
+    if (containers <= max_depth and
+            containers + data.count(b',') < max_elements):
+        return
+    depth = 0
+    elements = 1
+    for match in JSON_STRUCTURE.finditer(data):
+        token = match.group()
+        if token in (b'[', b'{'):
+            depth += 1
+            elements += 1
+            if depth > max_depth:
+                raise MessageTooComplexError(
+                    f'{name} nests deeper than {max_depth}'
+                )
+        elif token == b',':
+            elements += 1
+        elif token in (b']', b'}'):
+            depth -= 1
+        if elements > max_elements:
+            raise MessageTooComplexError(
+                f'{name} has more than {max_elements} values'
+            )
+
+
+def make_message_validator(required_keys, illegal_keys, message_types):
+    """Return a function `validate(mapping, name)` that raises a subclass
+    of `ValueError` unless `mapping` is a `dict` with all of
+    `required_keys` and none of `illegal_keys`, whose "message_type" is one
+    of `message_types`, whose "uuid_str" is a UUID string, and whose
+    "target_id" is one too, or None for a `NEW` message. The key sets are
+    frozen once, and the checks run against the key view without copying
+    it."""
+    required_keys = frozenset(required_keys)
+    illegal_keys = frozenset(illegal_keys)
+    message_types = frozenset(message_types)
+
+    def validate(mapping, name):
+        if type(mapping) is not dict:
+            raise MessageFormatError(f'{name} is not a JSON object')
+        keys = mapping.keys()
+        if not keys.isdisjoint(illegal_keys):
+            raise IllegalJSONKeysError(
+                f'illegal keys in {name}: {set(keys & illegal_keys)}'
+            )
+        if not required_keys <= keys:
+            raise MissingJSONKeysError(
+                f'missing keys in {name}: {set(required_keys - keys)}'
+            )
+        message_type = mapping['message_type']
+        if type(message_type) is not str or message_type not in message_types:
+            raise IllegalJSONValuesError(
+                f'unknown message_type in {name}: {message_type!r:.40}'
+            )
+        uuid_str = mapping['uuid_str']
+        if type(uuid_str) is not str or not UUID_PATTERN.fullmatch(uuid_str):
+            raise IllegalJSONValuesError(
+                f'uuid_str in {name} is not a UUID: {uuid_str!r:.40}'
+            )
+        target_id = mapping['target_id']
+        if target_id is None:
+            if message_type != NEW:
+                raise IllegalJSONValuesError(
+                    f'{message_type} without target_id in {name}'
+                )
+        elif type(target_id) is not str or not UUID_PATTERN.fullmatch(
+                target_id):
+            raise IllegalJSONValuesError(
+                f'target_id in {name} is not a UUID: {target_id!r:.40}'
+            )
+
+    return validate
+
+
+validate_message = make_message_validator(
+    REQUIRED_JSON_KEYS, ILLEGAL_JSON_KEYS, FILE_MESSAGE_TYPES
+)
+validate_user_message = make_message_validator(
+    REQUIRED_JSON_KEYS, ILLEGAL_JSON_KEYS | RESERVED_JSON_KEYS,
+    USER_MESSAGE_TYPES
+)
+
+
+class OwnerCache:
+    """Bounded, expiring cache of user names by uid, so that a burst of
+    messages from one user costs a single passwd lookup, which may go all
+    the way to a directory service. Unknown uids map to `str(uid)`, and
+    that answer is cached too, for `negative_ttl` seconds. The counters
+    `hits`, `misses`, and `negative_lookups` are available for monitoring,
+    together with the current size, from `stats`."""
+
+    def __init__(self, *, ttl=600, negative_ttl=60, maxsize=4096):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # uid -> (expiration time, user name)
+        self.hits = 0
+        self.misses = 0
+        self.negative_lookups = 0
+
+    def user_name(self, uid):
+        """Return the user name for `uid`, or `str(uid)` if it has none."""
+        now = time.monotonic()
+        entry = self._entries.get(uid)
+        if entry is not None and entry[0] > now:
+            self._entries.move_to_end(uid)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        try:
+            user_name = pwd.getpwuid(uid).pw_name
+            ttl = self.ttl
+        except Exception as e:
+            if isinstance(e, KeyError):
+                logger.warning(f'no user name for uid {uid}')
+            else:
+                logger.exception(f'problem getting user name for uid {uid}')
+            user_name = str(uid)
+            ttl = self.negative_ttl
+            self.negative_lookups += 1
+        self._entries[uid] = (now + ttl, user_name)
+        self._entries.move_to_end(uid)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return user_name
+
+    def clear(self):
+        """Forget all cached user names, but keep the counters."""
+        self._entries.clear()
+
+    def stats(self):
+        """Return a `dict` of the counters and the current size."""
+        return dict(hits=self.hits,
+                    misses=self.misses,
+                    negative_lookups=self.negative_lookups,
+                    size=len(self._entries))
+
+
+owner_cache = OwnerCache()  # Used by load_message
 
 
 class MissingJSONKeysError(ValueError):
@@ -230,3 +1003,29 @@ class MissingJSONKeysError(ValueError):
 class IllegalJSONKeysError(ValueError):
     """Some illegal keys were present in a JSON file."""
     pass
+
+
+class IllegalJSONValuesError(ValueError):
+    """A message file has a value of the wrong type or an unknown value."""
+    pass
+
+
+class MessageFormatError(ValueError):
+    """A message file is not a regular file holding a JSON object."""
+    pass
+
+
+class MessageTooLargeError(ValueError):
+    """A message file has more bytes than allowed."""
+    pass
+
+
+class MessageTooComplexError(ValueError):
+    """A message file nests too deep or holds too many values."""
+    pass
+
+
+class UntrustedMessageError(ValueError):
+    """A message from a user's file asks for what only the daemon may
+    do."""
+    pass
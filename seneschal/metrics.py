@@ -0,0 +1,228 @@
+"""Counters and latency histograms for the stages of message delivery, cheap
+enough to leave on in production. Instrumented code records into the shared
+`metrics` object:
+
+    start = time.perf_counter()
+    ...
+    metrics.observe('json_load_seconds', time.perf_counter() - start,
+                    channel=channel)
+    metrics.inc('messages_delivered_total', channel=channel,
+                message_type=message_type)
+
+The stages recorded are:
+
+* inbox_dwell_seconds: from the modification time of a message file until
+  the daemon loads it, by channel
+* json_load_seconds: loading and validating a message file, by channel
+* owner_lookup_seconds: finding the user name of the owner of a message
+* delivery_seconds: delivering a message to its manager, which includes
+  saving the worker and any messages the manager delivers in turn, by
+  channel and message type, where unknown message types count as "other"
+* worker_save_seconds: saving the state of a worker, by manager
+* messages_delivered_total and messages_rejected_total: counters
+* inbox_queue_depth and requests_in_flight: gauges of the messages waiting
+  and the requests in flight, by channel and user, with fair queueing
+
+A `MetricsExporter` writes everything, atomically, to a file for the
+Prometheus node exporter's textfile collector, or as JSON, at most once per
+interval. It is configured by the optional "metrics" section of the config:
+
+    metrics:
+      path: /var/lib/node_exporter/textfile/seneschal.prom
+      format: prometheus
+      interval: 15
+
+Only the delivery thread records metrics, so there is no locking."""
+
+from bisect import bisect_left
+from json import dump
+import logging
+import os
+from pathlib import Path
+import time
+
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'seneschal_'
+PROMETHEUS = 'prometheus'
+JSON = 'json'
+EXPORT_FORMATS = (PROMETHEUS, JSON)
+# Upper bounds in seconds, from tens of microseconds to an hour:
+DEFAULT_BUCKETS = (1e-5, 3e-5, 1e-4, 3e-4, 0.001, 0.003, 0.01, 0.03, 0.1,
+                   0.3, 1.0, 3.0, 10.0, 30.0, 100.0, 300.0, 1000.0, 3600.0)
+
+
+class Histogram:
+    """Counts observations in buckets with fixed upper bounds, plus an
+    overflow bucket, and keeps their sum."""
+
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds=DEFAULT_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def cumulative_counts(self):
+        """Return a list of (upper bound, count of observations not above
+        it), ending with (`float('inf')`, `count`)."""
+        result = []
+        total = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Metrics:
+    """Named counters, gauges, and histograms, each with an optional set of
+    labels, such as channel and message type."""
+
+    def __init__(self):
+        self.counters = dict()  # (name, labels) -> number
+        self.gauges = dict()  # (name, labels) -> number
+        self.histograms = dict()  # (name, labels) -> Histogram
+
+    def inc(self, name, amount=1, **labels):
+        """Add `amount` to a counter."""
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set_gauge(self, name, value, **labels):
+        """Set a gauge to `value`."""
+        self.gauges[name, tuple(sorted(labels.items()))] = value
+
+    def clear_gauges(self, name):
+        """Forget the gauges called `name`, with any labels, such as before
+        setting those that still apply."""
+        for key in [key for key in self.gauges if key[0] == name]:
+            del self.gauges[key]
+
+    def observe(self, name, value, **labels):
+        """Record one observation, usually in seconds, in a histogram."""
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def clear(self):
+        """Forget every counter, gauge, and histogram."""
+        self.counters.clear()
+        self.gauges.clear()
+        self.histograms.clear()
+
+    def to_prometheus(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        lines = []
+        for kind, values in (('counter', self.counters),
+                             ('gauge', self.gauges)):
+            for name in sorted({name for name, _ in values}):
+                lines.append(f'# TYPE {PREFIX}{name} {kind}')
+                for (other, labels), value in sorted(values.items()):
+                    if other == name:
+                        lines.append(f'{PREFIX}{name}'
+                                     f'{format_labels(labels)} {value}')
+        for name in sorted({name for name, _ in self.histograms}):
+            lines.append(f'# TYPE {PREFIX}{name} histogram')
+            for (other, labels), histogram in sorted(
+                    self.histograms.items(), key=lambda item: item[0]):
+                if other != name:
+                    continue
+                for bound, count in histogram.cumulative_counts():
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    bucket_labels = format_labels(labels + (('le', le),))
+                    lines.append(f'{PREFIX}{name}_bucket{bucket_labels} '
+                                 f'{count}')
+                lines.append(f'{PREFIX}{name}_sum{format_labels(labels)} '
+                             f'{histogram.sum!r}')
+                lines.append(f'{PREFIX}{name}_count{format_labels(labels)} '
+                             f'{histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self):
+        """Return the metrics as a `dict` that can be dumped as JSON."""
+        return dict(
+            time=time.time(),
+            counters=[dict(name=name, labels=dict(labels), value=value)
+                      for (name, labels), value
+                      in sorted(self.counters.items())],
+            gauges=[dict(name=name, labels=dict(labels), value=value)
+                    for (name, labels), value
+                    in sorted(self.gauges.items())],
+            histograms=[
+                dict(name=name, labels=dict(labels), sum=histogram.sum,
+                     count=histogram.count,
+                     buckets=[[None if bound == float('inf') else bound,
+                               count]
+                              for bound, count
+                              in histogram.cumulative_counts()])
+                for (name, labels), histogram
+                in sorted(self.histograms.items(), key=lambda item: item[0])
+            ]
+        )
+
+
+def format_labels(labels):
+    """Return Prometheus label syntax for a tuple of (name, value) pairs."""
+    if not labels:
+        return ''
+    text = ','.join('{}="{}"'.format(
+        key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for key, value in labels)
+    return '{' + text + '}'
+
+
+metrics = Metrics()  # Used by the instrumented modules
+
+
+class MetricsExporter:
+    """Writes `metrics` to `path` at most once every `interval` seconds, in
+    `format` "prometheus" or "json". Each export writes a temporary file
+    and renames it over `path`, so readers never see a partial file."""
+
+    def __init__(self, *, path, format=PROMETHEUS, interval=15.0,
+                 source=metrics, **kwds):
+        super().__init__(**kwds)
+        if format not in EXPORT_FORMATS:
+            raise ValueError(f'format must be one of {EXPORT_FORMATS}')
+        self.path = Path(path)
+        self.format = format
+        self.interval = interval
+        self.source = source
+        self._export_time = None  # time.monotonic() of last export
+
+    def maybe_export(self, force=False):
+        """Export if `force` is True or the interval has passed. Returns
+        True if the file was written."""
+        now = time.monotonic()
+        if (not force and self._export_time is not None and
+                now - self._export_time < self.interval):
+            return False
+        self._export_time = now
+        try:
+            self.export()
+        except OSError:
+            logger.exception(f'problem exporting metrics to {self.path}')
+            return False
+        return True
+
+    def export(self):
+        """Atomically replace the file at `path` with the current
+        metrics."""
+        temp_path = self.path.with_name(self.path.name + '.tmp')
+        with temp_path.open('w') as fout:
+            if self.format == PROMETHEUS:
+                fout.write(self.source.to_prometheus())
+            else:
+                dump(self.source.to_dict(), fout, sort_keys=True)
+        os.replace(temp_path, self.path)
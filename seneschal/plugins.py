@@ -0,0 +1,307 @@
+"""Hosting of plugins. A plugin is a directory in the plugins directory,
+named after the plugin and its version, such as "md5-1.0", that contains
+either a Python module named `plugin.py` or an executable named `plugin`.
+The configuration of a plugin is the config section under "plugins" with the
+same name as the directory.
+
+Python module plugins are imported once, and their `create` function is
+called once with the configuration. The resulting plugin object is cached
+and called directly with a `dict`.
+
+Executable plugins read their configuration, as JSON, from the environment
+variable `SENESCHAL_PLUGIN_CONFIG`. In one-shot mode, the plugin is started
+for every invocation, reads one JSON object from stdin, and writes one JSON
+object to stdout. A plugin that sets "persistent" in its "plugin_host"
+options (see below) instead runs as a warm worker: it is started with
+`SENESCHAL_PLUGIN_PROTOCOL=jsonl` and then repeatedly reads one request per
+line from stdin and writes one response per line to stdout, flushing after
+each, until stdin is closed. Workers are pooled per plugin, restarted if
+they crash, retired after "idle_timeout" seconds without work, and recycled
+after "max_requests" requests.
+
+The "plugin_host" section of the config holds the default options, and any
+plugin section may override them under its own "plugin_host" key:
+
+    plugin_host:
+      persistent: false
+      pool_size: 1
+      idle_timeout: 300
+      max_requests: 1000
+      timeout: 60
+    plugins:
+      md5-1.0:
+        executable: /usr/bin/md5sum
+        plugin_host:
+          persistent: true
+"""
+
+import importlib.util
+from json import dumps, loads
+import logging
+import os
+from pathlib import Path
+import select
+import subprocess
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+MODULE_FILE = 'plugin.py'
+EXECUTABLE_FILE = 'plugin'
+CONFIG_VARIABLE = 'SENESCHAL_PLUGIN_CONFIG'
+PROTOCOL_VARIABLE = 'SENESCHAL_PLUGIN_PROTOCOL'
+PROTOCOL = 'jsonl'
+DEFAULT_HOST_OPTIONS = dict(persistent=False, pool_size=1, idle_timeout=300,
+                            max_requests=1000, timeout=60)
+
+
+class PluginManager:
+    """The sterile manager of plugins: it has no workers with state, only a
+    cache of loaded plugins. Call `invoke` to run a plugin, and `shutdown`
+    to stop any warm workers."""
+
+    def __init__(self, *, directory, plugins_config=None,
+                 host_options=None):
+        """Parameters: `directory` is the plugins directory;
+        `plugins_config` is the "plugins" section of the config;
+        `host_options` is the "plugin_host" section."""
+        self.directory = Path(directory)
+        self.plugins_config = plugins_config or {}
+        self.host_options = dict(DEFAULT_HOST_OPTIONS, **(host_options or {}))
+        self._plugins = dict()  # name -> loaded plugin
+        self._lock = threading.Lock()
+
+    def invoke(self, name, request):
+        """Run the plugin `name` with the `dict` `request`, and return the
+        `dict` that it returns."""
+        return self.get(name)(request)
+
+    def get(self, name):
+        """Return the cached, callable plugin named `name`, loading it if
+        needed."""
+        with self._lock:
+            plugin = self._plugins.get(name)
+            if plugin is None:
+                plugin = self._plugins[name] = self._load(name)
+        return plugin
+
+    def reap_idle(self):
+        """Stop warm workers that have been idle too long."""
+        for plugin in list(self._plugins.values()):
+            if isinstance(plugin, PluginWorkerPool):
+                plugin.reap_idle()
+
+    def shutdown(self):
+        """Stop all warm workers and forget all loaded plugins."""
+        with self._lock:
+            plugins, self._plugins = self._plugins, dict()
+        for plugin in plugins.values():
+            if isinstance(plugin, PluginWorkerPool):
+                plugin.close()
+
+    def _load(self, name):
+        plugin_dir = self.directory / name
+        config = dict(self.plugins_config.get(name) or {})
+        options = dict(self.host_options, **config.pop('plugin_host', {}))
+        module_path = plugin_dir / MODULE_FILE
+        executable_path = plugin_dir / EXECUTABLE_FILE
+        if module_path.is_file():
+            logger.info(f'importing plugin {name}')
+            return load_module_plugin(name, module_path, config)
+        if executable_path.is_file():
+            if options['persistent']:
+                return PluginWorkerPool(name, [str(executable_path)], config,
+                                        **options)
+            return OneShotPlugin(name, [str(executable_path)], config,
+                                 timeout=options['timeout'])
+        raise PluginError(f'no {MODULE_FILE} or {EXECUTABLE_FILE} '
+                          f'in {plugin_dir}')
+
+
+def load_module_plugin(name, module_path, config):
+    """Import the module at `module_path` and return the result of calling
+    its `create` function with `config`."""
+    module_name = 'seneschal_plugin_' + name.replace('-', '_').replace('.',
+                                                                       '_')
+    spec = importlib.util.spec_from_file_location(module_name, module_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.create(config)
+
+
+def plugin_environment(config, persistent=False):
+    """Return the environment for an executable plugin."""
+    env = dict(os.environ)
+    env[CONFIG_VARIABLE] = dumps(config, sort_keys=True)
+    if persistent:
+        env[PROTOCOL_VARIABLE] = PROTOCOL
+    else:
+        env.pop(PROTOCOL_VARIABLE, None)
+    return env
+
+
+class OneShotPlugin:
+    """An executable plugin that is started for each invocation."""
+
+    def __init__(self, name, argv, config, *, timeout=None):
+        self.name = name
+        self.argv = argv
+        self.env = plugin_environment(config)
+        self.timeout = timeout
+
+    def __call__(self, request):
+        completed = subprocess.run(self.argv, input=dumps(request),
+                                   stdout=subprocess.PIPE, env=self.env,
+                                   timeout=self.timeout,
+                                   universal_newlines=True)
+        if completed.returncode:
+            raise PluginError(f'{self.name} exited with '
+                              f'{completed.returncode}')
+        return loads(completed.stdout)
+
+
+class PluginWorker:
+    """One warm worker process of an executable plugin, speaking the
+    JSON lines protocol."""
+
+    def __init__(self, argv, env):
+        self.process = subprocess.Popen(argv, stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, env=env,
+                                        bufsize=0)
+        self.requests = 0
+        self.last_used = time.monotonic()
+        self._buffer = b''
+
+    def call(self, request, timeout):
+        """Send one request and return the response. Raises `PluginError`
+        if the worker dies, times out, or answers with something other than
+        a JSON object."""
+        try:
+            self.process.stdin.write(dumps(request).encode() + b'\n')
+        except OSError as e:
+            raise PluginError(f'worker {self.process.pid} gone: {e}')
+        line = self._read_line(timeout)
+        self.requests += 1
+        self.last_used = time.monotonic()
+        response = loads(line)
+        if not isinstance(response, dict):
+            raise PluginError(f'bad response: {line[:100]!r}')
+        return response
+
+    def _read_line(self, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        fd = self.process.stdout.fileno()
+        while b'\n' not in self._buffer:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PluginError(f'worker {self.process.pid} timed out')
+            readable, _, _ = select.select([fd], [], [], remaining)
+            if not readable:
+                continue
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                raise PluginError(f'worker {self.process.pid} exited')
+            self._buffer += chunk
+        line, _, self._buffer = self._buffer.partition(b'\n')
+        return line
+
+    def close(self, timeout=5):
+        """Close stdin, which asks the worker to exit, and wait for it,
+        killing it if it does not exit within `timeout` seconds."""
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process.stdout.close()
+
+
+class PluginWorkerPool:
+    """A pool of up to `pool_size` warm `PluginWorker`s for one executable
+    plugin. Callable like any other plugin. A worker that fails is killed
+    and the request is retried once on a fresh worker."""
+
+    def __init__(self, name, argv, config, *, pool_size=1, idle_timeout=300,
+                 max_requests=1000, timeout=60, **kwds):
+        self.name = name
+        self.argv = argv
+        self.env = plugin_environment(config, persistent=True)
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.max_requests = max_requests
+        self.timeout = timeout
+        self._idle = []  # Idle workers, most recently used last
+        self._busy = 0
+        self._available = threading.Condition()
+        self.started = 0  # Number of workers ever started
+
+    def __call__(self, request):
+        for attempt in (1, 2):
+            worker = self._checkout()
+            try:
+                response = worker.call(request, self.timeout)
+            except (PluginError, ValueError) as e:
+                logger.warning(f'plugin {self.name} worker failed: {e}')
+                worker.process.kill()
+                worker.close()
+                self._checkin(None)
+                if attempt == 2:
+                    raise PluginError(f'plugin {self.name} failed: {e}')
+                continue
+            if worker.requests >= self.max_requests:
+                worker.close()
+                worker = None  # Recycle
+            self._checkin(worker)
+            return response
+
+    def _checkout(self):
+        with self._available:
+            while not self._idle and self._busy >= self.pool_size:
+                self._available.wait()
+            self._busy += 1
+            if self._idle:
+                return self._idle.pop()
+        self.started += 1
+        logger.info(f'starting worker for plugin {self.name}')
+        try:
+            return PluginWorker(self.argv, self.env)
+        except BaseException:
+            self._checkin(None)  # Give back the slot
+            raise
+
+    def _checkin(self, worker):
+        with self._available:
+            self._busy -= 1
+            if worker is not None:
+                self._idle.append(worker)
+            self._available.notify()
+
+    def reap_idle(self):
+        """Stop workers idle for more than `idle_timeout` seconds."""
+        cutoff = time.monotonic() - self.idle_timeout
+        with self._available:
+            stale = [worker for worker in self._idle
+                     if worker.last_used < cutoff]
+            self._idle = [worker for worker in self._idle
+                          if worker.last_used >= cutoff]
+        for worker in stale:
+            worker.close()
+
+    def close(self):
+        """Stop all idle workers."""
+        with self._available:
+            workers, self._idle = self._idle, []
+        for worker in workers:
+            worker.close()
+
+
+class PluginError(RuntimeError):
+    """A plugin could not be loaded or failed to respond."""
@@ -0,0 +1,174 @@
+"""Admission control for tasks that consume resources on the daemon host or
+the cluster. A `ResourceScheduler` counts the cores and processes in flight
+globally, per user, and per request, and only admits a task if it fits under
+every configured limit. A `ParallelTask` asks the scheduler before starting
+each child, and releases the child's resources when it finishes.
+
+Limits are read from the optional "scheduling" section of the config:
+
+    scheduling:
+      max_cores: 64
+      max_processes: 200
+      max_cores_per_user: 16
+      max_processes_per_user: 50
+      max_cores_per_request: 8
+      max_processes_per_request: 20
+
+A missing or blank limit means no limit.
+
+Limits are enforced by each daemon on its own. In cluster mode (see
+`cluster`), where a user's requests are spread over the live nodes, the
+global and per-user limits are divided by the number of live nodes (see
+`set_nodes`), rounding down but never below 1, so that the cluster as a
+whole stays within them. A request is handled by one node at a time, so
+per-request limits apply unchanged. The division follows the live nodes at
+each heartbeat, so the cluster may briefly exceed a limit while nodes join
+or leave.
+
+A task that is refused waits in line with `wait`. Whenever resources are
+released, `ready_waiters` hands back, in order, the waiters that fit
+together in what is free, so that a task blocked by a global or per-user
+limit is retried when any other request frees resources, not only when one
+of its own children finishes."""
+
+from collections import OrderedDict
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+GLOBAL = 'global'
+USER = 'user'
+REQUEST = 'request'
+
+
+class ResourceScheduler:
+    """Tracks resources in flight and enforces limits on them. A task that
+    asks for more than a limit allows is still admitted when nothing else is
+    in flight in that scope, so that an oversized task runs alone instead of
+    never running."""
+
+    def __init__(self, *, max_cores=None, max_processes=None,
+                 max_cores_per_user=None, max_processes_per_user=None,
+                 max_cores_per_request=None, max_processes_per_request=None):
+        # The limits as configured, for the whole cluster if clustered
+        self.configured_limits = {
+            GLOBAL: (max_cores, max_processes),
+            USER: (max_cores_per_user, max_processes_per_user),
+            REQUEST: (max_cores_per_request, max_processes_per_request),
+        }
+        self.limits = dict(self.configured_limits)  # Of this node
+        self.nodes = 1  # See set_nodes
+        self._in_use = dict()  # (scope, key) -> [cores, processes]
+        # (request ID, waiter key) -> (user, cores), in order of waiting
+        self._waiters = OrderedDict()
+        self._released = False  # Whether ready_waiters may find any
+
+    @classmethod
+    def from_config(cls, scheduling_config):
+        """Construct from the "scheduling" section of the config, which may
+        be None."""
+        options = {key: value
+                   for key, value in (scheduling_config or {}).items()
+                   if value is not None}
+        return cls(**options)
+
+    def set_nodes(self, nodes):
+        """Share the global and per-user limits among `nodes` live nodes.
+        See the module docstring."""
+        assert nodes >= 1, nodes
+        if nodes == self.nodes:
+            return
+        logger.info(f'sharing resource limits among {nodes} nodes')
+        self.nodes = nodes
+        for scope in (GLOBAL, USER):
+            self.limits[scope] = tuple(
+                None if limit is None else max(1, limit // nodes)
+                for limit in self.configured_limits[scope]
+            )
+        self._released = True  # Waiters may fit under higher limits.
+
+    def _scopes(self, request_id, user):
+        return ((GLOBAL, None), (USER, user), (REQUEST, request_id))
+
+    def fits(self, request_id, user, cores, processes=1):
+        """Return True if the resources would fit under all limits."""
+        for scope, key in self._scopes(request_id, user):
+            used_cores, used_processes = self._in_use.get((scope, key),
+                                                          (0, 0))
+            if not used_processes:
+                continue  # Always admit into an empty scope.
+            max_cores, max_processes = self.limits[scope]
+            if max_cores is not None and used_cores + cores > max_cores:
+                return False
+            if (max_processes is not None and
+                    used_processes + processes > max_processes):
+                return False
+        return True
+
+    def try_acquire(self, request_id, user, cores, processes=1):
+        """Acquire the resources if they fit. Returns True on success."""
+        if not self.fits(request_id, user, cores, processes):
+            return False
+        self.acquire(request_id, user, cores, processes)
+        return True
+
+    def acquire(self, request_id, user, cores, processes=1):
+        """Acquire the resources unconditionally, such as when restoring
+        the tasks that were running before a restart."""
+        for scope_key in self._scopes(request_id, user):
+            usage = self._in_use.setdefault(scope_key, [0, 0])
+            usage[0] += cores
+            usage[1] += processes
+
+    def release(self, request_id, user, cores, processes=1):
+        """Release resources previously acquired."""
+        self._released = True
+        self._release(request_id, user, cores, processes)
+
+    def _release(self, request_id, user, cores, processes):
+        for scope_key in self._scopes(request_id, user):
+            usage = self._in_use.get(scope_key)
+            if usage is None:
+                logger.warning(f'releasing unknown resources: {scope_key}')
+                continue
+            usage[0] -= cores
+            usage[1] -= processes
+            if usage[1] <= 0:
+                del self._in_use[scope_key]
+
+    def wait(self, request_id, user, cores, key):
+        """Put the task identified by `request_id` and `key`, such as its
+        path, in line for `cores` and one process. Waiting again keeps the
+        place in line."""
+        self._waiters.setdefault((request_id, key), (user, cores))
+
+    def forget_waiters(self, request_id):
+        """Take every task of `request_id` out of line, such as when the
+        request moves to another node."""
+        for waiter in [waiter for waiter in self._waiters
+                       if waiter[0] == request_id]:
+            del self._waiters[waiter]
+
+    def ready_waiters(self):
+        """If resources were released since the last call, take out of
+        line and return the list of (request ID, key) pairs of the waiters,
+        in order, that fit together in the resources now free. Each must
+        still `try_acquire` its resources."""
+        if not self._released:
+            return []
+        self._released = False
+        ready = []
+        for (request_id, key), (user, cores) in list(self._waiters.items()):
+            if self.fits(request_id, user, cores):
+                self.acquire(request_id, user, cores)  # Held back for now
+                ready.append((request_id, key, user, cores))
+                del self._waiters[request_id, key]
+        for request_id, _, user, cores in ready:
+            self._release(request_id, user, cores, 1)
+        return [(request_id, key) for request_id, key, _, _ in ready]
+
+    def usage(self, scope=GLOBAL, key=None):
+        """Return the (cores, processes) in flight for one scope and key,
+        such as `usage(USER, 'alice')`."""
+        return tuple(self._in_use.get((scope, key), (0, 0)))
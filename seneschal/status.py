@@ -0,0 +1,128 @@
+"""Status snapshots of requests, for clients. The daemon keeps one small JSON
+file per request in the "status" subdirectory of the outbox:
+
+    OUTBOX/status/12300000-0000-0000-0000-000000000000.json
+
+holding the overall state of the request and the number of leaf tasks in
+each state, as returned by `managers.Request.status`, plus the time of the
+snapshot. `seneschal status` reads that one file instead of the state of the
+request, so answering is O(1) no matter how large the task tree is.
+
+Each snapshot is written to a temporary file and renamed over the old one,
+so readers never see a partial file. Writes are coalesced: saving a request
+only marks it, and `StatusWriter.flush`, called at each checkpoint, writes
+each marked request at most once per `min_interval` seconds, except that a
+request that has just finished is written at once.
+
+The snapshot of a finished request is written once more and then left
+alone, so its modification time is when the request finished. At most once
+per `expire_interval` seconds, `StatusWriter.expire` removes the snapshots
+of finished requests older than `retention` seconds. Only snapshots that
+old are read, to check their state.
+
+The writer is configured by the optional "status" section of the config:
+
+    status:
+      min_interval: 1.0
+      retention: 604800
+      expire_interval: 3600
+"""
+
+from json import dump, load
+import logging
+import os
+from pathlib import Path
+import time
+
+from .client import FAILED, STATUS, SUCCEEDED
+
+
+logger = logging.getLogger(__name__)
+
+FINAL_STATES = (SUCCEEDED, FAILED)
+
+
+class StatusWriter:
+    """Writes coalesced status snapshots of requests into
+    `directory / STATUS`. See the module docstring."""
+
+    def __init__(self, *, directory, min_interval=1.0, retention=604800,
+                 expire_interval=3600, **kwds):
+        super().__init__(**kwds)
+        self.directory = Path(directory) / STATUS
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.min_interval = min_interval
+        self.retention = retention
+        self.expire_interval = expire_interval
+        self._marked = {}  # request ID -> request, waiting to be written
+        self._write_times = {}  # request ID -> time.monotonic() of write
+        self._expire_time = None  # time.monotonic() of the last expire
+
+    def mark(self, request):
+        """Note that the status of `request` may have changed."""
+        self._marked[request.id] = request
+
+    def flush(self, force=False):
+        """Write the snapshots of the marked requests that are due: all of
+        them if `force` is True, and otherwise those that finished or were
+        not written in the last `min_interval` seconds. Returns the number
+        written."""
+        now = time.monotonic()
+        horizon = now - self.min_interval
+        written = 0
+        for request_id, request in list(self._marked.items()):
+            status = request.status()
+            if (not force and status['state'] not in FINAL_STATES and
+                    self._write_times.get(request_id, horizon) > horizon):
+                continue
+            del self._marked[request_id]
+            try:
+                self.write(request_id, status)
+            except OSError:
+                logger.exception(f'problem writing status of {request_id}')
+                continue
+            self._write_times[request_id] = now
+            written += 1
+        # Forget write times too old to delay anything.
+        for request_id, write_time in list(self._write_times.items()):
+            if write_time <= horizon:
+                del self._write_times[request_id]
+        return written
+
+    def write(self, request_id, status):
+        """Atomically replace the snapshot of `request_id` with `status`,
+        plus the current time."""
+        path = self.directory / f'{request_id}.json'
+        temp_path = self.directory / f'.{request_id}.tmp'
+        with temp_path.open('w') as fout:
+            dump(dict(status, time=time.time()), fout, sort_keys=True)
+        os.replace(temp_path, path)
+
+    def expire(self, force=False, now=None):
+        """Remove the snapshots of requests that finished more than
+        `retention` seconds before `now` (default: the current time), if
+        `force` is True or `expire_interval` seconds have passed since the
+        last call. Returns the number removed."""
+        monotonic_now = time.monotonic()
+        if (not force and self._expire_time is not None and
+                monotonic_now - self._expire_time < self.expire_interval):
+            return 0
+        self._expire_time = monotonic_now
+        cutoff = (time.time() if now is None else now) - self.retention
+        removed = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith('.') or not entry.name.endswith('.json'):
+                continue
+            try:
+                if entry.stat().st_mtime > cutoff:
+                    continue
+                with open(entry.path) as fin:
+                    state = load(fin).get('state')
+                if state in FINAL_STATES:
+                    os.unlink(entry.path)
+                    removed += 1
+            except (OSError, ValueError, AttributeError):
+                logger.exception(f'problem expiring {entry.path}')
+        if removed:
+            logger.info(f'expired {removed} status snapshots')
+        return removed
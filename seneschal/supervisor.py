@@ -0,0 +1,146 @@
+"""Supervision of many concurrent local subprocesses, such as restartable
+copies, without blocking message delivery. A `SubprocessSupervisor` runs an
+asyncio event loop in a background thread. That loop starts the children,
+waits on all of them at once, enforces timeouts, and reaps them. Each exit
+is reported by calling `on_exit` from the supervisor thread, so `on_exit`
+must be thread-safe; typically it posts a message to the
+`messaging.MessageBroker` and wakes the engine.
+
+The thread starts on the first `spawn`, which keeps it on the right side of
+the fork performed while daemonizing. Requires Python 3.8 or later, where
+asyncio can reap children from a loop outside the main thread."""
+
+import asyncio
+import logging
+import subprocess
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+KILLED = 'killed'
+TIMED_OUT = 'timed out'
+
+
+class SubprocessSupervisor:
+    """Starts, tracks, times out, and reaps child processes identified by
+    keys. `on_exit(key, returncode, reason)` is called from the supervisor
+    thread when a child exits; `reason` is None for a normal exit,
+    `TIMED_OUT`, or an error message if the child could not be started.
+    Children killed by `shutdown` are not reported."""
+
+    def __init__(self, on_exit, *, kill_grace=5.0):
+        """`kill_grace` is the number of seconds between `SIGTERM` and
+        `SIGKILL` when stopping a child."""
+        self.on_exit = on_exit
+        self.kill_grace = kill_grace
+        self._loop = None
+        self._thread = None
+        self._processes = dict()  # key -> asyncio.subprocess.Process
+        self._futures = dict()  # key -> concurrent.futures.Future
+        self._lock = threading.Lock()  # Guards _futures
+        self._shutting_down = False
+
+    def __len__(self):
+        """Returns the number of children being supervised."""
+        with self._lock:
+            return len(self._futures)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._futures
+
+    def keys(self):
+        """Returns a list of the keys of the children being supervised."""
+        with self._lock:
+            return list(self._futures)
+
+    def spawn(self, key, argv, *, cwd=None, env=None, timeout=None):
+        """Start `argv` as a child process tracked under `key`, without
+        waiting for it. `timeout` is in seconds, or None for no limit."""
+        assert not self._shutting_down
+        self._ensure_started()
+        coroutine = self._supervise(key, list(argv), cwd, env, timeout)
+        with self._lock:
+            assert key not in self._futures, key
+            future = asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+            self._futures[key] = future
+        future.add_done_callback(lambda _: self._forget(key))
+
+    def shutdown(self):
+        """Stop every child (`SIGTERM`, then `SIGKILL` after `kill_grace`
+        seconds), stop the event loop, and return the keys of the children
+        that were stopped, so that the caller can re-queue them."""
+        self._shutting_down = True
+        if self._loop is None:
+            return []
+        with self._lock:
+            keys = list(self._futures)
+        if keys:
+            stop = asyncio.run_coroutine_threadsafe(self._stop_all(),
+                                                    self._loop)
+            stop.result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = self._thread = None
+        return keys
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever,
+                                        name='subprocess-supervisor',
+                                        daemon=True)
+        self._thread.start()
+
+    def _forget(self, key):
+        with self._lock:
+            self._futures.pop(key, None)
+
+    async def _supervise(self, key, argv, cwd, env, timeout):
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *argv, cwd=cwd, env=env, stdin=subprocess.DEVNULL,
+                start_new_session=True
+            )
+        except Exception as e:
+            logger.exception(f'could not start {key}: {argv}')
+            self._report(key, None, str(e))
+            return
+        self._processes[key] = process
+        logger.info(f'started {key} pid={process.pid}')
+        reason = None
+        try:
+            await asyncio.wait_for(process.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f'{key} timed out after {timeout} s')
+            reason = TIMED_OUT
+            await self._stop(process)
+        except asyncio.CancelledError:
+            return  # Stopped by shutdown
+        finally:
+            del self._processes[key]
+        if not self._shutting_down:
+            self._report(key, process.returncode, reason)
+
+    def _report(self, key, returncode, reason):
+        try:
+            self.on_exit(key, returncode, reason)
+        except Exception as e:
+            logger.exception(f'problem reporting exit of {key}')
+
+    async def _stop(self, process):
+        if process.returncode is None:
+            process.terminate()
+            try:
+                await asyncio.wait_for(process.wait(), self.kill_grace)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+
+    async def _stop_all(self):
+        processes = list(self._processes.values())
+        await asyncio.gather(*(self._stop(process)
+                               for process in processes))
@@ -0,0 +1,159 @@
+"""Wakes the engine when message files arrive. On Linux, a `DirectoryWatcher`
+uses inotify to notice files renamed or written into the watched
+directories. Elsewhere, or if inotify cannot be initialized, it falls back to
+polling. Either way, `DirectoryWatcher.wake` interrupts a wait immediately,
+which is how a `SIGTERM` handler gets the daemon to shut down promptly.
+
+Note that inotify only reports changes made through the local kernel. Files
+written by other hosts onto a network filesystem (NFS, Lustre, etc.) are
+invisible to it, so the watcher always returns after at most
+`poll_interval` seconds, regardless of mode."""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+from pathlib import Path
+import select
+import struct
+
+
+logger = logging.getLogger(__name__)
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, 'O_CLOEXEC', 0o2000000)
+WATCH_MASK = IN_MOVED_TO | IN_CLOSE_WRITE
+
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+READ_SIZE = 64 * 1024
+
+
+class DirectoryWatcher:
+    """Waits for new files in a list of directories. Call `wait` to block
+    until something arrives, `wake` (from anywhere, including a signal
+    handler) to cut a wait short, and `close` when done. The file descriptors
+    are opened in the constructor, so construct a `DirectoryWatcher` after
+    daemonizing."""
+
+    def __init__(self, directories, *, poll_interval=1.0, use_inotify=True):
+        """Parameters: `directories` is an iterable of paths to watch;
+        `poll_interval` is the longest time in seconds that `wait` will
+        block; `use_inotify` may be set to False to force polling."""
+        self.directories = [Path(directory) for directory in directories]
+        self.poll_interval = poll_interval
+        self._wake_read, self._wake_write = os.pipe()
+        os.set_blocking(self._wake_read, False)
+        os.set_blocking(self._wake_write, False)
+        self._inotify_fd = None
+        self._watches = {}  # watch descriptor -> directory
+        if use_inotify:
+            try:
+                self._open_inotify()
+            except OSError as e:
+                logger.warning(f'inotify unavailable, polling instead: {e}')
+                self._close_inotify()
+
+    @property
+    def polling(self):
+        """True if this watcher is not using inotify."""
+        return self._inotify_fd is None
+
+    def wait(self, timeout=None):
+        """Block until a file arrives in a watched directory, `wake` is
+        called, or `timeout` seconds elapse. `timeout` defaults to, and is
+        capped by, `poll_interval`. Returns a list of the `Path`s of files
+        that arrived, which may be empty. An empty result does not mean that
+        nothing arrived, only that the watcher did not see it."""
+        if timeout is None or timeout > self.poll_interval:
+            timeout = self.poll_interval
+        fds = [self._wake_read]
+        if not self.polling:
+            fds.append(self._inotify_fd)
+        readable, _, _ = select.select(fds, [], [], timeout)
+        if self._wake_read in readable:
+            self._drain_wake_pipe()
+        if self._inotify_fd is not None and self._inotify_fd in readable:
+            return self._read_events()
+        return []
+
+    def wake(self):
+        """Make the current or next `wait` return immediately. Safe to call
+        from a signal handler."""
+        try:
+            os.write(self._wake_write, b'\0')
+        except BlockingIOError:
+            pass  # The pipe is full, so a wakeup is already pending.
+
+    def close(self):
+        """Release the file descriptors."""
+        self._close_inotify()
+        for fd in (self._wake_read, self._wake_write):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def _open_inotify(self):
+        """Initialize inotify and add a watch for every directory. Raises
+        `OSError` on failure."""
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError(errno.ENOSYS, 'no C library found')
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'no inotify support in C library')
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._inotify_fd = fd
+        for directory in self.directories:
+            wd = libc.inotify_add_watch(fd, os.fsencode(directory),
+                                        WATCH_MASK)
+            if wd < 0:
+                error_number = ctypes.get_errno()
+                raise OSError(error_number, os.strerror(error_number),
+                              str(directory))
+            self._watches[wd] = directory
+        logger.debug(f'watching with inotify: {self.directories}')
+
+    def _close_inotify(self):
+        if self._inotify_fd is not None:
+            os.close(self._inotify_fd)
+        self._inotify_fd = None
+        self._watches.clear()
+
+    def _drain_wake_pipe(self):
+        try:
+            while os.read(self._wake_read, READ_SIZE):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _read_events(self):
+        """Return the paths named by all pending inotify events."""
+        paths = []
+        while True:
+            try:
+                buffer = os.read(self._inotify_fd, READ_SIZE)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, _, name_length = EVENT_HEADER.unpack_from(buffer,
+                                                                    offset)
+                offset += EVENT_HEADER.size
+                name = buffer[offset:offset + name_length].rstrip(b'\0')
+                offset += name_length
+                if mask & IN_Q_OVERFLOW:
+                    logger.warning('inotify queue overflow')
+                elif mask & IN_IGNORED:
+                    logger.warning(f'watch removed: {self._watches.get(wd)}')
+                elif name and wd in self._watches:
+                    paths.append(self._watches[wd] / os.fsdecode(name))
+        return paths
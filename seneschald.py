@@ -11,7 +11,6 @@ import os
 import signal
 import sys
 import syslog
-import time
 
 from daemon import DaemonContext
 from daemon.runner import is_pidfile_stale, emit_message
@@ -19,6 +18,8 @@ from lockfile.pidlockfile import PIDLockFile
 import yaml
 
 from seneschal import Engine
+from seneschal.archiver import archive_message_drops
+from seneschal.audit import AuditPipeline
 
 
 logger = logging.getLogger('seneschald')
@@ -38,10 +39,17 @@ def main():
             config_logging(logging_config)
             if daemon_command == 'stop':
                 stop(daemon_config)
+            elif daemon_command == 'archive':
+                archive_message_drops(seneschal_config)
             else:
                 engine = Engine(seneschal_config)
                 if daemon_command == 'sweep':
-                    engine.sweep()
+                    try:
+                        engine.start_plugins()
+                        engine.start_managers()
+                        engine.sweep()
+                    finally:
+                        engine.close()
     except Exception as e:
         emit_message(e)
         sys.exit(1)
@@ -52,7 +60,8 @@ def main():
 def parse_args():
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('config_file', help='path to YAML file')
-    parser.add_argument('daemon_command', choices=['start', 'stop', 'sweep'])
+    parser.add_argument('daemon_command',
+                        choices=['start', 'stop', 'sweep', 'archive'])
     args = parser.parse_args()
     return args
 
@@ -66,6 +75,7 @@ def load_config_file(config_file):
 def start(logging_config, daemon_config, seneschal_config):
     syslog.openlog('seneschal', 0, syslog.LOG_USER)
     engine = Engine(seneschal_config)
+    audit_pipeline = AuditPipeline(**(seneschal_config.get('audit') or {}))
     pidfile, daemon_options = check_daemon_options(daemon_config)
     if is_pidfile_stale(pidfile):
         syslog.syslog(syslog.LOG_NOTICE, 'breaking stale PID file')
@@ -80,21 +90,26 @@ def start(logging_config, daemon_config, seneschal_config):
             pid = os.getpid()
             syslog.syslog(syslog.LOG_NOTICE, 'daemon running as: %s' % pid)
             config_logging(logging_config)
+            audit_pipeline.start()
             logger.debug('========================================')
             logger.info('daemon running pid=%s', pid)
             logger.debug('args: %r', sys.argv)
             logger.debug('daemon_options: %r', daemon_options)
             logger.debug('seneschal_config: %r', seneschal_config)
+            engine.start_watching()
+            engine.start_plugins()
+            engine.start_managers()
+            engine.resume()
             while Engine.running:
                 engine.sweep()
-                time.sleep(1)
-                # TODO: Long polling times, may result in an unacceptable
-                # delay during daemon shutdown.
+                engine.wait_for_messages()
     except Exception as e:
         syslog.syslog(syslog.LOG_ERR, str(e))
         logger.exception(repr(e))
         raise
     finally:
+        engine.close()
+        audit_pipeline.stop()
         syslog.syslog(syslog.LOG_NOTICE, 'exiting')
         logger.info('exiting')
 
@@ -172,9 +187,10 @@ def config_logging(logging_config_dict):
 
 
 def trigger_shutdown(signum, frame):
-    """Set global `running` to False, to trigger shutdown."""
+    """Set global `running` to False and wake the engine, to trigger
+    shutdown."""
     syslog.syslog(syslog.LOG_NOTICE, 'term signal')
-    Engine.running = False
+    Engine.shutdown()
 
 
 class DaemonStopError(RuntimeError):
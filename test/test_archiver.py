@@ -0,0 +1,72 @@
+import os
+import tarfile
+import time
+
+from seneschal import messaging
+from seneschal.archiver import ARCHIVE, INDEX, LEGACY_INDEX, Archiver
+
+from test_messaging import make_drop
+
+
+def test_archive_and_lookup(tmp_path):
+    make_drop(tmp_path)
+    now = time.time()
+    day = 86400
+    old_time = now - 3 * day
+    uuids = []
+    for index in range(5):
+        uuid_str = messaging.leave_message(tmp_path, messaging.NEW,
+                                           index=index)
+        uuids.append(uuid_str)
+        name = uuid_str + '.json'
+        subdir = messaging.ERROR if index == 4 else messaging.RECEIVED
+        path = tmp_path / subdir / name
+        (tmp_path / messaging.INBOX / name).rename(path)
+        if index < 4:
+            os.utime(path, (old_time, old_time))
+    archiver = Archiver(directory=tmp_path, min_age=0, bucket_seconds=day)
+    # Renaming just set st_ctime, so nothing is old enough yet.
+    assert archiver.run(now=now - 60) == {messaging.RECEIVED: 0,
+                                          messaging.ERROR: 0}
+    assert archiver.run(now=now + 60) == {messaging.RECEIVED: 4,
+                                          messaging.ERROR: 1}
+    assert not list((tmp_path / messaging.RECEIVED).iterdir())
+    assert not list((tmp_path / messaging.ERROR).iterdir())
+    segments = sorted(path.name
+                      for path in (tmp_path / ARCHIVE).glob('*.tar.gz'))
+    assert len(segments) == 2  # One bucket each, days apart.
+    with tarfile.open(tmp_path / ARCHIVE / segments[0]) as tar:
+        assert all(member.name.startswith(messaging.RECEIVED)
+                   for member in tar)
+    for index, uuid_str in enumerate(uuids):
+        message = archiver.lookup(uuid_str)
+        assert message['uuid_str'] == uuid_str
+        assert message['index'] == index
+    assert archiver.lookup('no-such-uuid') is None
+
+    # A crash after indexing leaves files that are simply unlinked.
+    path = tmp_path / messaging.RECEIVED / (uuids[0] + '.json')
+    path.write_text('{}')
+    assert archiver.run(now=now + 60)[messaging.RECEIVED] == 0
+    assert not path.exists()
+    assert archiver.lookup(uuids[0])['index'] == 0
+
+
+def test_index_sharded_by_uuid(tmp_path):
+    make_drop(tmp_path)
+    archiver = Archiver(directory=tmp_path, min_age=0)
+    uuid_str = messaging.leave_message(tmp_path, messaging.NEW)
+    name = uuid_str + '.json'
+    (tmp_path / messaging.INBOX / name).rename(
+        tmp_path / messaging.RECEIVED / name)
+    assert archiver.run(now=time.time() + 60)[messaging.RECEIVED] == 1
+    shards = list((tmp_path / ARCHIVE / INDEX).iterdir())
+    assert [path.name for path in shards] == [uuid_str[:2] + '.jsonl']
+
+    # An unsharded index of an older version is split by the next run.
+    shards[0].rename(tmp_path / ARCHIVE / LEGACY_INDEX)
+    assert archiver.lookup(uuid_str)['uuid_str'] == uuid_str
+    archiver.run()
+    assert not (tmp_path / ARCHIVE / LEGACY_INDEX).exists()
+    assert archiver.indexed_names(uuid_str) == {(messaging.RECEIVED, name)}
+    assert archiver.lookup(uuid_str)['uuid_str'] == uuid_str
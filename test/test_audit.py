@@ -0,0 +1,60 @@
+import logging
+from logging.handlers import RotatingFileHandler
+
+import pytest
+
+from seneschal.audit import (AuditPipeline, DROP, audit, audit_logger,
+                             format_value)
+
+
+@pytest.fixture
+def audit_handler(tmp_path):
+    handler = RotatingFileHandler(tmp_path / 'audit.log', maxBytes=2000,
+                                  backupCount=2)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    audit_logger.addHandler(handler)
+    audit_logger.setLevel(logging.INFO)
+    audit_logger.propagate = False
+    yield handler
+    audit_logger.removeHandler(handler)
+    audit_logger.propagate = True
+    handler.close()
+
+
+def test_format_value():
+    assert format_value('alice') == 'alice'
+    assert format_value(3) == '3'
+    assert format_value('a b="c"') == r'"a b=\"c\""'
+    assert format_value('') == '""'
+
+
+def test_pipeline_batches_rotates_and_flushes(tmp_path, audit_handler):
+    pipeline = AuditPipeline(queue_size=1000, batch_size=50)
+    pipeline.start()
+    assert audit_handler not in audit_logger.handlers
+    for index in range(200):
+        audit('test_event', index=index, note='some words')
+    pipeline.stop()
+    assert audit_handler in audit_logger.handlers
+    lines = []
+    for name in ('audit.log.2', 'audit.log.1', 'audit.log'):
+        lines.extend((tmp_path / name).read_text().splitlines())
+    assert lines[-1] == 'event=test_event index=199 note="some words"'
+    assert len(lines) < 200  # The oldest were rotated away.
+    assert [int(line.split()[1][6:]) for line in lines] == list(
+        range(200 - len(lines), 200))
+
+
+def test_drop_policy_reports_gap(tmp_path, audit_handler):
+    pipeline = AuditPipeline(queue_size=5, when_full=DROP)
+    # Not started, so nothing drains the queue yet.
+    for index in range(8):
+        pipeline.enqueue(audit_logger.makeRecord(
+            'audit', logging.INFO, __file__, 0, f'event=e index={index}',
+            (), None))
+    assert pipeline.dropped_total == 3
+    pipeline.start()
+    pipeline.stop()
+    lines = (tmp_path / 'audit.log').read_text().splitlines()
+    assert lines == [f'event=e index={index}' for index in range(5)] + [
+        'event=audit_records_dropped count=3']
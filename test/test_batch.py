@@ -0,0 +1,78 @@
+import pytest
+
+from seneschal import managers, messaging
+from seneschal.batch import (LocalScheduler, offsets_path, read_arguments,
+                             write_argument_file)
+
+from test_messaging import make_broker, make_paths
+
+
+def test_array_job_coalescing(tmp_path):
+    paths = make_paths(tmp_path, 'requests', 'jobs')
+    batch_scheduler = LocalScheduler(paths['job_messages'])
+    request_manager = managers.RequestManager(directory=paths['requests'])
+    job_manager = managers.JobManager(directory=paths['jobs'],
+                                      batch_scheduler=batch_scheduler)
+    broker = make_broker(paths, request_manager, job_manager)
+    count = 200
+    root = dict(type='parallel', child_type='batch_job', cores=1,
+                cwd='md5_dst_dir', executable='.../python3.6',
+                prefix_arguments=['.../md5_script'],
+                zchildren=[dict(arguments=[f'src_file{i}', f'sample{i}'])
+                           for i in range(count)])
+    managers.propagate_inheritance(root, chained=True)
+    request_id = '12300000-0000-0000-0000-000000000000'
+    root['request_id'] = request_id
+    request_manager.add_worker(dict(id=request_id, t=root))
+    request = request_manager.registry[request_id]
+    request.root_task.start(broker)
+
+    [job_spec] = batch_scheduler.submissions
+    assert job_spec['array_size'] == count
+    assert job_spec['argv'] == ['.../python3.6', '.../md5_script']
+    assert read_arguments(job_spec['argument_file'], 7) == ['src_file7',
+                                                           'sample7']
+    assert request.path_index.leaf_state_counts == {messaging.STARTED: count}
+
+    assert batch_scheduler.run_pending(fail={3}) == count
+    assert broker.deliver_up_to(10 * count)[messaging.JOB] == 2 * count
+    assert request.path_index.leaf_state_counts == {
+        messaging.SUCCEEDED: count - 1, messaging.FAILED: 1}
+    assert root['zchildren'][3]['state'] == messaging.FAILED
+    assert root['state'] == messaging.FAILED
+    assert len(job_manager.registry) == 0
+
+
+def test_admission_batched_under_limits(tmp_path):
+    paths = make_paths(tmp_path, 'requests', 'jobs')
+    batch_scheduler = LocalScheduler(paths['job_messages'])
+    request_manager = managers.RequestManager(directory=paths['requests'])
+    job_manager = managers.JobManager(directory=paths['jobs'],
+                                      batch_scheduler=batch_scheduler)
+    broker = make_broker(paths, request_manager, job_manager,
+                         scheduling=dict(max_cores_per_request=10))
+    root = dict(type='parallel', child_type='batch_job', cores=1,
+                executable='.../python3.6',
+                zchildren=[dict(arguments=[f'sample{i}'])
+                           for i in range(30)])
+    managers.propagate_inheritance(root, chained=True)
+    request_id = '12300000-0000-0000-0000-000000000001'
+    request_manager.add_worker(dict(id=request_id, t=root))
+    request_manager.registry[request_id].root_task.start(broker)
+    while batch_scheduler.run_pending():
+        broker.deliver_up_to(1000)
+    assert [job_spec['array_size']
+            for job_spec in batch_scheduler.submissions] == [10, 10, 10]
+    assert root['state'] == messaging.SUCCEEDED
+
+
+def test_read_arguments_by_offset(tmp_path):
+    path = tmp_path / 'arguments.jsonl'
+    argument_lists = [[f'file{i}', 'é' * i] for i in range(50)]
+    write_argument_file(path, argument_lists)
+    assert [read_arguments(path, i) for i in (0, 17, 49)] == [
+        argument_lists[0], argument_lists[17], argument_lists[49]]
+    with pytest.raises(IndexError):
+        read_arguments(path, 50)
+    offsets_path(path).unlink()  # Written before there were tables
+    assert read_arguments(path, 17) == argument_lists[17]
@@ -0,0 +1,116 @@
+import importlib.util
+import json
+import os
+from pathlib import Path
+import subprocess
+import sys
+
+import pytest
+import yaml
+
+from seneschal import client
+
+from test_messaging import make_drop
+
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+def load_script():
+    spec = importlib.util.spec_from_file_location('seneschal_script',
+                                                  ROOT / 'seneschal.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_client_imports_stay_light():
+    code = ('import sys, seneschal.client; '
+            'print(sorted(name for name in ("yaml", "logging", '
+            '"seneschal.engine", "seneschal.messaging") '
+            'if name in sys.modules))')
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT,
+                                     universal_newlines=True)
+    assert output.strip() == '[]'
+
+
+def test_config_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    script = load_script()
+    config_path = tmp_path / 'config.yaml'
+    config = dict(logging={}, daemon={},
+                  seneschal=dict(paths=dict(user_messages='/a'),
+                                 delivery=dict(batch_size=1)))
+    config_path.write_text(yaml.safe_dump(config))
+    assert script.load_config_file(str(config_path)) == dict(
+        paths=dict(user_messages='/a'))
+    [cache_path] = (tmp_path / 'cache' / 'seneschal').iterdir()
+    assert cache_path.stat().st_size < 200  # Only the paths are kept.
+    assert script.load_config_file(str(config_path))['paths'] == dict(
+        user_messages='/a')
+
+    config['seneschal']['paths']['user_messages'] = '/changed'
+    config_path.write_text(yaml.safe_dump(config))
+    os.utime(config_path, ns=(0, 1))  # Make sure the mtime changes.
+    assert script.load_config_file(str(config_path))['paths'] == dict(
+        user_messages='/changed')
+
+
+def test_leave_new_requests(tmp_path):
+    drop = make_drop(tmp_path / 'drop').directory
+    requests = [('echo', [str(index)]) for index in range(5)]
+    uuids = list(client.leave_new_requests(drop, requests, durable=True,
+                                           chunk_size=2))
+    assert len(set(uuids)) == 5
+    assert not list((drop / client.TEMP).iterdir())
+    for uuid_str, (workflow, arg_list) in zip(uuids, requests):
+        message = json.loads(
+            (drop / client.INBOX / f'{uuid_str}.json').read_text())
+        assert message == dict(uuid_str=uuid_str, message_type=client.NEW,
+                               target_id=None, workflow=workflow,
+                               arg_list=arg_list)
+
+    # A failing input discards its partial chunk but keeps earlier chunks.
+    def failing():
+        yield 'echo', ['a']
+        yield 'echo', ['b']
+        yield 'echo', ['c']
+        raise RuntimeError('bad input')
+
+    seen = []
+    with pytest.raises(RuntimeError):
+        for uuid_str in client.leave_new_requests(drop, failing(),
+                                                  chunk_size=2):
+            seen.append(uuid_str)
+    assert len(seen) == 2
+    assert not list((drop / client.TEMP).iterdir())
+    assert len(list((drop / client.INBOX).iterdir())) == 7
+
+
+def test_submit_batch(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    drop = make_drop(tmp_path / 'drop').directory
+    config_path = tmp_path / 'config.yaml'
+    config_path.write_text(yaml.safe_dump(
+        dict(seneschal=dict(paths=dict(user_messages=str(drop))))))
+    lines = ['{"workflow": "echo", "args": ["1"]}', '',
+             '{"workflow": "ls"}']
+    output = subprocess.run(
+        [sys.executable, str(ROOT / 'seneschal.py'), str(config_path),
+         'submit', '--batch', '-'],
+        input='\n'.join(lines), stdout=subprocess.PIPE, check=True,
+        universal_newlines=True).stdout
+    uuids = output.split()
+    assert len(uuids) == 2
+    workflows = [json.loads((drop / client.INBOX / f'{uuid_str}.json')
+                            .read_text())['workflow'] for uuid_str in uuids]
+    assert workflows == ['echo', 'ls']
+
+
+def test_durable_without_syncfs(tmp_path, monkeypatch):
+    monkeypatch.setattr(client, '_syncfs', False)  # Fall back to fsync
+    drop = make_drop(tmp_path / 'drop').directory
+    uuids = list(client.leave_new_requests(drop, [('echo', [])] * 3,
+                                           durable=True, chunk_size=2))
+    assert sorted(path.stem for path in (drop / client.INBOX).iterdir()) \
+        == sorted(uuids)
@@ -0,0 +1,80 @@
+import os
+import time
+
+from seneschal import client, messaging
+from seneschal.cluster import Cluster, partition_of
+
+from test_messaging import make_drop
+
+PARTITIONS = 8
+
+
+def settle(*clusters):
+    """Heartbeat every node a few times, as if time passed."""
+    for _ in range(4):
+        for cluster in clusters:
+            cluster.heartbeat()
+
+
+def test_related_uuids_share_a_partition():
+    target_id = client.new_uuid()
+    uuid_str = client.new_uuid(target_id)
+    assert uuid_str != target_id
+    assert partition_of(uuid_str, 64) == partition_of(target_id, 64)
+    assert partition_of('not-hex.json', 64) == 0
+
+
+def test_leases_balance_and_fail_over(tmp_path):
+    a = Cluster(directory=tmp_path, node='a', partitions=PARTITIONS)
+    gained, lost = a.heartbeat()
+    assert not gained and len(a.pending) == PARTITIONS  # Not yet confirmed
+    gained, lost = a.heartbeat()
+    assert gained == set(range(PARTITIONS)) and not lost
+
+    b = Cluster(directory=tmp_path, node='b', partitions=PARTITIONS)
+    settle(b, a, b, a)
+    assert len(a.owned) == len(b.owned) == PARTITIONS // 2
+    assert a.live_nodes == b.live_nodes == 2
+    assert a.owned | b.owned == set(range(PARTITIONS))
+
+    # Node a stops renewing: its heartbeat and leases go stale.
+    past = time.time() - 3600
+    for path in (tmp_path / 'leases').iterdir():
+        if int(path.name) in a.owned:
+            os.utime(path, (past, past))
+    os.utime(tmp_path / 'nodes' / 'a', (past, past))
+    settle(b)
+    assert b.owned == set(range(PARTITIONS))
+    gained, lost = a.heartbeat()
+    assert not a.owned and lost
+
+    b.release_all()
+    assert not list((tmp_path / 'leases').iterdir())
+
+
+def test_claims_and_requeue(tmp_path):
+    drop = make_drop(tmp_path / 'user_messages')
+    cluster = Cluster(directory=tmp_path / 'cluster', node='a',
+                      partitions=2)
+    drop.set_cluster(cluster)
+    uuids = [messaging.leave_message(drop.directory, messaging.NEW)
+             for _ in range(20)]
+    cluster.owned = {0}
+    mine = {uuid_str for uuid_str in uuids if cluster.owns(uuid_str)}
+    fetched = set()
+    message = drop.fetch_message()
+    while message is not None:
+        fetched.add(message.uuid_str)
+        message = drop.fetch_message()
+    assert fetched == mine
+    assert len(list(drop.inbox.iterdir())) == len(uuids) - len(mine)
+
+    # Node b died holding a claim on a message in partition 1.
+    [other] = sorted(set(uuids) - mine)[:1]
+    b_claims = drop.directory / messaging.CLAIMED / 'b'
+    b_claims.mkdir()
+    os.rename(drop.inbox / f'{other}.json', b_claims / f'{other}.json')
+    cluster.owned = {0, 1}
+    assert drop.requeue_claims({1}) == 1
+    assert drop.fetch_message() is not None
+    assert not list(b_claims.iterdir())
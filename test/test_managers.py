@@ -0,0 +1,207 @@
+import json
+import os
+import time
+import uuid
+
+import pytest
+
+from seneschal import managers, messaging
+
+
+class Worker(managers.DictProxy):
+    pass
+
+
+class CountingManager(managers.Manager):
+    loads = 0
+
+    def __init__(self, **kwds):
+        super().__init__(**kwds, worker_class=Worker)
+
+    def load(self, subdir):
+        CountingManager.loads += 1
+        return managers.load_most_recent_state(subdir)
+
+
+def make_worker_dir(root):
+    worker_id = str(uuid.uuid4())
+    subdir = root / 'by_uuid' / worker_id
+    subdir.mkdir(parents=True)
+    (subdir / '0.json').write_text(json.dumps(dict(id=worker_id)))
+    return worker_id
+
+
+@pytest.fixture
+def manager_root(tmp_path):
+    CountingManager.loads = 0
+    return tmp_path
+
+
+def test_lazy_registry_and_snapshot(manager_root):
+    worker_ids = {make_worker_dir(manager_root) for _ in range(3)}
+    manager = CountingManager(directory=manager_root)
+    assert set(manager.registry) == worker_ids
+    assert CountingManager.loads == 0
+    worker_id = min(worker_ids)
+    assert manager.registry[worker_id].id == worker_id
+    assert CountingManager.loads == 1
+    assert manager.checkpoint()
+    assert not manager.checkpoint()
+    snapshot = json.loads(manager.registry_snapshot_path.read_text())
+    assert sorted(snapshot['ids']) == sorted(worker_ids)
+
+    # A fresh manager trusts the snapshot...
+    manager = CountingManager(directory=manager_root)
+    assert not manager.registry.dirty
+    # ...until by_uuid changes behind its back.
+    worker_ids.add(make_worker_dir(manager_root))
+    manager = CountingManager(directory=manager_root)
+    assert manager.registry.dirty
+    assert set(manager.registry) == worker_ids
+
+
+def test_registry_drops_vanished_worker(manager_root):
+    worker_id = make_worker_dir(manager_root)
+    manager = CountingManager(directory=manager_root)
+    for path in manager.worker_dir(worker_id).iterdir():
+        path.unlink()
+    manager.worker_dir(worker_id).rmdir()
+    with pytest.raises(KeyError):
+        manager.registry[worker_id]
+    assert worker_id not in manager.registry
+
+
+def test_state_compaction(tmp_path):
+    subdir = tmp_path / str(uuid.uuid4())
+    subdir.mkdir()
+    for i in range(12):
+        assert managers.save_new_state(subdir, dict(i=i),
+                                       compact_every=5) == i
+    assert managers.load_most_recent_state(subdir) == dict(i=11)
+    assert managers.most_recent_state_number(subdir) == 11
+    assert sorted(p.name for p in subdir.iterdir()) == [
+        '10.json', '11.json', managers.STATE_HISTORY, managers.LATEST_STATE
+    ]
+    history = list(managers.iterate_state_history(subdir))
+    assert history == [(i, dict(i=i)) for i in range(12)]
+
+
+def test_sharded_layout_and_migration(manager_root):
+    flat_ids = {make_worker_dir(manager_root) for _ in range(3)}
+    manager = CountingManager(directory=manager_root, shard_depth=2,
+                              migrate_batch=2)
+    assert set(manager.registry) == flat_ids
+    worker_id = min(flat_ids)
+    assert manager.worker_dir(worker_id).parent.name == 'by_uuid'
+    new_id = str(uuid.uuid4())
+    manager.save_worker_state(new_id, dict(id=new_id))
+    new_dir = manager_root / 'by_uuid' / new_id[:2] / new_id[2:4] / new_id
+    assert manager.worker_dir(new_id) == new_dir
+    assert new_dir.is_dir()
+
+    assert manager.checkpoint()  # Moves two workers...
+    assert manager.migrate() == 1  # ...and this the last one.
+    assert manager.migrate() == 0
+    for worker_id in flat_ids:
+        subdir = manager.worker_dir(worker_id)
+        assert subdir.parent.parent.parent.name == 'by_uuid'
+        assert (manager_root / 'by_uuid' / worker_id).is_symlink()
+        assert manager.registry[worker_id].id == worker_id
+
+    # A new manager sees every worker once, even with a stale snapshot.
+    manager = CountingManager(directory=manager_root, shard_depth=2)
+    assert manager.registry.dirty
+    assert set(manager.registry) == flat_ids | {new_id}
+    assert manager.migrate() == 0
+
+    # The symlinks go once they are old enough.
+    assert manager.remove_migration_links() == 0
+    assert manager.remove_migration_links(now=time.time() + 86400) == 3
+    assert not any((manager_root / 'by_uuid' / worker_id).exists()
+                   for worker_id in flat_ids)
+    manager = CountingManager(directory=manager_root, shard_depth=2)
+    assert set(manager.registry) == flat_ids | {new_id}
+
+
+def test_delta_saves(manager_root):
+    manager = CountingManager(directory=manager_root, state_snapshot_every=4,
+                              compact_every=6)
+    worker_id = str(uuid.uuid4())
+    state = dict(id=worker_id, t=dict(
+        state='NEW', running=[],
+        zchildren=[dict(path=f't/{i}', state='NEW') for i in range(50)]))
+    states = []
+    for i in range(10):
+        leaf = state['t']['zchildren'][i]
+        leaf['state'] = 'SUCCEEDED'
+        leaf['returncode'] = 0
+        state['t']['running'] = [i + 1]
+        state.pop('removed', None)
+        if i % 2:
+            state['removed'] = i
+        assert manager.save_worker_state(worker_id, state) == i
+        states.append(json.loads(json.dumps(state)))
+        subdir = manager.worker_dir(worker_id)
+        assert managers.load_most_recent_state(subdir) == state
+        assert managers.most_recent_state_number(subdir) == i
+    assert manager.save_worker_state(worker_id, state) == 9  # No change
+    assert sorted(p.name for p in subdir.iterdir()) == [
+        '8.deltas.jsonl', '8.json', managers.STATE_HISTORY,
+        managers.LATEST_STATE
+    ]
+    delta = json.loads((subdir / '8.deltas.jsonl').read_text())
+    assert delta == dict(num=9, changes=[
+        [['t', 'zchildren', 9], dict(returncode=0, state='SUCCEEDED'), []],
+        [['t'], dict(running=[10]), []],
+        [[], dict(removed=9), []],
+    ])
+    history = list(managers.iterate_state_history(subdir))
+    assert history == list(enumerate(states))
+
+    # An incomplete last line, as after a crash, is ignored, and a fresh
+    # manager starts with a full state file after the last good delta.
+    with (subdir / '8.deltas.jsonl').open('a') as fout:
+        fout.write('{"num": 10, "chan')
+    assert managers.load_most_recent_state(subdir) == states[-1]
+    manager = CountingManager(directory=manager_root)
+    assert manager.save_worker_state(worker_id, state) == 10
+    assert os.readlink(subdir / managers.LATEST_STATE) == '10.json'
+
+
+def test_state_changes_round_trip():
+    old = dict(a=1, b=dict(c=[1, 2], d=True), e=[dict(f=1), dict(f=2)])
+    new = dict(a=True, b=dict(c=[1, 2, 3]), e=[dict(f=1), dict(g=2)], h=None)
+    changes = managers.state_changes(old, new)
+    assert managers.state_changes(new, new) == []
+    assert managers.apply_state_changes(json.loads(json.dumps(old)),
+                                        changes) == new
+
+
+def test_state_changes_nested_types():
+    old = dict(a=dict(b=[0, 1], c=dict(d=False)), e=[dict(f=1)])
+    new = dict(a=dict(b=[False, 1.0], c=dict(d=0)), e=[dict(f=True)])
+    changes = managers.state_changes(old, new)
+    assert changes
+    result = managers.apply_state_changes(json.loads(json.dumps(old)),
+                                          json.loads(json.dumps(changes)))
+    assert json.dumps(result, sort_keys=True) == json.dumps(new,
+                                                            sort_keys=True)
+
+
+def test_user_requests_cannot_set_worker_state(tmp_path):
+    manager = managers.RequestManager(directory=tmp_path)
+    uuid_str = str(uuid.uuid4())
+    manager.receive_message(messaging.Message(
+        channel=messaging.REQUEST, target_id=None, message_type=messaging.NEW,
+        uuid_str=uuid_str, uid=12345, user_name='mallory', workflow='md5',
+        arg_list=[], id='../../x', t=dict(type='subprocess', argv=['x'])))
+    assert vars(manager.registry[uuid_str]) == dict(
+        id=uuid_str, uuid_str=uuid_str, uid=12345, user_name='mallory',
+        workflow='md5', arg_list=[])
+    assert [path.name for path in (tmp_path / 'by_uuid').iterdir()] == [
+        uuid_str]
+    with pytest.raises(messaging.UntrustedMessageError):
+        manager.receive_message(messaging.Message(
+            channel=messaging.REQUEST, target_id=uuid_str,
+            message_type=messaging.SUCCEEDED, uuid_str=str(uuid.uuid4()),
+            uid=12345, user_name='mallory', path='t'))
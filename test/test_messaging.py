@@ -0,0 +1,335 @@
+import os
+from types import SimpleNamespace
+from uuid import uuid4
+
+import pytest
+
+from seneschal import messaging
+
+
+def make_drop(root, channel=messaging.REQUEST):
+    for name in (messaging.TEMP, messaging.INBOX, messaging.RECEIVED,
+                 messaging.ERROR):
+        (root / name).mkdir(parents=True)
+    return messaging.MessageDrop(directory=root, channel=channel)
+
+
+def leave_aged_messages(drop, count):
+    """Leave `count` messages, oldest first, and return their UUIDs."""
+    uuids = []
+    for age in range(count, 0, -1):
+        uuid_str = messaging.leave_message(drop.directory, messaging.NEW,
+                                           workflow='echo', arg_list=[])
+        path = drop.inbox / (uuid_str + '.json')
+        os.utime(path, (1000 - age, 1000 - age))
+        uuids.append(uuid_str)
+    return uuids
+
+
+@pytest.fixture
+def drop(tmp_path):
+    return make_drop(tmp_path / 'user_messages')
+
+
+def test_fetch_oldest_first(drop):
+    uuids = leave_aged_messages(drop, 5)
+    fetched = [drop.fetch_message().uuid_str for _ in uuids]
+    assert fetched == uuids
+    assert drop.fetch_message() is None
+    assert len(list(drop.received.iterdir())) == 5
+
+
+def test_fetch_skips_vanished_and_bad_files(drop):
+    uuids = leave_aged_messages(drop, 3)
+    assert drop.inbox_index.scan() == 3
+    (drop.inbox / (uuids[0] + '.json')).unlink()
+    (drop.inbox / (uuids[1] + '.json')).write_text('{"bad": 1}')
+    assert drop.fetch_message().uuid_str == uuids[2]
+    assert [p.stem for p in drop.error.iterdir()] == [uuids[1]]
+
+
+def test_fetch_survives_bad_file_vanishing(drop, monkeypatch):
+    uuids = leave_aged_messages(drop, 2)
+
+    def load_message(message_path, channel, **kwds):
+        if message_path.stem == uuids[0]:
+            message_path.unlink()  # As by a racing node
+            raise messaging.MessageFormatError('bad')
+        return real_load_message(message_path, channel, **kwds)
+
+    real_load_message = messaging.load_message
+    monkeypatch.setattr(messaging, 'load_message', load_message)
+    assert drop.fetch_message().uuid_str == uuids[1]
+    assert list(drop.error.iterdir()) == []
+
+
+def test_note_arrival(drop):
+    drop.inbox_index.scan()
+    uuid_str = messaging.leave_message(drop.directory, messaging.NEW)
+    drop.note_arrival(drop.inbox / (uuid_str + '.json'))
+    assert len(drop.inbox_index) == 1
+
+
+class RecordingManager:
+    def __init__(self):
+        self.messages = []
+
+    def set_message_broker(self, message_broker):
+        pass
+
+    def receive_message(self, message):
+        self.messages.append(message)
+
+    def checkpoint(self, force=False):
+        pass
+
+    def resume(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+
+def make_paths(root, *names):
+    """Return the "paths" config section of a daemon under `root`, with
+    both message drops, and the directories `names`, such as "requests",
+    created."""
+    paths = dict(user_messages=root / 'user_messages',
+                 job_messages=root / 'job_messages')
+    for path in paths.values():
+        make_drop(path)
+    for name in names:
+        paths[name] = root / name
+        paths[name].mkdir()
+    return paths
+
+
+def make_broker(paths, request_manager=None, job_manager=None,
+                subprocess_manager=None, **config):
+    """Return a `MessageBroker` for `paths` and the other `config`
+    sections, over the given managers, or `RecordingManager`s."""
+    return messaging.MessageBroker(dict(config, paths=paths),
+                                   request_manager or RecordingManager(),
+                                   job_manager or RecordingManager(),
+                                   subprocess_manager or RecordingManager())
+
+
+def test_deliver_up_to_is_fair(tmp_path):
+    config = dict(paths=dict(user_messages=tmp_path / 'user_messages',
+                             job_messages=tmp_path / 'job_messages'),
+                  delivery=dict(weights=dict(JOB=2)))
+    user_drop = make_drop(config['paths']['user_messages'])
+    job_drop = make_drop(config['paths']['job_messages'], messaging.JOB)
+    leave_aged_messages(user_drop, 20)
+    leave_aged_messages(job_drop, 4)
+    managers = [RecordingManager() for _ in range(3)]
+    broker = messaging.MessageBroker(config, *managers)
+    assert broker.deliver_up_to(6) == {messaging.REQUEST: 2,
+                                       messaging.JOB: 4}
+    assert broker.deliver_up_to(100) == {messaging.REQUEST: 18,
+                                         messaging.JOB: 0}
+    assert not broker.attempt_to_deliver_one_left_message()
+
+
+def test_owner_cache():
+    cache = messaging.OwnerCache(maxsize=2)
+    uid = os.getuid()
+    assert cache.user_name(uid) == cache.user_name(uid)
+    assert (cache.hits, cache.misses) == (1, 1)
+    unknown_uid = 2 ** 31 - 2
+    assert cache.user_name(unknown_uid) == str(unknown_uid)
+    assert cache.user_name(unknown_uid) == str(unknown_uid)
+    assert cache.stats() == dict(hits=2, misses=2, negative_lookups=1,
+                                 size=2)
+    cache.user_name(0)
+    assert cache.stats()['size'] == 2
+
+
+def fake_stat(uid, mtime_ns):
+    return SimpleNamespace(st_uid=uid, st_mtime_ns=mtime_ns)
+
+
+def test_fair_inbox_index(tmp_path):
+    heavy, light = 900001, 900002
+    index = messaging.FairInboxIndex(tmp_path,
+                                     weights={str(heavy): 2})
+    index.scan()
+    for i in range(100):
+        index.add(f'h{i:03}.json', fake_stat(heavy, i))
+    for i in range(3):
+        index.add(f'l{i}.json', fake_stat(light, 1000 + i))
+    assert index.queue_depths() == {str(heavy): 100, str(light): 3}
+    names = [index.pop().name for _ in range(9)]
+    # Weighted 2:1, and oldest first for each user:
+    assert names == ['h000.json', 'l0.json', 'h001.json', 'h002.json',
+                     'l1.json', 'h003.json', 'h004.json', 'l2.json',
+                     'h005.json']
+    assert index.queue_depths() == {str(heavy): 94}
+
+
+def test_fair_inbox_index_in_flight_cap(tmp_path):
+    first, second = 900001, 900002
+    index = messaging.FairInboxIndex(tmp_path, default_max_in_flight=1)
+    index.scan()
+    for uid in (first, second):
+        for i in range(2):
+            index.add(f'{uid}-{i}.json', fake_stat(uid, i))
+
+    def start(path):
+        uid = int(path.stem.split('-')[0])
+        index.started(SimpleNamespace(message_type=messaging.NEW,
+                                      target_id=None, uid=uid,
+                                      uuid_str=path.stem))
+        return path.stem
+
+    started = [start(index.pop()), start(index.pop())]
+    assert started == [f'{first}-0', f'{second}-0']
+    assert index.pop() is None  # Both users are at their cap.
+    assert index.in_flight() == {str(first): 1, str(second): 1}
+    index.finished(f'{second}-0')
+    assert index.pop().stem == f'{second}-1'
+
+
+def test_hostile_files_go_to_error(tmp_path):
+    drop = messaging.MessageDrop(directory=make_drop(tmp_path).directory,
+                                 channel=messaging.REQUEST,
+                                 limits=dict(max_bytes=4096, max_depth=8,
+                                             max_elements=100))
+    drop.trusted_uids = frozenset()  # As if a user wrote every file
+    good = messaging.leave_message(drop.directory, messaging.NEW,
+                                   text='[[[[[[[[[[,,,,' * 10)
+    bad = {
+        'large': '{"x": "' + 'a' * 5000 + '"}',
+        'deep': '[' * 1000 + ']' * 1000,
+        'wide': '[' + ','.join('1' * 200) + ']',
+        'list': '[1, 2]',
+        'keys': '{"uuid_str": "x", "message_type": "NEW"}',
+        'type': '{"uuid_str": "%s", "message_type": "BOGUS", '
+                '"target_id": null}',
+        'resume': '{"uuid_str": "%s", "message_type": "RESUME", '
+                  '"target_id": "%s"}' % ('%s', uuid4()),
+        'uuid': '{"uuid_str": 5, "message_type": "NEW", "target_id": null}',
+        'null': '{"uuid_str": "%s", "message_type": "FAILED", '
+                '"target_id": null}',
+        'target': '{"uuid_str": "%s", "message_type": "FAILED", '
+                  '"target_id": [1]}',
+        'event': '{"uuid_str": "%s", "message_type": "SUCCEEDED", '
+                 '"target_id": "%s", "path": "t/0"}' % ('%s', uuid4()),
+        'tree': '{"uuid_str": "%s", "message_type": "NEW", '
+                '"target_id": null, "t": {"type": "subprocess"}}',
+    }
+    for key in ('id', 'path', 'request_id', 'state'):
+        bad[key] = ('{"uuid_str": "%s", "message_type": "NEW", '
+                    '"target_id": null, "' + key + '": "../../x"}')
+    names = {}
+    for label, text in bad.items():
+        uuid_str = messaging.new_uuid()
+        if '%s' in text:
+            text = text % uuid_str
+        (drop.inbox / f'{uuid_str}.json').write_text(text)
+        names[uuid_str] = label
+    link = messaging.new_uuid()
+    os.symlink(drop.inbox / f'{good}.json', drop.inbox / f'{link}.json')
+    (drop.inbox / '...json').write_text(
+        '{"uuid_str": "..", "message_type": "NEW", "target_id": null}')
+
+    message = drop.fetch_message()
+    assert message.uuid_str == good
+    assert drop.fetch_message() is None
+    assert {path.stem for path in drop.error.iterdir()} == (
+        set(names) | {link, '..'})
+
+
+def test_check_structure():
+    messaging.check_structure(b'{"a": "[[[[,,,,"}', 'x', 2, 3)
+    with pytest.raises(messaging.MessageTooComplexError):
+        messaging.check_structure(b'{"a": [[1]]}', 'x', 2, 100)
+    with pytest.raises(messaging.MessageTooComplexError):
+        messaging.check_structure(b'[1, 2, 3, 4]', 'x', 2, 3)
+
+
+def test_engine_survives_failed_delivery(tmp_path):
+    from seneschal import Engine
+    paths = make_paths(tmp_path, 'requests', 'jobs', 'subprocesses',
+                       'plugins')
+    engine = Engine(dict(paths=paths))
+    engine.start_plugins()
+    engine.start_managers()
+    try:
+        # No such job, so the JobManager raises KeyError.
+        messaging.leave_message(paths['job_messages'], messaging.SUCCEEDED,
+                                target_id=str(uuid4()))
+        uuid_str = messaging.leave_new_request(paths['user_messages'],
+                                               'echo', [])
+        assert engine.sweep() == {messaging.REQUEST: 1, messaging.JOB: 1}
+        assert uuid_str in engine.message_broker.managers[
+            messaging.REQUEST].registry
+    finally:
+        engine.close()
+
+
+def test_in_flight_counts_rebuilt_and_released(tmp_path):
+    from seneschal import managers
+    paths = make_paths(tmp_path, 'requests')
+
+    def start_broker():
+        request_manager = managers.RequestManager(
+            directory=paths['requests'])
+        broker = make_broker(paths, request_manager,
+                             fair_queueing=dict(default_max_in_flight=5))
+        return request_manager, broker, broker.message_drops[0].inbox_index
+
+    request_manager, broker, index = start_broker()
+    uuids = [messaging.leave_new_request(paths['user_messages'], 'echo', [])
+             for _ in range(3)]
+    broker.deliver_up_to(10)
+    user = messaging.owner_cache.user_name(os.getuid())
+    assert index.in_flight() == {user: 3}
+
+    # A restart counts the requests in flight again, and a purge stops.
+    request_manager, broker, index = start_broker()
+    assert index.in_flight() == {}
+    broker.resume()
+    assert index.in_flight() == {user: 3}
+    request_manager.purge(uuids[0])
+    assert index.in_flight() == {user: 2}
+
+    # So does a request that fails to be created...
+    index.track('bad', os.getuid())
+    broker.delivery_failed(messaging.Message(
+        channel=messaging.REQUEST, target_id=None,
+        message_type=messaging.NEW, uuid_str='bad'), ValueError('bad'))
+    assert index.in_flight() == {user: 2}
+    # ...or a partition lost to another node.
+    index.forget(lambda request_id: request_id == uuids[1])
+    assert index.in_flight() == {user: 1}
+
+    broker.checkpoint()
+    gauges = messaging.metrics.to_dict()['gauges']
+    assert dict(name='requests_in_flight', value=1,
+                labels=dict(channel=messaging.REQUEST, user=user)) in gauges
+
+
+def test_finished_request_admits_next(tmp_path):
+    from seneschal import managers
+    paths = make_paths(tmp_path, 'requests')
+    request_manager = managers.RequestManager(directory=paths['requests'])
+    broker = make_broker(paths, request_manager,
+                         fair_queueing=dict(default_max_in_flight=1))
+    first, second = [
+        messaging.leave_new_request(paths['user_messages'], 'echo', [])
+        for _ in range(2)]
+    for age, uuid_str in enumerate((second, first)):
+        os.utime(paths['user_messages'] / messaging.INBOX / f'{uuid_str}.json',
+                 (1000 - age, 1000 - age))
+    broker.deliver_up_to(10)
+    assert list(request_manager.registry) == [first]
+    assert broker.deliver_up_to(10) == {messaging.REQUEST: 0,
+                                        messaging.JOB: 0}
+
+    request = request_manager.registry[first]
+    request.t = dict(type='subprocess', path='t', state=messaging.SUCCEEDED)
+    request_manager.save_worker(request)
+    assert not (request_manager.in_flight_dir / first).exists()
+    broker.deliver_up_to(10)
+    assert list(request_manager.registry) == [first, second]
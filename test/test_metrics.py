@@ -0,0 +1,84 @@
+import json
+from pathlib import Path
+
+import yaml
+
+from seneschal import messaging
+from seneschal.metrics import JSON, Metrics, MetricsExporter, metrics
+
+from test_messaging import RecordingManager, make_broker, make_paths
+
+SAMPLE_CONFIG = (Path(__file__).parent.parent / 'docs' /
+                 'seneschal_config_sample.yaml')
+
+
+def test_histogram_export():
+    recorded = Metrics()
+    for value in (0.00002, 0.002, 0.002, 5000):
+        recorded.observe('load_seconds', value, channel='REQUEST')
+    recorded.inc('delivered_total', channel='REQUEST', message_type='NEW')
+    text = recorded.to_prometheus()
+    assert ('seneschal_delivered_total{channel="REQUEST",message_type="NEW"}'
+            ' 1\n') in text
+    assert ('seneschal_load_seconds_bucket{channel="REQUEST",le="0.003"} 3\n'
+            in text)
+    assert 'seneschal_load_seconds_bucket{channel="REQUEST",le="+Inf"} 4\n' \
+        in text
+    assert 'seneschal_load_seconds_count{channel="REQUEST"} 4\n' in text
+
+
+def test_delivery_is_instrumented(tmp_path):
+    paths = make_paths(tmp_path)
+    broker = make_broker(paths)
+    metrics.clear()
+    for _ in range(3):
+        messaging.leave_message(paths['user_messages'], messaging.NEW)
+    assert broker.deliver_up_to(10)[messaging.REQUEST] == 3
+    exporter = MetricsExporter(path=tmp_path / 'stats.json', format=JSON,
+                               interval=3600)
+    assert exporter.maybe_export()
+    assert not exporter.maybe_export()
+    stats = json.loads((tmp_path / 'stats.json').read_text())
+    assert stats['counters'] == [dict(
+        name='messages_delivered_total',
+        labels=dict(channel=messaging.REQUEST, message_type=messaging.NEW),
+        value=3)]
+    counts = {histogram['name']: histogram['count']
+              for histogram in stats['histograms']}
+    assert counts == dict(delivery_seconds=3, inbox_dwell_seconds=3,
+                          json_load_seconds=3, owner_lookup_seconds=3)
+
+
+class ForwardingManager(RecordingManager):
+    def set_message_broker(self, message_broker):
+        self.message_broker = message_broker
+
+    def receive_message(self, message):
+        super().receive_message(message)
+        self.message_broker.deliver_one_message(messaging.Message(
+            channel=messaging.JOB, target_id=None,
+            message_type=messaging.STARTED))
+
+
+def test_nested_delivery_counted_once(tmp_path):
+    job_manager = RecordingManager()
+    broker = make_broker(make_paths(tmp_path), ForwardingManager(),
+                         job_manager)
+    metrics.clear()
+    assert broker.deliver_one_message(messaging.Message(
+        channel=messaging.REQUEST, target_id=None, message_type='BOGUS'))
+    assert len(job_manager.messages) == 1
+    assert metrics.to_dict()['counters'] == [dict(
+        name='messages_delivered_total',
+        labels=dict(channel=messaging.REQUEST, message_type=messaging.OTHER),
+        value=1)]
+
+
+def test_sample_config_sections():
+    config = yaml.safe_load(SAMPLE_CONFIG.read_text())
+    assert config['logging']['loggers']['audit']['handlers'] == [
+        'audit_handler']
+    exporter = MetricsExporter(**config['seneschal']['metrics'])
+    assert exporter.interval == 15
+    assert 'status' not in config['logging']
+    assert config['seneschal']['status']['retention'] == 604800
@@ -0,0 +1,111 @@
+import os
+import sys
+
+import pytest
+
+from seneschal.plugins import PluginError, PluginManager, PluginWorkerPool
+
+
+MODULE_PLUGIN = '''
+created = []
+
+def create(config):
+    created.append(config)
+    def plugin(request):
+        return dict(request, greeting=config['greeting'],
+                    created=len(created))
+    return plugin
+'''
+
+# Answers with its pid and request count, or crashes when asked to.
+EXECUTABLE_PLUGIN = f'''#!{sys.executable}
+import json, os, sys
+config = json.loads(os.environ['SENESCHAL_PLUGIN_CONFIG'])
+if os.environ.get('SENESCHAL_PLUGIN_PROTOCOL') != 'jsonl':
+    request = json.load(sys.stdin)
+    json.dump(dict(pid=os.getpid(), count=1, **config), sys.stdout)
+    sys.exit()
+count = 0
+for line in sys.stdin:
+    request = json.loads(line)
+    if request.get('crash'):
+        sys.exit(1)
+    count += 1
+    print(json.dumps(dict(pid=os.getpid(), count=count, **config)),
+          flush=True)
+'''
+
+
+def install(directory, name, file_name, text):
+    plugin_dir = directory / name
+    plugin_dir.mkdir()
+    path = plugin_dir / file_name
+    path.write_text(text)
+    path.chmod(0o755)
+
+
+@pytest.fixture
+def plugins_dir(tmp_path):
+    install(tmp_path, 'hello-1.0', 'plugin.py', MODULE_PLUGIN)
+    install(tmp_path, 'echo-1.0', 'plugin', EXECUTABLE_PLUGIN)
+    install(tmp_path, 'echo-2.0', 'plugin', EXECUTABLE_PLUGIN)
+    return tmp_path
+
+
+def test_module_plugin_created_once(plugins_dir):
+    manager = PluginManager(
+        directory=plugins_dir,
+        plugins_config={'hello-1.0': dict(greeting='hi')}
+    )
+    for _ in range(3):
+        response = manager.invoke('hello-1.0', dict(x=1))
+    assert response == dict(x=1, greeting='hi', created=1)
+    with pytest.raises(PluginError):
+        manager.get('missing-1.0')
+
+
+def test_one_shot_and_persistent_plugins(plugins_dir):
+    manager = PluginManager(
+        directory=plugins_dir,
+        plugins_config={
+            'echo-1.0': dict(flavor='one-shot'),
+            'echo-2.0': dict(flavor='warm',
+                             plugin_host=dict(persistent=True,
+                                              max_requests=3)),
+        },
+        host_options=dict(timeout=10)
+    )
+    try:
+        one_shot = [manager.invoke('echo-1.0', {}) for _ in range(2)]
+        assert [response['count'] for response in one_shot] == [1, 1]
+        assert one_shot[0]['pid'] != one_shot[1]['pid']
+        assert one_shot[0]['flavor'] == 'one-shot'
+
+        warm = [manager.invoke('echo-2.0', {}) for _ in range(4)]
+        # Three requests on one worker, then a recycled worker.
+        assert [response['count'] for response in warm] == [1, 2, 3, 1]
+        assert len({response['pid'] for response in warm[:3]}) == 1
+        assert warm[3]['pid'] != warm[0]['pid']
+        assert warm[0]['flavor'] == 'warm'
+        pool = manager.get('echo-2.0')
+        assert pool.started == 2
+
+        # A crash is retried once on a fresh worker, which crashes too.
+        with pytest.raises(PluginError):
+            manager.invoke('echo-2.0', dict(crash=True))
+        assert manager.invoke('echo-2.0', {})['count'] == 1
+        assert pool.started == 4
+
+        pool.idle_timeout = 0
+        manager.reap_idle()
+        assert not pool._idle
+    finally:
+        manager.shutdown()
+
+
+def test_failed_spawn_gives_back_slot(tmp_path):
+    pool = PluginWorkerPool('missing', [str(tmp_path / 'missing')], {})
+    for _ in range(2):  # Would wait forever if the slot leaked
+        with pytest.raises(OSError):
+            pool({})
+    assert pool._busy == 0
@@ -0,0 +1,100 @@
+from seneschal import managers
+from seneschal.messaging import RESUME
+from seneschal.scheduling import ResourceScheduler, USER
+
+
+@managers.Task.register_concrete_subclass
+class RecordingTask(managers.Task):
+    __task_type_id__ = 'test_recording'
+    started = []
+
+    def start(self, message_broker):
+        RecordingTask.started.append(self.path)
+
+
+class Broker:
+    def __init__(self, **limits):
+        self.scheduler = ResourceScheduler(**limits)
+
+
+def make_request(count, cores=2, request_id='r1'):
+    root = dict(type='parallel', child_type='test_recording', cores=cores,
+                request_id=request_id, user_name='alice',
+                zchildren=[dict(arguments=[i]) for i in range(count)])
+    managers.propagate_inheritance(root, chained=True)
+    return managers.Request(dict(t=root))
+
+
+def test_parallel_task_honors_limits():
+    RecordingTask.started = []
+    broker = Broker(max_cores=64, max_cores_per_user=6)
+    request = make_request(5)
+    task = request.root_task
+    task.start(broker)
+    assert RecordingTask.started == ['t/0', 't/1', 't/2']
+    assert broker.scheduler.usage(USER, 'alice') == (6, 3)
+    assert request.t['running'] == [0, 1, 2]
+    assert request.t['next_child'] == 3
+    for index in range(5):
+        task[index].finish(index != 1, broker)
+    assert RecordingTask.started == ['t/0', 't/1', 't/2', 't/3', 't/4']
+    assert request.t['state'] == 'FAILED'
+    assert request.t['failed'] == 1
+    assert broker.scheduler.usage() == (0, 0)
+    assert request.path_index.leaf_state_counts == {'SUCCEEDED': 4,
+                                                    'FAILED': 1}
+
+
+def test_oversized_task_runs_alone():
+    scheduler = ResourceScheduler(max_cores=4)
+    assert scheduler.try_acquire('r1', 'bob', 8)
+    assert not scheduler.try_acquire('r2', 'carol', 1)
+    scheduler.release('r1', 'bob', 8)
+    assert scheduler.try_acquire('r2', 'carol', 1)
+
+
+def test_restore_after_reload():
+    broker = Broker(max_processes=10)
+    request = make_request(3, cores=1)
+    request.root_task.start(broker)
+    reloaded = managers.Request(request.__dict__)
+    scheduler = ResourceScheduler()
+    reloaded.restore(scheduler)
+    assert scheduler.usage() == (3, 3)
+
+
+def test_waiter_woken_by_other_request():
+    RecordingTask.started = []
+    broker = Broker(max_cores_per_user=4)
+    first = make_request(2)
+    second = make_request(1, request_id='r2')
+    first.root_task.start(broker)
+    second.root_task.start(broker)
+    assert RecordingTask.started == ['t/0', 't/1']
+    assert broker.scheduler.ready_waiters() == []
+    first.root_task[0].finish(True, broker)
+    assert broker.scheduler.ready_waiters() == [('r2', 't')]
+    second.receive_message(RESUME, dict(path='t'), broker)
+    assert RecordingTask.started == ['t/0', 't/1', 't/0']
+    assert second.t['running'] == [0]
+    assert broker.scheduler.usage(USER, 'alice') == (4, 2)
+
+
+def test_root_task_gets_request_ids():
+    root = dict(type='parallel', child_type='test_recording',
+                zchildren=[dict(arguments=[0])])
+    managers.propagate_inheritance(root, chained=True)
+    request = managers.Request(dict(id='r3', user_name='bob', t=root))
+    child = request.root_task[0]
+    assert (child.request_id, child.user_name) == ('r3', 'bob')
+    assert request.root_task.child_resources(child) == ('r3', 'bob', 1)
+
+
+def test_limits_shared_among_nodes():
+    scheduler = ResourceScheduler(max_cores=64, max_cores_per_user=3,
+                                  max_cores_per_request=8)
+    scheduler.set_nodes(4)
+    assert scheduler.limits == {'global': (16, None), 'user': (1, None),
+                                'request': (8, None)}
+    scheduler.set_nodes(1)
+    assert scheduler.limits == scheduler.configured_limits
@@ -0,0 +1,68 @@
+import time
+
+from seneschal import client, managers, messaging
+from seneschal.batch import LocalScheduler
+from seneschal.status import StatusWriter
+
+from test_messaging import make_broker, make_paths
+
+
+def test_status_snapshots(tmp_path):
+    paths = make_paths(tmp_path, 'requests', 'jobs')
+    outbox = tmp_path / 'outbox'
+    batch_scheduler = LocalScheduler(paths['job_messages'])
+    request_manager = managers.RequestManager(
+        directory=paths['requests'], outbox=outbox, status_interval=3600)
+    job_manager = managers.JobManager(directory=paths['jobs'],
+                                      batch_scheduler=batch_scheduler)
+    broker = make_broker(paths, request_manager, job_manager)
+    count = 10
+    root = dict(type='parallel', child_type='batch_job', cores=1,
+                executable='/bin/true', prefix_arguments=[],
+                zchildren=[dict(arguments=[str(i)]) for i in range(count)])
+    managers.propagate_inheritance(root, chained=True)
+    request_id = '12300000-0000-0000-0000-000000000000'
+    root['request_id'] = request_id
+    request_manager.add_worker(dict(id=request_id, t=root, workflow='md5'))
+    request = request_manager.registry[request_id]
+    request_manager.save_worker(request)
+    assert client.read_status(outbox, request_id) is None  # Not flushed
+    broker.checkpoint()
+    status = client.read_status(outbox, request_id)
+    assert status['state'] == messaging.NEW
+    assert status['leaf_states'] == {messaging.NEW: count}
+    assert status['workflow'] == 'md5'
+
+    # Within the interval, changes are coalesced until forced.
+    request.root_task.start(broker)
+    request_manager.save_worker(request)
+    broker.checkpoint()
+    assert client.read_status(outbox, request_id) == status
+    broker.checkpoint(force=True)
+    status = client.read_status(outbox, request_id)
+    assert status['state'] == messaging.STARTED
+    assert status['leaf_states'] == {messaging.STARTED: count}
+
+    # A finished request is written at once.
+    batch_scheduler.run_pending(fail={3})
+    broker.deliver_up_to(10 * count)
+    broker.checkpoint()
+    status = client.read_status(outbox, request_id)
+    assert status['state'] == messaging.FAILED
+    assert status['leaves'] == count
+    assert status['leaf_states'] == {messaging.SUCCEEDED: count - 1,
+                                     messaging.FAILED: 1}
+    assert [path.name for path in (outbox / client.STATUS).iterdir()] == [
+        f'{request_id}.json']
+
+
+def test_expire_finished_snapshots(tmp_path):
+    writer = StatusWriter(directory=tmp_path, retention=60)
+    writer.write('done', dict(state=messaging.SUCCEEDED))
+    writer.write('running', dict(state=messaging.STARTED))
+    assert writer.expire() == 0  # Too recent
+    assert writer.expire(now=time.time() + 120) == 0  # Too soon
+    assert writer.expire(force=True, now=time.time() + 120) == 1
+    assert client.read_status(tmp_path, 'done') is None
+    assert client.read_status(tmp_path, 'running')['state'] == \
+        messaging.STARTED
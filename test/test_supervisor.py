@@ -0,0 +1,64 @@
+import sys
+import time
+
+from seneschal import managers, messaging
+from seneschal.supervisor import SubprocessSupervisor, TIMED_OUT
+
+from test_messaging import make_broker, make_paths
+
+
+EXIT_SCRIPT = 'import sys, time; time.sleep(0.1); sys.exit(int(sys.argv[1]))'
+
+
+def wait_for(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_supervisor_timeout_and_shutdown():
+    exits = []
+    supervisor = SubprocessSupervisor(
+        lambda *args: exits.append(args), kill_grace=1
+    )
+    supervisor.spawn('fast', [sys.executable, '-c', 'pass'])
+    supervisor.spawn('slow', ['sleep', '30'], timeout=0.2)
+    supervisor.spawn('stuck', ['sleep', '30'])
+    wait_for(lambda: len(exits) == 2)
+    assert sorted(exits) == [('fast', 0, None), ('slow', -15, TIMED_OUT)]
+    assert supervisor.shutdown() == ['stuck']
+    assert len(exits) == 2
+
+
+def test_subprocess_tasks_end_to_end(tmp_path):
+    paths = make_paths(tmp_path, 'requests', 'subprocesses')
+    request_manager = managers.RequestManager(directory=paths['requests'])
+    subprocess_manager = managers.SubprocessManager(
+        directory=paths['subprocesses'])
+    broker = make_broker(paths, request_manager,
+                         subprocess_manager=subprocess_manager)
+    root = dict(type='parallel', child_type='subprocess',
+                executable=sys.executable,
+                prefix_arguments=['-c', EXIT_SCRIPT],
+                zchildren=[dict(arguments=[str(code)]) for code in (0, 3)])
+    request_id = '12300000-0000-0000-0000-000000000000'
+    managers.propagate_inheritance(root, chained=True)
+    root['request_id'] = request_id
+    request_manager.add_worker(dict(id=request_id, t=root))
+    request = request_manager.registry[request_id]
+    try:
+        request.root_task.start(broker)
+        assert len(subprocess_manager.registry) == 2
+        wait_for(lambda: len(broker.posted_messages) == 2)
+        assert broker.deliver_up_to(10) == {messaging.REQUEST: 0,
+                                            messaging.JOB: 0,
+                                            messaging.SUBPROCESS: 2}
+    finally:
+        broker.shutdown()
+    assert root['state'] == messaging.FAILED
+    assert [child['state'] for child in root['zchildren']] == [
+        messaging.SUCCEEDED, messaging.FAILED]
+    assert len(subprocess_manager.registry) == 0
+    assert request.path_index.leaf_state_counts == {messaging.SUCCEEDED: 1,
+                                                     messaging.FAILED: 1}
@@ -135,3 +135,88 @@ def test_index_mappings():
     print(yaml.dump(index['t/0/1/1']))
     assert index['t/0/1/1'] == yaml.load(T011)
     assert index['t'] == state
+
+
+def test_child_view():
+    state = yaml.safe_load(STATE_2_YAML)
+    root = managers.Task.from_dict(state)
+    children = root.children
+    assert root.children is children
+    assert root[0] is children[0] is children[-2]
+    assert [child.path for child in children] == ['t/0', 't/1']
+    assert 'zchildren' in vars(root) and '_child_view' not in vars(root)
+    grandchild = root[0][1]
+    grandchild.cores = 2
+    assert root[0][1] is grandchild
+    assert state['zchildren'][0]['zchildren'][1]['cores'] == 2
+    added = children.append(dict(type='subprocess', path='t/2'))
+    assert isinstance(added, managers.SubprocessTask)
+    assert root[2] is added and len(root.children) == 3
+    state['zchildren'][1] = dict(type='batch_job', path='t/1')
+    assert isinstance(root[1], managers.BatchJobTask)
+
+
+def test_chained_inheritance():
+    state = yaml.safe_load(STATE_1_YAML)
+    managers.propagate_inheritance(state, chained=True)
+    leaf = state['zchildren'][0]['zchildren'][1]['zchildren'][1]
+    assert leaf == dict(arguments=['src_file2', 'sample2'], index=1,
+                        path='t/0/1/1', type='batch_job')
+    task = managers.Task.from_dict(state)[0][1][1]
+    assert (task.cwd, task.cores) == ('md5_dst_dir', 1)
+    assert task.executable == '.../python3.6'
+    assert not hasattr(task, 'child_type')
+    state['state'] = state['zchildren'][0]['state'] = managers.STARTED
+    state['zchildren'][0]['running'] = [0]
+    assert not hasattr(task, 'state') and not hasattr(task, 'running')
+    leaf['state'] = managers.STARTED
+    expanded = managers.expand_inheritance(state)
+    assert managers.compress_inheritance(expanded) == state
+    for mapping in managers.iterate_nested_mappings(state):
+        for key in managers.RUNTIME_KEYS:
+            mapping.pop(key, None)
+    expanded = managers.expand_inheritance(state)
+    assert expanded == yaml.safe_load(STATE_2_YAML)
+    assert managers.compress_inheritance(expanded) == state
+
+
+def test_path_index():
+    state = yaml.safe_load(STATE_2_YAML)
+    index = managers.PathIndex(state)
+    assert sorted(index) == PATHS
+    assert index['t/0/1/1']['arguments'] == ['src_file2', 'sample2']
+    assert [m['path'] for m in index.subtree('t/0/1')] == [
+        't/0/1', 't/0/1/0', 't/0/1/1']
+    assert index.leaf_state_counts == {'NEW': 5}
+    index.set_state('t/0/1/1', 'STARTED')
+    index.set_state('t/0/0/0', 'STARTED')
+    assert [m['path'] for m in index.leaves('t/0/1', 'STARTED')] == [
+        't/0/1/1']
+    assert index.leaf_state_counts == {'NEW': 3, 'STARTED': 2}
+    new_child = dict(type='subprocess', path='t/0/1/2')
+    state['zchildren'][0]['zchildren'][1]['zchildren'].append(new_child)
+    index.add(new_child)
+    assert index.leaf_state_counts['NEW'] == 4
+    index.remove('t/0/1')
+    assert sorted(index) == ['t', 't/0', 't/0/0', 't/0/0/0', 't/0/0/1',
+                             't/1']
+    assert index.leaf_state_counts == {'NEW': 2, 'STARTED': 1}
+    assert managers.parent_path('t/0/1') == 't/0'
+    assert managers.parent_path('t') is None
+
+
+def test_request_task_at():
+    request = managers.Request(dict(t=yaml.safe_load(STATE_2_YAML)))
+    task = request.task_at('t/0/1/1')
+    assert task.__dict__ is request.path_index['t/0/1/1']
+    assert request.task_at('t/0/1/1') is task
+    assert 'root_task' not in vars(request)
+
+
+def test_deep_tree_indexing():
+    root = mapping = dict(type='sequence', path='t')
+    for depth in range(2000):
+        child = dict(type='sequence', path=f'{mapping["path"]}/0')
+        mapping['zchildren'] = [child]
+        mapping = child
+    assert len(managers.index_mappings(root)) == 2001
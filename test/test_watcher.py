@@ -0,0 +1,33 @@
+import os
+import time
+
+from seneschal.watcher import DirectoryWatcher
+
+
+def test_rename_wakes_watcher(tmp_path):
+    watcher = DirectoryWatcher([tmp_path], poll_interval=5)
+    try:
+        if watcher.polling:
+            return  # Nothing to test without inotify.
+        temp_path = tmp_path.parent / (tmp_path.name + '.tmp')
+        temp_path.write_text('{}')
+        os.rename(temp_path, tmp_path / 'a.json')
+        start = time.monotonic()
+        paths = watcher.wait()
+        assert time.monotonic() - start < 1
+        assert paths == [tmp_path / 'a.json']
+    finally:
+        watcher.close()
+
+
+def test_wake_interrupts_wait(tmp_path):
+    for use_inotify in (True, False):
+        watcher = DirectoryWatcher([tmp_path], poll_interval=5,
+                                   use_inotify=use_inotify)
+        try:
+            watcher.wake()
+            start = time.monotonic()
+            assert watcher.wait() == []
+            assert time.monotonic() - start < 1
+        finally:
+            watcher.close()